@@ -0,0 +1,91 @@
+import time
+import threading
+
+# How long attributes and missing paths are remembered, in this process
+# and by the kernel
+ATTRIBUTE_TIMEOUT = 1.0  # seconds
+# Paths whose last invalidation is remembered. Beyond this, all lookups
+# that started before are treated as overlapping an invalidation.
+MAX_INVALIDATED_PATHS = 10000
+
+
+class AttributeCache:
+    """Remembers the results of getattr for `ttl` seconds,
+    including the paths that do not exist.
+
+    The cache is invalidated by the operations of the fuse process
+    that change a path. Changes from the worker processes only touch
+    the state of a file, not its attributes, so they do not need to
+    invalidate it.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # path -> (expiry, attributes). Attributes are None for missing paths.
+        self.entries = {}
+        self.lock = threading.Lock()
+        # Counts invalidations. A getattr that overlapped with an
+        # invalidation of its path may have seen the old attributes
+        # and must not put them into the cache.
+        self.generation = 0
+        # path -> generation of its last invalidation
+        self.invalidations = {}
+        # Generation of the last invalidation that may have
+        # touched any path
+        self.last_invalidation_of_all = 0
+
+    def get(self, path):
+        """Returns a tuple (hit, attributes)"""
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                return False, None
+            expiry, attributes = entry
+            if expiry < time.monotonic():
+                del self.entries[path]
+                return False, None
+            return True, attributes
+
+    def put(self, path, attributes, generation):
+        """`generation` is the value of the generation
+        when the attributes were looked up.
+        """
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            if generation < max(
+                self.invalidations.get(path, 0), self.last_invalidation_of_all
+            ):
+                return
+            self.entries[path] = (time.monotonic() + self.ttl, attributes)
+
+    def put_missing(self, path, generation):
+        self.put(path, None, generation)
+
+    def invalidate(self, path):
+        """Forgets the path and its parent folder, whose
+        times and link count change with it.
+        """
+        with self.lock:
+            self.generation += 1
+            if len(self.invalidations) >= MAX_INVALIDATED_PATHS:
+                self.invalidations.clear()
+                self.last_invalidation_of_all = self.generation
+            for invalidated_path in (path, _parent(path)):
+                self.invalidations[invalidated_path] = self.generation
+                self.entries.pop(invalidated_path, None)
+
+    def invalidate_tree(self, path):
+        """Forgets a folder, everything below it and its parent folder"""
+        prefix = path.rstrip("/") + "/"
+        with self.lock:
+            self.generation += 1
+            self.last_invalidation_of_all = self.generation
+            for cached_path in list(self.entries):
+                if cached_path.startswith(prefix):
+                    del self.entries[cached_path]
+        self.invalidate(path)
+
+
+def _parent(path):
+    return path.rstrip("/").rsplit("/", 1)[0] or "/"
@@ -2,18 +2,144 @@
 The lifecycle settings on the bucket must be configured to
 'keep only the last version.
 """
+
+import os
+import io
+import time
+import hashlib
+import tempfile
 from io import BytesIO
+from uuid import uuid4
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from b2.api import B2Api
 from b2.bucket import Bucket
 from b2.account_info.in_memory import InMemoryAccountInfo
-from b2.download_dest import DownloadDestBytes
-from b2.exception import B2ConnectionError
+from b2.download_dest import AbstractDownloadDestination
+from b2.exception import B2ConnectionError, B2Error, FileNotPresent
 from .b2_file_info_store import FileInfoStore
+from .chunking import split_into_chunks, hash_chunk
+from .compression import (
+    compress,
+    compress_file,
+    has_compressed_extension,
+    is_worth_compressing,
+    DecompressingStream,
+    DEFAULT_CODEC,
+    SAMPLE_SIZE,
+)
+
+# Files of at least this size are uploaded in parts, with several parts
+# in flight at once.
+LARGE_FILE_THRESHOLD = 200 * 1000 * 1000  # Bytes
+PART_SIZE = 100 * 1000 * 1000  # Bytes
+UPLOAD_CONCURRENCY = 4
+MAX_PART_UPLOAD_ATTEMPTS = 5
+# B2 does not accept large files with more parts than this.
+MAX_NUMBER_OF_PARTS = 10000
+# Prefix of the names of chunks in the content-addressed layout
+CHUNK_PREFIX = "chunks/"
+# Files below this size are uploaded together in pack objects,
+# which saves a transaction for each of them.
+PACK_FILE_THRESHOLD = 256 * 1024  # Bytes
+PACK_SIZE = 16 * 1000 * 1000  # Bytes
+PACK_PREFIX = "packs/"
+# Packs in which the files that are left take up less than this
+# fraction are rewritten by the compactor.
+MIN_LIVE_FRACTION = 0.5
+
+
+class UploadAbortException(Exception):
+    pass
+
+
+class DownloadDestStream(AbstractDownloadDestination):
+    """Hands the downloaded bytes to a stream as they arrive,
+    instead of collecting them in memory.
+    """
+
+    def __init__(self, stream, on_content_length=None):
+        self.stream = stream
+        self.on_content_length = on_content_length
+
+    def make_file_context(
+        self,
+        file_id,
+        file_name,
+        content_length,
+        content_type,
+        content_sha1,
+        file_info,
+        mod_time_millis,
+        range_=None,
+    ):
+        if self.on_content_length is not None:
+            self.on_content_length(content_length)
+        return self._stream_context()
+
+    @contextmanager
+    def _stream_context(self):
+        yield self.stream
+
+
+def choose_part_ranges(content_length, part_size):
+    """Returns (offset, length) of the parts of a large file.
+    The part size is increased if the file would otherwise
+    have too many parts.
+    """
+    part_size = max(part_size, -(-content_length // MAX_NUMBER_OF_PARTS))
+    return [
+        (offset, min(part_size, content_length - offset))
+        for offset in range(0, content_length, part_size)
+    ]
+
+
+def _download_decompressed(bucket_api, file_id, stream, first, last, range_):
+    """Downloads the compressed object, or the `range_` of the object
+    that holds it, and writes its decompressed bytes from `first`
+    to `last` into `stream`.
+    """
+    decompressing_stream = DecompressingStream(stream, first, last)
+    bucket_api.download_file_by_id(
+        file_id, DownloadDestStream(decompressing_stream), range_=range_
+    )
+    decompressing_stream.finish()
+
+
+def _get_file_descriptor(file):
+    try:
+        return file.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        # For example an in-memory stream
+        return None
 
 
 class FileAPI:
 
-    def __init__(self, account_id, application_key, bucket_id, db_file):
+    def __init__(
+        self,
+        account_id,
+        application_key,
+        bucket_id,
+        db_file,
+        large_file_threshold=LARGE_FILE_THRESHOLD,
+        part_size=PART_SIZE,
+        upload_concurrency=UPLOAD_CONCURRENCY,
+        content_addressed=False,
+        compression=False,
+        pack_small_files=False,
+    ):
+        """With `content_addressed`, files are uploaded as chunks that
+        are shared between files. With `compression`, files or chunks
+        that compress well are uploaded compressed. With
+        `pack_small_files`, the cleaner uploads small files in packs.
+        Files that were uploaded either way can always be downloaded
+        and deleted.
+        """
+        self.large_file_threshold = large_file_threshold
+        self.part_size = part_size
+        self.upload_concurrency = upload_concurrency
+        self.compression = compression
         try:
             account_info = InMemoryAccountInfo()
             self.api = B2Api(account_info)
@@ -25,17 +151,301 @@ class FileAPI:
             raise ConnectionError
         self.bucket_api = Bucket(self.api, bucket_id)
         self.file_info_store = FileInfoStore(db_file)
+        self.chunk_store = ChunkStore(self) if content_addressed else None
+        self.pack_store = PackStore(self) if pack_small_files else None
 
-    def upload(self, file, file_uuid, file_uuid_to_replace=None):
+    def upload(
+        self,
+        file,
+        file_uuid,
+        file_uuid_to_replace=None,
+        abort_requested=None,
+        upload_key=None,
+    ):
+        """Returns the uuid under which the file was uploaded.
+
+        The upload stops with an UploadAbortException once
+        `abort_requested` returns True. Large files are uploaded in parts
+        and `abort_requested` is checked before each part, and before
+        each block while they are compressed.
+        The parts that were uploaded before an abort are kept. The next
+        upload with the same `upload_key` carries on from there, under
+        the uuid of the interrupted upload.
+        """
         if file_uuid_to_replace is not None:
             self.delete(file_uuid_to_replace)
-        data = file.read()
-        file_info = self.bucket_api.upload_bytes(data, str(file_uuid))
+        abort_requested = abort_requested or (lambda: False)
+        file_descriptor = _get_file_descriptor(file)
+        file_name = getattr(file, "name", None)
+        if file_descriptor is not None and self.chunk_store is not None:
+            self.chunk_store.upload(
+                file_descriptor,
+                file_uuid,
+                abort_requested,
+                compress=self.compression
+                and not has_compressed_extension(file_name),
+            )
+            return file_uuid
+        if file_descriptor is not None and self._is_large_file(
+            os.fstat(file_descriptor).st_size
+        ):
+            content_length = os.fstat(file_descriptor).st_size
+            codec = self._choose_codec(
+                file_name, os.pread(file_descriptor, SAMPLE_SIZE, 0)
+            )
+            if codec is None:
+                file_uuid, file_id = self._upload_large_file(
+                    file_descriptor, file_uuid, abort_requested, upload_key
+                )
+            else:
+                # The compressed size is only known once the whole file
+                # is compressed, so it is compressed to disk first.
+                with tempfile.TemporaryFile() as compressed_file:
+                    if not compress_file(
+                        file_descriptor,
+                        compressed_file,
+                        codec,
+                        abort_requested,
+                    ):
+                        raise UploadAbortException
+                    compressed_file.flush()
+                    compressed_length = os.fstat(
+                        compressed_file.fileno()
+                    ).st_size
+                    if self._is_large_file(compressed_length):
+                        file_uuid, file_id = self._upload_large_file(
+                            compressed_file.fileno(),
+                            file_uuid,
+                            abort_requested,
+                            upload_key,
+                        )
+                    else:
+                        # Too small for a large file once it is compressed
+                        if abort_requested():
+                            raise UploadAbortException
+                        file_id = self._upload_bytes(
+                            os.pread(
+                                compressed_file.fileno(), compressed_length, 0
+                            ),
+                            file_uuid,
+                        )
+        else:
+            if abort_requested():
+                raise UploadAbortException
+            data = file.read()
+            content_length = len(data)
+            codec = self._choose_codec(file_name, data[:SAMPLE_SIZE])
+            if codec is not None:
+                data = compress(data, codec)
+            file_id = self._upload_bytes(data, file_uuid)
         self.file_info_store.set_file_id(
-            file_uuid, file_info.as_dict().get("fileId")
+            file_uuid, file_id, codec, content_length
+        )
+        return file_uuid
+
+    def _upload_bytes(self, data, file_uuid):
+        """Uploads the file in one request. Returns the file id."""
+        try:
+            file_info = self.bucket_api.upload_bytes(data, str(file_uuid))
+        except B2ConnectionError:
+            raise ConnectionError
+        return file_info.as_dict().get("fileId")
+
+    def should_pack(self, content_length):
+        return (
+            self.pack_store is not None
+            and content_length < PACK_FILE_THRESHOLD
+        )
+
+    def upload_pack(self, members):
+        """Uploads small files together in one object.
+        `members` are (file_uuid, data, file_name) of the files.
+        """
+        self.pack_store.upload(members)
+
+    def compact_packs(self):
+        if self.pack_store is None:
+            return
+        self.pack_store.compact()
+
+    def get_packed_files(self):
+        """Returns the uuids of the files that are stored in packs,
+        except those that are waiting to be deleted.
+        """
+        return self.file_info_store.get_packed_uuids()
+
+    def _choose_codec(self, file_name, sample):
+        """Returns the codec to compress the file with, or None"""
+        if self.compression and is_worth_compressing(sample, file_name):
+            return DEFAULT_CODEC
+        return None
+
+    def _get_part_size(self):
+        return max(
+            self.part_size, self.api.account_info.get_minimum_part_size()
+        )
+
+    def _is_large_file(self, content_length):
+        # A large file needs at least two parts
+        return content_length >= max(
+            self.large_file_threshold, 2 * self._get_part_size()
         )
 
+    def _upload_large_file(
+        self, file_descriptor, file_uuid, abort_requested, upload_key
+    ):
+        """Uploads the file in parts, several of them at once.
+        Each part is read from disk only when it is its turn, so memory use
+        is bounded by the part size times the number of parallel uploads.
+        Returns the file uuid and the file id.
+        """
+        content_length = os.fstat(file_descriptor).st_size
+        part_ranges = choose_part_ranges(content_length, self._get_part_size())
+        try:
+            file_uuid, file_id, uploaded_sha1s = self._start_large_file(
+                file_uuid, content_length, part_ranges, upload_key
+            )
+            try:
+                with ThreadPoolExecutor(self.upload_concurrency) as executor:
+                    part_futures = [
+                        executor.submit(
+                            self._upload_part,
+                            file_id,
+                            part_number,
+                            file_descriptor,
+                            offset,
+                            length,
+                            uploaded_sha1s.get(part_number),
+                            abort_requested,
+                        )
+                        for part_number, (offset, length) in enumerate(
+                            part_ranges, start=1
+                        )
+                    ]
+                    part_sha1s = [future.result() for future in part_futures]
+                response = self.api.session.finish_large_file(
+                    file_id, part_sha1s
+                )
+            except UploadAbortException:
+                if upload_key is None:
+                    self._cancel_large_file(file_id, upload_key)
+                # Otherwise the parts are kept for the next attempt
+                raise
+            except Exception:
+                self._cancel_large_file(file_id, upload_key)
+                raise
+        except B2ConnectionError:
+            raise ConnectionError
+        if upload_key is not None:
+            self.file_info_store.remove_unfinished_upload(upload_key)
+        return file_uuid, response["fileId"]
+
+    def _start_large_file(
+        self, file_uuid, content_length, part_ranges, upload_key
+    ):
+        """Returns the file uuid, the file id and the sha1 of the parts
+        that are already uploaded, by part number. These come from an
+        interrupted upload under `upload_key` if the file still has the
+        same size. Otherwise a new large file is started.
+        """
+        unfinished = None
+        if upload_key is not None:
+            unfinished = self.file_info_store.get_unfinished_upload(upload_key)
+        if unfinished is not None:
+            unfinished_uuid, file_id, unfinished_length = unfinished
+            if unfinished_length == content_length:
+                parts = list(self.bucket_api.list_parts(file_id))
+                if all(
+                    part.part_number <= len(part_ranges)
+                    and part.content_length
+                    == part_ranges[part.part_number - 1][1]
+                    for part in parts
+                ):
+                    print(f"Resuming upload of {unfinished_uuid}")
+                    return (
+                        unfinished_uuid,
+                        file_id,
+                        {
+                            part.part_number: part.content_sha1
+                            for part in parts
+                        },
+                    )
+            self._cancel_large_file(file_id, upload_key)
+        file_id = self.bucket_api.start_large_file(
+            str(file_uuid), Bucket.DEFAULT_CONTENT_TYPE, {}
+        ).file_id
+        if upload_key is not None:
+            self.file_info_store.set_unfinished_upload(
+                upload_key, file_uuid, file_id, content_length
+            )
+        return file_uuid, file_id, {}
+
+    def get_unfinished_uploads(self):
+        """Returns the upload keys of the interrupted uploads"""
+        return self.file_info_store.get_unfinished_upload_keys()
+
+    def cancel_unfinished_upload(self, upload_key):
+        """Gives up the interrupted upload under `upload_key`, if any,
+        together with its parts.
+        """
+        unfinished = self.file_info_store.get_unfinished_upload(upload_key)
+        if unfinished is not None:
+            _, file_id, _ = unfinished
+            self._cancel_large_file(file_id, upload_key)
+
+    def _cancel_large_file(self, file_id, upload_key):
+        if upload_key is not None:
+            self.file_info_store.remove_unfinished_upload(upload_key)
+        try:
+            self.bucket_api.cancel_large_file(file_id)
+        except B2Error as e:
+            # For example if it was cancelled before
+            print(f"Could not cancel large file {file_id}: {e}")
+
+    def _upload_part(
+        self,
+        file_id,
+        part_number,
+        file_descriptor,
+        offset,
+        length,
+        uploaded_sha1,
+        abort_requested,
+    ):
+        if abort_requested():
+            raise UploadAbortException
+        data = os.pread(file_descriptor, length, offset)
+        sha1 = hashlib.sha1(data).hexdigest()
+        if sha1 == uploaded_sha1:
+            # Uploaded by an earlier attempt
+            return sha1
+        for attempt in range(MAX_PART_UPLOAD_ATTEMPTS):
+            try:
+                # Every thread needs its own upload url
+                response = self.api.session.get_upload_part_url(file_id)
+                self.api.raw_api.upload_part(
+                    response["uploadUrl"],
+                    response["authorizationToken"],
+                    part_number,
+                    len(data),
+                    sha1,
+                    BytesIO(data),
+                )
+                return sha1
+            except B2Error as e:
+                if (
+                    not e.should_retry_upload()
+                    or attempt == MAX_PART_UPLOAD_ATTEMPTS - 1
+                ):
+                    raise
+
     def delete(self, file_uuid):
+        if PackStore(self).delete(file_uuid):
+            return
+        manifest = self.file_info_store.get_manifest(file_uuid)
+        if manifest is not None:
+            ChunkStore(self).delete(file_uuid)
+            return
         file_id = self.file_info_store.get_file_id(file_uuid)
         if not file_id:
             # No file ID means file was never synched to remote
@@ -47,14 +457,412 @@ class FileAPI:
             )
             return
         print("deleting file from remote")
-        self.bucket_api.delete_file_version(file_id, str(file_uuid))
+        self._delete_object(file_uuid, file_id)
         self.file_info_store.remove_entry(file_uuid)
 
+    def delete_many(self, file_uuids, executor):
+        """Deletes the files, with the calls to the remote running
+        on `executor`. The files that are stored as single objects are
+        looked up and forgotten together. Released chunks are queued by
+        their file id. Returns the exceptions of the files that could
+        not be deleted, by uuid.
+        """
+        names = self.file_info_store.get_pending_object_names(file_uuids)
+        file_ids = self.file_info_store.get_many(
+            [file_uuid for file_uuid in file_uuids if file_uuid not in names]
+        )
+        futures = {}
+        for file_uuid in file_uuids:
+            if file_uuid in names:
+                futures[file_uuid] = executor.submit(
+                    self._delete_object, names[file_uuid], file_uuid
+                )
+            elif file_uuid in file_ids:
+                futures[file_uuid] = executor.submit(
+                    self._delete_object, file_uuid, file_ids[file_uuid]
+                )
+            else:
+                # Packed, chunked or never uploaded
+                futures[file_uuid] = executor.submit(self.delete, file_uuid)
+        errors = {}
+        deleted_objects = []
+        for file_uuid, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                errors[file_uuid] = e
+                continue
+            if file_uuid in file_ids:
+                deleted_objects.append(file_uuid)
+        self.file_info_store.remove_many(deleted_objects)
+        return errors
+
+    def _delete_object(self, name, file_id):
+        try:
+            self.bucket_api.delete_file_version(file_id, str(name))
+        except FileNotPresent:
+            # Deleted by an earlier attempt that did not get to
+            # remove the entry
+            pass
+
+    def load_file_info(self, file_uuids):
+        """Looks the files up together, so that
+        their downloads do not have to.
+        """
+        self.file_info_store.get_many(file_uuids)
+
+    def schedule_delete(self, file_uuid):
+        """Leaves the deletion to the deleter, which retries it
+        until it succeeds.
+        """
+        self.file_info_store.add_pending_deletes([file_uuid], time.time())
+
     def download(self, file_uuid):
-        download_dest = DownloadDestBytes()
-        file_id = self.file_info_store.get_file_id(file_uuid)
+        """Returns the content of the file in memory.
+        For big files, prefer `download_to`, which streams to disk.
+        """
+        stream = BytesIO()
+        self.download_to(file_uuid, stream)
+        stream.seek(0)
+        return stream
+
+    def download_to(
+        self,
+        file_uuid,
+        stream,
+        range_=None,
+        on_content_length=None,
+        read_local_copy=None,
+    ):
+        """Writes the content of the file into `stream` while it is being
+        downloaded. `range_` is an inclusive (first, last) byte range.
+        `on_content_length` is called with the number of bytes in the
+        response before the first byte is written.
+        For files that are stored as chunks, `read_local_copy` is asked
+        for each chunk first. It is called with the uuid of another file
+        that contains the chunk, an offset and a length, and returns the
+        bytes if it has that file, or None.
+        """
+        manifest, packed_file, file_info = self.file_info_store.get_location(
+            file_uuid
+        )
+        if manifest is not None:
+            ChunkStore(self).download_to(
+                manifest, stream, range_, on_content_length, read_local_copy
+            )
+            return
+        if packed_file is not None:
+            PackStore(self).download_to(
+                packed_file, stream, range_, on_content_length
+            )
+            return
+        file_id, codec, content_length = file_info or (None, None, None)
+        try:
+            if codec is None:
+                self.bucket_api.download_file_by_id(
+                    file_id,
+                    DownloadDestStream(stream, on_content_length),
+                    range_=range_,
+                )
+                return
+            first, last = range_ or (0, content_length - 1)
+            if on_content_length is not None:
+                on_content_length(last - first + 1)
+            _download_decompressed(
+                self.bucket_api, file_id, stream, first, last, range_=None
+            )
+        except B2ConnectionError:
+            raise ConnectionError
+
+    def supports_ranged_reads(self, file_uuid):
+        """Compressed objects can only be downloaded as a whole,
+        so a ranged download of them is not worth it.
+        """
+        _, packed_file, file_info = self.file_info_store.get_location(
+            file_uuid
+        )
+        if packed_file is not None:
+            return packed_file[3] is None
+        return file_info is None or file_info[1] is None
+
+
+class ChunkStore:
+    """Content-addressed layout: a file is split into chunks, each of
+    which is stored under the hash of its content. A chunk that is
+    already on the remote is not uploaded again, whichever file it
+    came from. The file info store keeps the list of chunks of each
+    file and counts the references to each chunk.
+    """
+
+    def __init__(self, file_api):
+        self.bucket_api = file_api.bucket_api
+        self.file_info_store = file_api.file_info_store
+        self.upload_concurrency = file_api.upload_concurrency
+
+    def upload(self, file_descriptor, file_uuid, abort_requested, compress):
+        """With `compress`, each chunk that compresses well
+        is uploaded compressed.
+        """
+        chunks = split_into_chunks(file_descriptor)
+        with ThreadPoolExecutor(self.upload_concurrency) as executor:
+            futures = [
+                executor.submit(
+                    self._store_chunk,
+                    file_descriptor,
+                    offset,
+                    length,
+                    chunk_hash,
+                    abort_requested,
+                    compress,
+                )
+                for offset, length, chunk_hash in chunks
+            ]
+            stored = []
+            error = None
+            for future in futures:
+                try:
+                    stored.append(future.result())
+                except Exception as e:
+                    error = error or e
+        if error is not None:
+            # Chunks that no other file refers to are left to the deleter
+            self.file_info_store.release_chunks(
+                stored, CHUNK_PREFIX, time.time()
+            )
+            if isinstance(error, B2ConnectionError):
+                raise ConnectionError
+            raise error
+        self.file_info_store.set_manifest(
+            file_uuid,
+            [(chunk_hash, length) for _, length, chunk_hash in chunks],
+        )
+
+    def _store_chunk(
+        self,
+        file_descriptor,
+        offset,
+        length,
+        chunk_hash,
+        abort_requested,
+        compress_chunk,
+    ):
+        """Makes sure that the chunk is on the remote and
+        counts a reference to it. Returns its hash.
+        """
+        if abort_requested():
+            raise UploadAbortException
+        if self.file_info_store.acquire_chunk(chunk_hash):
+            return chunk_hash
+        data = os.pread(file_descriptor, length, offset)
+        if hash_chunk(data) != chunk_hash:
+            # The file was changed since it was split into chunks
+            raise UploadAbortException
+        codec = None
+        if compress_chunk and is_worth_compressing(data[:SAMPLE_SIZE]):
+            codec = DEFAULT_CODEC
+            data = compress(data, codec)
+        file_name = CHUNK_PREFIX + chunk_hash
+        file_info = self.bucket_api.upload_bytes(data, file_name)
+        file_id = file_info.as_dict().get("fileId")
+        if not self.file_info_store.add_chunk(
+            chunk_hash, file_id, length, codec
+        ):
+            # Another upload stored the same chunk in the meantime
+            self.bucket_api.delete_file_version(file_id, file_name)
+        return chunk_hash
+
+    def delete(self, file_uuid):
+        """The chunks that no other file refers to are queued for the
+        deleter together with removing the manifest. They are deleted
+        right away, and are left to the deleter if that fails.
+        """
+        unused = self.file_info_store.remove_manifest(
+            file_uuid, CHUNK_PREFIX, time.time()
+        )
+        deleted = []
+        for name, file_id in unused:
+            try:
+                self.bucket_api.delete_file_version(file_id, name)
+            except FileNotPresent:
+                pass
+            except B2Error as e:
+                print(f"Could not delete {name}, the deleter will retry: {e}")
+                continue
+            deleted.append(file_id)
+        self.file_info_store.remove_pending_deletes(deleted)
+
+    def download_to(
+        self, manifest, stream, range_, on_content_length, read_local_copy
+    ):
+        content_length = sum(length for _, length in manifest)
+        first, last = range_ or (0, content_length - 1)
+        if on_content_length is not None:
+            on_content_length(last - first + 1)
+        download_dest = DownloadDestStream(stream)
+        chunk_start = 0
         try:
-            self.bucket_api.download_file_by_id(file_id, download_dest)
+            for chunk_hash, length in manifest:
+                chunk_end = chunk_start + length - 1
+                if chunk_end >= first and chunk_start <= last:
+                    chunk_range = (
+                        max(first, chunk_start) - chunk_start,
+                        min(last, chunk_end) - chunk_start,
+                    )
+                    data = None
+                    if read_local_copy is not None:
+                        data = self._read_local_copy(
+                            chunk_hash, length, read_local_copy
+                        )
+                    if data is not None:
+                        stream.write(data[chunk_range[0] : chunk_range[1] + 1])
+                    else:
+                        self._download_chunk(
+                            chunk_hash, length, chunk_range, download_dest
+                        )
+                chunk_start += length
         except B2ConnectionError:
             raise ConnectionError
-        return BytesIO(download_dest.get_bytes_written())
+
+    def _download_chunk(self, chunk_hash, length, chunk_range, download_dest):
+        file_id, codec = self.file_info_store.get_chunk(chunk_hash)
+        if codec is not None:
+            _download_decompressed(
+                self.bucket_api,
+                file_id,
+                download_dest.stream,
+                *chunk_range,
+                range_=None,
+            )
+            return
+        self.bucket_api.download_file_by_id(
+            file_id,
+            download_dest,
+            range_=None if chunk_range == (0, length - 1) else chunk_range,
+        )
+
+    def _read_local_copy(self, chunk_hash, length, read_local_copy):
+        for file_uuid, offset in self.file_info_store.get_chunk_locations(
+            chunk_hash
+        ):
+            data = read_local_copy(file_uuid, offset, length)
+            # The local file may have been changed since it was uploaded
+            if data is not None and hash_chunk(data) == chunk_hash:
+                return data
+        return None
+
+
+class PackStore:
+    """Small files are uploaded together in pack objects. A packed file
+    is downloaded with a ranged download of its pack. Deleted files
+    leave holes in their pack, and packs that are mostly holes are
+    rewritten by `compact`.
+    """
+
+    def __init__(self, file_api):
+        self.bucket_api = file_api.bucket_api
+        self.file_info_store = file_api.file_info_store
+        self.compression = file_api.compression
+
+    def upload(self, members):
+        pack = bytearray()
+        entries = []
+        for file_uuid, data, file_name in members:
+            content_length = len(data)
+            codec = None
+            if self.compression and is_worth_compressing(
+                data[:SAMPLE_SIZE], file_name
+            ):
+                codec = DEFAULT_CODEC
+                data = compress(data, codec)
+            entries.append(
+                (file_uuid, len(pack), len(data), codec, content_length)
+            )
+            pack += data
+        name, file_id = self._upload_pack(pack)
+        self.file_info_store.add_pack(name, file_id, len(pack), entries)
+
+    def _upload_pack(self, pack):
+        name = PACK_PREFIX + str(uuid4())
+        try:
+            file_info = self.bucket_api.upload_bytes(bytes(pack), name)
+        except B2ConnectionError:
+            raise ConnectionError
+        return name, file_info.as_dict().get("fileId")
+
+    def delete(self, file_uuid):
+        """Returns False if the file is not packed"""
+        pack = self.file_info_store.remove_packed_file(file_uuid)
+        if pack is None:
+            return False
+        name, file_id, files_left = pack
+        if files_left == 0:
+            self._delete_pack(name, file_id)
+        return True
+
+    def _delete_pack(self, name, file_id):
+        self.file_info_store.remove_pack(name)
+        try:
+            self.bucket_api.delete_file_version(file_id, name)
+        except B2Error as e:
+            # For example if the compactor deleted it at the same time
+            print(f"Could not delete pack {name}: {e}")
+
+    def download_to(self, packed_file, stream, range_, on_content_length):
+        file_id, offset, length, codec, content_length = packed_file
+        first, last = range_ or (0, content_length - 1)
+        if on_content_length is not None:
+            on_content_length(last - first + 1)
+        if last < first:
+            # An empty file
+            return
+        try:
+            if codec is None:
+                self.bucket_api.download_file_by_id(
+                    file_id,
+                    DownloadDestStream(stream),
+                    range_=(offset + first, offset + last),
+                )
+            else:
+                _download_decompressed(
+                    self.bucket_api,
+                    file_id,
+                    stream,
+                    first,
+                    last,
+                    range_=(offset, offset + length - 1),
+                )
+        except B2ConnectionError:
+            raise ConnectionError
+
+    def compact(self, min_live_fraction=MIN_LIVE_FRACTION):
+        """Moves the files of sparse packs into new packs.
+        The emptied packs are deleted by the next compaction, so that
+        downloads that looked up a file just before it was moved
+        can still finish.
+        """
+        for name, file_id in self.file_info_store.get_empty_packs():
+            self._delete_pack(name, file_id)
+        pack = bytearray()
+        moves = []
+        for name, file_id in self.file_info_store.get_sparse_packs(
+            min_live_fraction
+        ):
+            stream = BytesIO()
+            self.bucket_api.download_file_by_id(
+                file_id, DownloadDestStream(stream)
+            )
+            old_pack = stream.getbuffer()
+            entries = self.file_info_store.get_pack_entries(name)
+            for file_uuid, offset, length, _, _ in entries:
+                moves.append((file_uuid, name, len(pack)))
+                pack += old_pack[offset : offset + length]
+            if len(pack) >= PACK_SIZE:
+                self._store_moved_files(pack, moves)
+                pack = bytearray()
+                moves = []
+        if moves:
+            self._store_moved_files(pack, moves)
+
+    def _store_moved_files(self, pack, moves):
+        name, file_id = self._upload_pack(pack)
+        self.file_info_store.move_packed_files(name, file_id, len(pack), moves)
@@ -1,33 +1,537 @@
+import json
 import sqlite3
+import threading
+from collections import OrderedDict
+
+# Number of files whose file id and codec are kept in memory
+FILE_INFO_CACHE_SIZE = 10000
+# Stay well below the limit on the number of sql variables
+MAX_VARIABLES = 500
 
 
 class FileInfoStore:
+    """Safe to share between the threads of a multithreaded fuse process.
+    sqlite connections may be used from several threads as long as
+    access is serialized, which is what the lock is for.
+
+    The database is in WAL mode, so that the processes can read while
+    one of them writes.
+    """
 
-    def __init__(self, db_path):
-        self.connection = sqlite3.connect(db_path, timeout=5)
-        with self.connection:
+    def __init__(self, db_path, cache_size=FILE_INFO_CACHE_SIZE):
+        self.connection = sqlite3.connect(
+            db_path, timeout=5, check_same_thread=False
+        )
+        self.lock = threading.Lock()
+        # file_uuid -> (file_id, codec, content_length), least recently
+        # used first. A uuid is uploaded only once, so its entry stays
+        # valid until it is removed.
+        self.file_info_cache = OrderedDict()
+        self.cache_size = cache_size
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # Durable enough in WAL mode: a crash of the machine can lose
+            # the last transactions, but does not corrupt the database.
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.lock, self.connection:
             self.connection.execute(
                 """CREATE TABLE IF NOT EXISTS b2_file_info (file_uuid text primary key, file_id text)"""
             )
+            # Large files whose upload was interrupted, so that
+            # the next upload of the same file can carry on.
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS unfinished_uploads (upload_key text primary key, file_uuid text, file_id text, content_length integer)"""
+            )
+            # With the content-addressed layout, a file is a list of chunks.
+            # Chunks are shared between files and counted, so that they
+            # can be deleted once no file refers to them anymore.
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS manifests (file_uuid text primary key, chunks text)"""
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS chunks (hash text primary key, file_id text, length integer, refs integer)"""
+            )
+            # Where each chunk is in the files, so that a download can
+            # take chunks from files that are in the cache.
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS chunk_locations (hash text, file_uuid text, offset integer)"""
+            )
+            self.connection.execute(
+                """CREATE INDEX IF NOT EXISTS chunk_locations_by_hash ON chunk_locations (hash)"""
+            )
+            self.connection.execute(
+                """CREATE INDEX IF NOT EXISTS chunk_locations_by_file ON chunk_locations (file_uuid)"""
+            )
+            # Small files are uploaded together in pack objects.
+            # A packed file is a range of its pack.
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS packs (name text primary key, file_id text, size integer)"""
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS packed_files (file_uuid text primary key, pack text, offset integer, length integer, codec text, content_length integer)"""
+            )
+            self.connection.execute(
+                """CREATE INDEX IF NOT EXISTS packed_files_by_pack ON packed_files (pack)"""
+            )
+            # Files that are to be deleted from the remote. They are kept
+            # until the deletion succeeds, and retried with a growing delay.
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS pending_deletes (file_uuid text primary key, attempts integer, due real)"""
+            )
+            self.connection.execute(
+                """CREATE INDEX IF NOT EXISTS pending_deletes_by_due ON pending_deletes (due)"""
+            )
+            # Compressed objects record their codec and the length
+            # of the content before compression.
+            self._add_column("b2_file_info", "codec", "text")
+            self._add_column("b2_file_info", "content_length", "integer")
+            self._add_column("chunks", "codec", "text")
+            # Released chunk objects are queued for deletion by file id,
+            # which tells their versions apart, together with their name.
+            self._add_column("pending_deletes", "name", "text")
+
+    def _add_column(self, table, column, column_type):
+        # For databases that were created before the column existed
+        columns = [
+            row[1]
+            for row in self.connection.execute(f"PRAGMA table_info({table})")
+        ]
+        if column not in columns:
+            self.connection.execute(
+                f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"
+            )
 
-    def set_file_id(self, file_uuid, file_id):
-        with self.connection:
+    def set_file_id(self, file_uuid, file_id, codec=None, content_length=None):
+        """`codec` is None for objects that are not compressed"""
+        with self.lock, self.connection:
             self.connection.execute(
-                """INSERT OR REPLACE INTO b2_file_info (file_uuid, file_id) VALUES (?, ?)""",
-                (file_uuid, file_id),
+                """INSERT OR REPLACE INTO b2_file_info (file_uuid, file_id, codec, content_length) VALUES (?, ?, ?, ?)""",
+                (file_uuid, file_id, codec, content_length),
             )
+            self._cache_file_info(file_uuid, (file_id, codec, content_length))
 
     def get_file_id(self, file_uuid):
-        with self.connection:
+        file_info = self._get_file_infos([file_uuid]).get(file_uuid)
+        return file_info and file_info[0]
+
+    def get_many(self, file_uuids):
+        """Returns the file ids of those of `file_uuids` that are known,
+        by uuid. Those that are not cached are looked up together.
+        """
+        file_infos = self._get_file_infos(file_uuids)
+        return {
+            file_uuid: file_info[0]
+            for file_uuid, file_info in file_infos.items()
+        }
+
+    def get_compression(self, file_uuid):
+        """Returns (codec, content_length) if the object is
+        compressed, otherwise None.
+        """
+        file_info = self._get_file_infos([file_uuid]).get(file_uuid)
+        if file_info is None or file_info[1] is None:
+            return None
+        return file_info[1:]
+
+    def get_location(self, file_uuid):
+        """Looks up how the file is stored, in one query. Returns
+        (manifest, packed_file, file_info) as returned by `get_manifest`,
+        `get_packed_file` and (file_id, codec, content_length).
+        Those that do not apply are None.
+        """
+        with self.lock:
+            file_info = self.file_info_cache.get(file_uuid)
+            if file_info is not None:
+                # Objects are not chunked or packed
+                self.file_info_cache.move_to_end(file_uuid)
+                return None, None, file_info
+            with self.connection:
+                cursor = self.connection.execute(
+                    """SELECT manifests.chunks, packs.file_id, packed_files.offset, packed_files.length, packed_files.codec, packed_files.content_length, b2_file_info.file_id, b2_file_info.codec, b2_file_info.content_length FROM (SELECT ? AS file_uuid) AS file LEFT JOIN manifests ON manifests.file_uuid = file.file_uuid LEFT JOIN packed_files ON packed_files.file_uuid = file.file_uuid LEFT JOIN packs ON packs.name = packed_files.pack LEFT JOIN b2_file_info ON b2_file_info.file_uuid = file.file_uuid""",
+                    (file_uuid,),
+                )
+                row = cursor.fetchone()
+            manifest = row[0] and [
+                tuple(chunk) for chunk in json.loads(row[0])
+            ]
+            packed_file = row[1:6] if row[1] is not None else None
+            file_info = row[6:] if row[6] is not None else None
+            if file_info is not None:
+                self._cache_file_info(file_uuid, file_info)
+        return manifest, packed_file, file_info
+
+    def _get_file_infos(self, file_uuids):
+        file_infos = {}
+        with self.lock:
+            missing = []
+            for file_uuid in file_uuids:
+                file_info = self.file_info_cache.get(file_uuid)
+                if file_info is None:
+                    missing.append(file_uuid)
+                else:
+                    self.file_info_cache.move_to_end(file_uuid)
+                    file_infos[file_uuid] = file_info
+            if not missing:
+                return file_infos
+            for start in range(0, len(missing), MAX_VARIABLES):
+                chunk = missing[start : start + MAX_VARIABLES]
+                cursor = self.connection.execute(
+                    f"""SELECT file_uuid, file_id, codec, content_length FROM b2_file_info WHERE file_uuid IN ({", ".join("?" * len(chunk))})""",
+                    chunk,
+                )
+                for file_uuid, *file_info in cursor:
+                    file_infos[file_uuid] = tuple(file_info)
+                    self._cache_file_info(file_uuid, tuple(file_info))
+        return file_infos
+
+    def _cache_file_info(self, file_uuid, file_info):
+        self.file_info_cache[file_uuid] = file_info
+        self.file_info_cache.move_to_end(file_uuid)
+        if len(self.file_info_cache) > self.cache_size:
+            self.file_info_cache.popitem(last=False)
+
+    def remove_entry(self, file_uuid):
+        self.remove_many([file_uuid])
+
+    def remove_many(self, file_uuids):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                """DELETE from b2_file_info WHERE file_uuid = ?""",
+                [(file_uuid,) for file_uuid in file_uuids],
+            )
+            for file_uuid in file_uuids:
+                self.file_info_cache.pop(file_uuid, None)
+
+    def set_unfinished_upload(
+        self, upload_key, file_uuid, file_id, content_length
+    ):
+        with self.lock, self.connection:
+            self.connection.execute(
+                """INSERT OR REPLACE INTO unfinished_uploads (upload_key, file_uuid, file_id, content_length) VALUES (?, ?, ?, ?)""",
+                (upload_key, file_uuid, file_id, content_length),
+            )
+
+    def get_unfinished_upload(self, upload_key):
+        """Returns (file_uuid, file_id, content_length) or None"""
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                """SELECT file_uuid, file_id, content_length FROM unfinished_uploads WHERE upload_key = ?""",
+                (upload_key,),
+            )
+            return cursor.fetchone()
+
+    def get_unfinished_upload_keys(self):
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                """SELECT upload_key FROM unfinished_uploads"""
+            )
+            return [upload_key for (upload_key,) in cursor.fetchall()]
+
+    def remove_unfinished_upload(self, upload_key):
+        with self.lock, self.connection:
+            self.connection.execute(
+                """DELETE from unfinished_uploads WHERE upload_key = ?""",
+                (upload_key,),
+            )
+
+    def set_manifest(self, file_uuid, chunks):
+        """`chunks` is a list of (hash, length)"""
+        locations = []
+        offset = 0
+        for chunk_hash, length in chunks:
+            locations.append((chunk_hash, file_uuid, offset))
+            offset += length
+        with self.lock, self.connection:
+            self.connection.execute(
+                """INSERT OR REPLACE INTO manifests (file_uuid, chunks) VALUES (?, ?)""",
+                (file_uuid, json.dumps(chunks)),
+            )
+            self.connection.execute(
+                """DELETE from chunk_locations WHERE file_uuid = ?""",
+                (file_uuid,),
+            )
+            self.connection.executemany(
+                """INSERT INTO chunk_locations (hash, file_uuid, offset) VALUES (?, ?, ?)""",
+                locations,
+            )
+
+    def get_manifest(self, file_uuid):
+        with self.lock, self.connection:
             cursor = self.connection.execute(
-                """SELECT file_id FROM b2_file_info WHERE file_uuid = ?""",
+                """SELECT chunks FROM manifests WHERE file_uuid = ?""",
                 (file_uuid,),
             )
-        result = cursor.fetchone()
-        return result and result[0]
+            result = cursor.fetchone()
+        return result and [tuple(chunk) for chunk in json.loads(result[0])]
 
-    def remove_entry(self, file_uuid):
-        with self.connection:
+    def remove_manifest(self, file_uuid, chunk_prefix, due):
+        """Forgets the file and releases its chunks, as `release_chunks`
+        does, in one transaction. Returns what that returns.
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                """SELECT chunks FROM manifests WHERE file_uuid = ?""",
+                (file_uuid,),
+            )
+            result = cursor.fetchone()
+            if result is None:
+                return []
+            self.connection.execute(
+                """DELETE from manifests WHERE file_uuid = ?""", (file_uuid,)
+            )
+            self.connection.execute(
+                """DELETE from chunk_locations WHERE file_uuid = ?""",
+                (file_uuid,),
+            )
+            return self._release_chunks(
+                [chunk_hash for chunk_hash, _ in json.loads(result[0])],
+                chunk_prefix,
+                due,
+            )
+
+    def get_chunk_locations(self, chunk_hash):
+        """Returns (file_uuid, offset) of the files that contain the chunk"""
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                """SELECT file_uuid, offset FROM chunk_locations WHERE hash = ?""",
+                (chunk_hash,),
+            )
+            return cursor.fetchall()
+
+    def acquire_chunk(self, chunk_hash):
+        """Counts one more reference to the chunk.
+        Returns False if the chunk is not on the remote.
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                """UPDATE chunks SET refs = refs + 1 WHERE hash = ?""",
+                (chunk_hash,),
+            )
+        return cursor.rowcount > 0
+
+    def add_chunk(self, chunk_hash, file_id, length, codec=None):
+        """Records an uploaded chunk with one reference. Returns False,
+        and counts a reference to the known chunk instead, if another
+        upload has recorded the same chunk in the meantime.
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                """INSERT OR IGNORE INTO chunks (hash, file_id, length, refs, codec) VALUES (?, ?, ?, 1, ?)""",
+                (chunk_hash, file_id, length, codec),
+            )
+            if cursor.rowcount > 0:
+                return True
+            self.connection.execute(
+                """UPDATE chunks SET refs = refs + 1 WHERE hash = ?""",
+                (chunk_hash,),
+            )
+        return False
+
+    def get_chunk(self, chunk_hash):
+        """Returns (file_id, codec) or None"""
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                """SELECT file_id, codec FROM chunks WHERE hash = ?""",
+                (chunk_hash,),
+            )
+            return cursor.fetchone()
+
+    def release_chunks(self, chunk_hashes, chunk_prefix, due):
+        """Counts one reference less for each of `chunk_hashes`.
+        The chunks that are no longer referenced are forgotten, and their
+        objects, which are named `chunk_prefix` and the hash, are queued
+        by file id to be deleted from `due` on. Returns (name, file_id)
+        of these.
+        """
+        with self.lock, self.connection:
+            return self._release_chunks(chunk_hashes, chunk_prefix, due)
+
+    def _release_chunks(self, chunk_hashes, chunk_prefix, due):
+        for chunk_hash in chunk_hashes:
+            self.connection.execute(
+                """UPDATE chunks SET refs = refs - 1 WHERE hash = ?""",
+                (chunk_hash,),
+            )
+        unused = []
+        for chunk_hash in set(chunk_hashes):
+            cursor = self.connection.execute(
+                """SELECT file_id FROM chunks WHERE hash = ? AND refs <= 0""",
+                (chunk_hash,),
+            )
+            result = cursor.fetchone()
+            if result:
+                unused.append((chunk_hash, result[0]))
+        self.connection.executemany(
+            """DELETE from chunks WHERE hash = ?""",
+            [(chunk_hash,) for chunk_hash, _ in unused],
+        )
+        objects = [
+            (chunk_prefix + chunk_hash, file_id)
+            for chunk_hash, file_id in unused
+        ]
+        # A chunk can be uploaded again and released again before the
+        # deleter gets to it, so each version is queued on its own.
+        self.connection.executemany(
+            """INSERT OR IGNORE INTO pending_deletes (file_uuid, attempts, due, name) VALUES (?, 0, ?, ?)""",
+            [(file_id, due, name) for name, file_id in objects],
+        )
+        return objects
+
+    def add_pack(self, name, file_id, size, entries):
+        """`entries` are (file_uuid, offset, length, codec, content_length)
+        of the files in the pack. `length` is the length in the pack.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                """INSERT INTO packs (name, file_id, size) VALUES (?, ?, ?)""",
+                (name, file_id, size),
+            )
+            self.connection.executemany(
+                """INSERT OR REPLACE INTO packed_files (file_uuid, pack, offset, length, codec, content_length) VALUES (?, ?, ?, ?, ?, ?)""",
+                [
+                    (file_uuid, name, offset, length, codec, content_length)
+                    for file_uuid, offset, length, codec, content_length in entries
+                ],
+            )
+
+    def get_packed_file(self, file_uuid):
+        """Returns (file_id, offset, length, codec, content_length),
+        where `file_id` is that of the pack, or None.
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                """SELECT packs.file_id, offset, length, codec, content_length FROM packed_files JOIN packs ON packs.name = packed_files.pack WHERE file_uuid = ?""",
+                (file_uuid,),
+            )
+            return cursor.fetchone()
+
+    def remove_packed_file(self, file_uuid):
+        """Returns None if the file is not packed. Otherwise returns
+        (name, file_id, number of files left) of its pack.
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                """SELECT pack FROM packed_files WHERE file_uuid = ?""",
+                (file_uuid,),
+            )
+            result = cursor.fetchone()
+            if result is None:
+                return None
             self.connection.execute(
-                """DELETE from b2_file_info WHERE file_uuid = ?""", (file_uuid,)
+                """DELETE from packed_files WHERE file_uuid = ?""",
+                (file_uuid,),
+            )
+            cursor = self.connection.execute(
+                """SELECT name, file_id, (SELECT COUNT(*) FROM packed_files WHERE pack = name) FROM packs WHERE name = ?""",
+                result,
+            )
+            return cursor.fetchone()
+
+    def get_packed_uuids(self):
+        """Returns the packed files that are not waiting to be deleted"""
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                """SELECT file_uuid FROM packed_files WHERE file_uuid NOT IN (SELECT file_uuid FROM pending_deletes)"""
+            )
+            return [file_uuid for (file_uuid,) in cursor.fetchall()]
+
+    def remove_pack(self, name):
+        with self.lock, self.connection:
+            self.connection.execute(
+                """DELETE from packs WHERE name = ?""", (name,)
+            )
+
+    def get_empty_packs(self):
+        """Returns (name, file_id) of the packs without files"""
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                """SELECT name, file_id FROM packs WHERE NOT EXISTS (SELECT 1 FROM packed_files WHERE pack = name)"""
+            )
+            return cursor.fetchall()
+
+    def get_sparse_packs(self, min_live_fraction):
+        """Returns (name, file_id) of the packs in which the files
+        that are left take up less than `min_live_fraction` of the pack.
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                """SELECT name, file_id FROM packs JOIN packed_files ON pack = name GROUP BY name HAVING SUM(length) < ? * size""",
+                (min_live_fraction,),
+            )
+            return cursor.fetchall()
+
+    def get_pack_entries(self, name):
+        """Returns (file_uuid, offset, length, codec, content_length)
+        of the files in the pack
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                """SELECT file_uuid, offset, length, codec, content_length FROM packed_files WHERE pack = ? ORDER BY offset""",
+                (name,),
+            )
+            return cursor.fetchall()
+
+    def move_packed_files(self, name, file_id, size, moves):
+        """Records a new pack and moves files from other packs into it.
+        `moves` are (file_uuid, old pack, offset in the new pack).
+        Files that have left their old pack in the meantime are not moved.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                """INSERT INTO packs (name, file_id, size) VALUES (?, ?, ?)""",
+                (name, file_id, size),
+            )
+            self.connection.executemany(
+                """UPDATE packed_files SET pack = ?, offset = ? WHERE file_uuid = ? AND pack = ?""",
+                [
+                    (name, offset, file_uuid, old_name)
+                    for file_uuid, old_name, offset in moves
+                ],
+            )
+
+    def add_pending_deletes(self, file_uuids, due):
+        """A file that is pending already keeps its place"""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                """INSERT OR IGNORE INTO pending_deletes (file_uuid, attempts, due) VALUES (?, 0, ?)""",
+                [(file_uuid, due) for file_uuid in file_uuids],
+            )
+
+    def get_pending_object_names(self, file_uuids):
+        """Returns the names of those of `file_uuids` that are the
+        file ids of released objects, by file id.
+        """
+        names = {}
+        with self.lock, self.connection:
+            for start in range(0, len(file_uuids), MAX_VARIABLES):
+                chunk = file_uuids[start : start + MAX_VARIABLES]
+                cursor = self.connection.execute(
+                    f"""SELECT file_uuid, name FROM pending_deletes WHERE name IS NOT NULL AND file_uuid IN ({", ".join("?" * len(chunk))})""",
+                    chunk,
+                )
+                names.update(cursor.fetchall())
+        return names
+
+    def get_due_deletes(self, now, limit):
+        """Returns (file_uuid, attempts) of the deletes that are due"""
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                """SELECT file_uuid, attempts FROM pending_deletes WHERE due <= ? ORDER BY due LIMIT ?""",
+                (now, limit),
+            )
+            return cursor.fetchall()
+
+    def remove_pending_deletes(self, file_uuids):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                """DELETE from pending_deletes WHERE file_uuid = ?""",
+                [(file_uuid,) for file_uuid in file_uuids],
+            )
+
+    def postpone_pending_deletes(self, postponements):
+        """`postponements` are (file_uuid, due). Counts one more attempt"""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                """UPDATE pending_deletes SET attempts = attempts + 1, due = ? WHERE file_uuid = ?""",
+                [(due, file_uuid) for file_uuid, due in postponements],
             )
@@ -1,9 +1,12 @@
 import os
 import errno
 import logging
+import threading
+from contextlib import contextmanager
 from multiprocessing import current_process
 from fuse import FuseOSError
 from .locking import PathLock
+from .leases import LeaseTable
 from .events import (
     FileAccessEvent,
     FileDeleteEvent,
@@ -11,20 +14,55 @@ from .events import (
     FileEvictedFromCacheEvent,
     FileLoadedIntoCacheEvent,
 )
-from .metadata_store import MetaData, _metadata_cache_path_from_cache_path
+from .metadata_store import MetaData, WriteBuffer
 from .path_converter import PathConverter
 from .remote_identifiers import RemoteIdentifiers
-from .dirty_flags import DirtyFlags
 from .globals import ANTI_COLLISION_HASH
+from .state_store import get_state_store, STATES
 from .states import StateMachine
+from .hydration import Hydration, HydrationFailedException
+from .attribute_cache import AttributeCache, ATTRIBUTE_TIMEOUT
 
 log = logging.getLogger(current_process().name)
 
+GETATTR_ATTEMPTS = 3
+
 
 class PathDoesNotExistException(Exception):
     pass
 
 
+class DownloadAbortException(Exception):
+    pass
+
+
+class _AbortableStream:
+    """Passes the downloaded bytes on to `stream`, but stops the
+    download once `abort_requested` returns True.
+    """
+
+    # Looking for an abort request can mean a stat call,
+    # so it is not done on every write.
+    CHECK_INTERVAL = 1024 * 1024  # Bytes
+
+    def __init__(self, stream, abort_requested):
+        self.stream = stream
+        self.abort_requested = abort_requested
+        self.unchecked = 0
+
+    def write(self, data):
+        self.unchecked += len(data)
+        if self.unchecked >= self.CHECK_INTERVAL:
+            self.unchecked = 0
+            if self.abort_requested():
+                raise DownloadAbortException
+        self.stream.write(data)
+
+
+def is_read_only(flags):
+    return flags & os.O_ACCMODE == os.O_RDONLY
+
+
 def is_file_descriptor(cache_path):
     try:
         os.stat(cache_path)
@@ -36,15 +74,34 @@ def is_file_descriptor(cache_path):
 
 class Cache:
 
-    def __init__(self, cache_folder, api, events_channel):
+    def __init__(
+        self,
+        cache_folder,
+        api,
+        events_channel,
+        progressive_hydration=False,
+        attribute_timeout=ATTRIBUTE_TIMEOUT,
+    ):
         self.cache_folder = cache_folder
         self.converter = PathConverter(cache_folder)
         self.api = api
+        self.state_store = get_state_store(cache_folder)
         self.metadata_store = MetaData(cache_folder)
+        self.write_buffer = WriteBuffer(self.state_store)
         self.states = StateMachine(cache_folder=cache_folder)
         self.remote_identifiers = RemoteIdentifiers(cache_folder)
         self.events_channel = events_channel
         # instead of passing an instance here, sending a signal to the worker process might be more robust
+        # If set, remote files that are opened for reading are downloaded
+        # in the background and reads are served while the download is in flight.
+        self.progressive_hydration = progressive_hydration
+        self.hydrations = {}
+        # file handle -> the hydration it was opened on. A handle keeps its
+        # hydration after it is over, so that reads fail once it has failed.
+        self.handle_hydrations = {}
+        self.hydrations_lock = threading.Lock()
+        self.leases = LeaseTable()
+        self.attributes = AttributeCache(ttl=attribute_timeout)
 
     def _get_path_or_dummy(self, fuse_path):
         """Get cache path for given fuse_path.
@@ -81,86 +138,182 @@ class Cache:
 
     def open(self, path, flags):
         print(f"CACHE: open {path}")
-        with PathLock(
-            path,
-            high_priority=True,
-            acquisition_max_retries=100,
-            lock_creator="CACHE OPEN",
+        # The lease is held until the handle is released, so that
+        # reads and writes on the handle do not need to lock the path.
+        lease = self.leases.acquire(path)
+        try:
+            with lease.mutex:
+                file_path, hydration = self._get_path_for_handle(path, flags)
+                print(file_path)
+                if self.metadata_store.record_access(path=path):
+                    self.attributes.invalidate(path)
+                FileAccessEvent(self.events_channel).submit(path=path)
+                file_handle = os.open(file_path, flags)
+        except Exception:
+            self.leases.release(lease)
+            raise
+        if hydration is not None:
+            with self.hydrations_lock:
+                self.handle_hydrations[file_handle] = hydration
+        self.leases.register_handle(file_handle, lease)
+        return file_handle
+
+    def _get_path_for_handle(self, path, flags):
+        """Returns the path to open and the hydration
+        that the handle reads from, if any.
+        """
+        hydration = self._get_hydration(path)
+        if hydration is not None:
+            if is_read_only(flags):
+                return hydration.file_path, hydration
+            # Writers have to wait for the whole file
+            try:
+                hydration.wait_until_complete()
+            except HydrationFailedException:
+                raise FuseOSError(errno.ENETUNREACH)
+        if (
+            self.progressive_hydration
+            and is_read_only(flags)
+            and self.states.current_state_is_remote(path)
         ):
-            cache_path = self._get_path(path)
-            print(cache_path)
-            self.metadata_store.record_access(path=path)
-            FileAccessEvent(self.events_channel).submit(path=path)
-            return os.open(cache_path, flags)
+            hydration = self._start_hydration(path)
+            return hydration.file_path, hydration
+        return self._get_path(path), None
+
+    def release(self, path, fh):
+        os.close(fh)
+        with self.hydrations_lock:
+            self.handle_hydrations.pop(fh, None)
+        self.write_buffer.flush(path)
+        self.leases.release_handle(fh)
+        # The cleaner can start uploading as soon as it hears about the
+        # last write, which it cannot do while the file is open anyway.
+        self.events_channel.flush(path)
+
+    def flush_metadata(self, path):
+        self.write_buffer.flush(path)
+
+    def _get_hydration(self, path):
+        with self.hydrations_lock:
+            return self.hydrations.get(path)
+
+    def _start_hydration(self, path):
+        """Starts downloading a remote file in the background.
+        The hydration holds on to the lease on the path until it is over.
+        The file stays in the remote state until the download is
+        complete, so an interrupted hydration leaves nothing behind
+        that could be mistaken for the full file.
+        """
+        cache_path = self.converter.to_cache_path(path)
+        lease = self.leases.acquire(path)
+
+        def on_complete(hydration):
+            try:
+                self.states.remote_to_clean(path)
+                FileLoadedIntoCacheEvent(self.events_channel).submit(path=path)
+            finally:
+                self._end_hydration(path, lease)
+
+        def on_failure(hydration):
+            self._end_hydration(path, lease)
+
+        try:
+            hydration = Hydration(
+                api=self.api,
+                uuid=self.remote_identifiers.get_uuid_or_none(path),
+                file_path=self.converter.add_dummy_ending(cache_path),
+                on_complete=on_complete,
+                on_failure=on_failure,
+            )
+        except Exception:
+            self.leases.release(lease)
+            raise
+        with self.hydrations_lock:
+            self.hydrations[path] = hydration
+        return hydration.start()
+
+    def _end_hydration(self, path, lease):
+        with self.hydrations_lock:
+            del self.hydrations[path]
+        self.leases.release(lease)
+
+    @contextmanager
+    def _exclusive_lease(self, path):
+        """For operations on a path that do not come with a file handle."""
+        lease = self.leases.acquire(path, exclusive=True)
+        try:
+            with lease.mutex:
+                yield lease
+        finally:
+            self.leases.release(lease)
 
     def read(self, path, size, offset, fh):
         print(f"CACHE: read {path}")
-        with PathLock(
-            path,
-            exclusive_lock_on_leaf=False,
-            high_priority=True,
-            acquisition_max_retries=100,
-            lock_creator="CACHE READ",
-        ):
-            TODO: ALTERNATIVE 1:
-            # Do not use fh here, use path, because the file handle comes from "open" (?),
-            # but it might be that between open and read, the file gets moved to remote and back
-            # in this case, the file handle might change in the meantime (?)
-            # Basically, "open" should do nothing apart from maybe logging the access,
-            # and we are actually opening the file in here and also ensuring here that it is local.
-            # In this case, we would probably want to ignore operations such as flush, fsync, etc.
-            # This is probably the simpler approach, but we are probably giving up some options for
-            # performance optimization and I am probably violating some POSIX behavior, such as
-            # file-open -based locks (?), etc..
-            # However, I could always implement another layer of abstraction in front of this "cache",
-            # that acts like an actual cache and actually makes use of flush, and fsync etc.
-            # This here might be relevant: https://stackoverflow.com/a/2340641
-            # ALTERNATIVE2:
-            #  we could actually open  file  in python during the "open",   but then we have to
-            # manage the lock lifecycle such that it stays locked during all reads until the file is closed.
-            # And if a write happens, the lock needs to be upgraded to a write lock, so we need to support
-            # re-entry. We would also need to manage the lock without the context manager.
-            os.lseek(fh, offset, 0)
-            return os.read(fh, size)
+        # The handle's lease keeps the workers away from the file
+        with self.hydrations_lock:
+            hydration = self.handle_hydrations.get(fh)
+        if hydration is not None:
+            try:
+                hydration.wait_for(offset, size)
+            except HydrationFailedException:
+                raise FuseOSError(errno.ENETUNREACH)
+        # pread does not move a shared file offset, so concurrent reads on the
+        # same handle from several fuse threads cannot interfere.
+        return os.pread(fh, size, offset)
 
     def truncate(self, path, length):
         print("truncate")
-        with PathLock(path, high_priority=True, acquisition_max_retries=100):
-            self.metadata_store.record_content_modification(path=path)
-            cache_path = self.converter.to_cache_path(path)
+        with self._exclusive_lease(path):
+            cache_path = self._get_path(path)
+            os.truncate(cache_path, length)
+            self.write_buffer.flush(path)
+            self.state_store.record_truncate(path, length)
+            self.attributes.invalidate(path)
             FileUpdateOrCreateEvent(self.events_channel).submit(path=path)
             FileAccessEvent(self.events_channel).submit(path=path)
-            with open(cache_path, "r+") as f:
-                return f.truncate(length)
 
     def write(self, path, data, offset, fh):
         print("write")
-        with PathLock(
-            path,
-            high_priority=True,
-            acquisition_max_retries=100,
-            lock_creator="CACHE WRITE",
-        ):
-            self.metadata_store.record_content_modification(path=path)
+        lease = self.leases.get_by_handle(fh)
+        with lease.mutex:
+            lease.make_exclusive()
+            result = os.pwrite(fh, data, offset)
+            # Times and size are kept in memory until the handle is released
+            self.write_buffer.record_write(path, offset + result)
+            self.attributes.invalidate(path)
             FileAccessEvent(self.events_channel).submit(path=path)
-            os.lseek(fh, offset, 0)
-            result = os.write(fh, data)
-            self.states.dirty_or_clean_to_dirty(path)
             FileUpdateOrCreateEvent(self.events_channel).submit(path=path)
             return result
 
     def create(self, path, mode):
         print("CREATING")
         cache_path = self.converter.to_cache_path(path)
-        self.metadata_store.create(cache_path)
-        result = os.open(
-            cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode
-        )
-        self.metadata_store.record_content_modification(path=path)
-        self.states.clean_to_dirty(path)
-        FileUpdateOrCreateEvent(self.events_channel).submit(path=path)
-        FileAccessEvent(self.events_channel).submit(path=path)
-        return result
+        lease = self.leases.acquire(path, exclusive=True)
+        try:
+            with lease.mutex:
+                hydration = self._get_hydration(path)
+                if hydration is not None:
+                    # Otherwise it moves the old file over the new one
+                    try:
+                        hydration.wait_until_complete()
+                    except HydrationFailedException:
+                        pass
+                if self.states.current_state_is_remote(path):
+                    # The old file only exists as its dummy. It is replaced
+                    # like a file that a rename overwrites.
+                    self._delete_file(path)
+                file_handle = os.open(
+                    cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode
+                )
+                self.state_store.add(path, os.fstat(file_handle), STATES.DIRTY)
+                self.attributes.invalidate(path)
+                FileUpdateOrCreateEvent(self.events_channel).submit(path=path)
+                FileAccessEvent(self.events_channel).submit(path=path)
+        except Exception:
+            self.leases.release(lease)
+            raise
+        self.leases.register_handle(file_handle, lease)
+        return file_handle
 
     def rename(self, old_path, new_path):
         print("rename")
@@ -170,75 +323,59 @@ class Cache:
         # TODO: Issue event to inform ranker about move?
         old_cache_path = self.converter.to_cache_path(old_path)
         new_cache_path = self.converter.to_cache_path(new_path)
-        with PathLock(
-            old_path,
-            acquisition_max_retries=100,
-            high_priority=True,
-            lock_creator="CACHE RENAME",
-        ):
-            existing_file_desciptor_at_new_location = is_file_descriptor(
-                new_cache_path
-            )
-            if existing_file_desciptor_at_new_location:
-                # If something exists at the target path, we will overwrite it
-                if os.path.islink(new_cache_path):
-                    os.unlink(new_cache_path)
-                elif os.path.isdir(new_cache_path):
-                    # file_desciptor is a folder:
-                    self.rmdir(new_cache_path)
-                    # TODO: If the target contains files, we have to delete them and issue
-                    # delete events!
-                elif os.path.isfile(new_cache_path):
-                    # file_desciptor is a file
-                    with PathLock(
-                        new_path,
-                        acquisition_max_retries=100,
-                        high_priority=True,
-                    ):
-                        self._delete_file(new_path)
+        is_folder = os.path.isdir(old_cache_path)
+        if is_folder:
+            # Open files in the folder hold intention locks on it, which
+            # would keep us from locking the folder, so they move first.
+            self.leases.move(old_path, new_path)
+        is_renamed = False
+        try:
+            with self._exclusive_lease(old_path):
+                # A remote file at the new location only exists as its dummy
+                existing_file_desciptor_at_new_location = is_file_descriptor(
+                    new_cache_path
+                ) or self.states.current_state_is_remote(new_path)
+                if existing_file_desciptor_at_new_location:
+                    # If something exists at the target path, we will overwrite it
+                    if os.path.islink(new_cache_path):
+                        os.unlink(new_cache_path)
+                    elif os.path.isdir(new_cache_path):
+                        # file_desciptor is a folder:
+                        self.rmdir(new_cache_path)
+                        # TODO: If the target contains files, we have to delete them and issue
+                        # delete events!
+                    elif os.path.isfile(self._get_path_or_dummy(new_path)):
+                        # file_desciptor is a file
+                        with self._exclusive_lease(new_path):
+                            self._delete_file(new_path)
+                    else:
+                        raise NotImplementedError
+
+                if is_folder:
+                    os.rename(old_cache_path, new_cache_path)
+                    is_renamed = True
+                    # TODO: Issue event for ranker.
                 else:
-                    raise NotImplementedError
-
-            if os.path.isdir(old_cache_path):
-                # Rename the cache files
-                os.rename(old_cache_path, new_cache_path)
-                # TODO: Issue event for ranker.
-            else:
-                # Rename the cache files
-                os.rename(old_cache_path, new_cache_path)
-                # TODO : This is hacky/ not in the right place
-                os.rename(
-                    _metadata_cache_path_from_cache_path(old_cache_path),
-                    _metadata_cache_path_from_cache_path(new_cache_path),
-                )
-                print("renamed metadata")
-                try:
-                    os.rename(
-                        DirtyFlags(
-                            self.cache_folder
-                        )._dirty_flag_path_from_fuse_path(old_path),
-                        DirtyFlags(
-                            self.cache_folder
-                        )._dirty_flag_path_from_fuse_path(new_path),
-                    )
-                    print("renamed dirty flag")
-                except FileNotFoundError:
-                    # Dirty flag file does not exist
-                    pass
-                try:
-                    os.rename(
-                        RemoteIdentifiers(
-                            self.cache_folder
-                        )._uuid_path_from_fuse_path(old_path),
-                        RemoteIdentifiers(
-                            self.cache_folder
-                        )._uuid_path_from_fuse_path(new_path),
-                    )
-                    print("renamed remote identifier file")
-                except FileNotFoundError:
-                    # UUID flag file does not exist
-                    pass
-                # TODO: self.metadata_store. -> record file move
+                    # A remote file only exists as its dummy
+                    old_file_path = self._get_path_or_dummy(old_path)
+                    if old_file_path == old_cache_path:
+                        os.rename(old_cache_path, new_cache_path)
+                    else:
+                        os.rename(
+                            old_file_path,
+                            self.converter.add_dummy_ending(new_cache_path),
+                        )
+                    is_renamed = True
+                    # Open handles now keep the workers away from the new path
+                    self.leases.move(old_path, new_path)
+                # The state of the file, or of all files in the folder
+                self.write_buffer.flush_all()
+                self.state_store.move(old_path, new_path)
+                self.attributes.invalidate_tree(old_path)
+                self.attributes.invalidate_tree(new_path)
+        finally:
+            if is_folder and not is_renamed:
+                self.leases.move(new_path, old_path)
 
     def mkdir(self, path, mode):
         print("mkdir", path)
@@ -247,19 +384,16 @@ class Cache:
         # free manner.  We need this in multiple parts of the code
         # also here.
         cache_path = self.converter.to_cache_path(path)
-        return os.mkdir(cache_path, mode)
+        os.mkdir(cache_path, mode)
+        self.attributes.invalidate(path)
 
     def rmdir(self, fuse_path, *args, **kwargs):
         cache_path = self.converter.to_cache_path(fuse_path)
         print("rmdir", args, kwargs)
-        with PathLock(
-            fuse_path,
-            high_priority=True,
-            acquisition_max_retries=100,
-            lock_creator="CACHE RMDIR",
-        ):
+        with self._exclusive_lease(fuse_path):
             # TODO: I assume this fails, and fuse expects it to fail, if the folder is not empty?
-            return os.rmdir(cache_path, *args, **kwargs)
+            os.rmdir(cache_path, *args, **kwargs)
+            self.attributes.invalidate(fuse_path)
 
     def unlink(self, fuse_path):
         print(f"unlink {fuse_path}")
@@ -269,30 +403,20 @@ class Cache:
             os.unlink(cache_path)
         else:
 
-            with PathLock(
-                fuse_path,
-                acquisition_max_retries=10,
-                high_priority=True,
-                lock_creator="CACHE UNLINK",
-            ):
+            with self._exclusive_lease(fuse_path):
                 self._delete_file(fuse_path)
+        self.attributes.invalidate(fuse_path)
+
+    def symlink(self, path, target):
+        os.symlink(target, self.converter.to_cache_path(path))
+        self.attributes.invalidate(path)
 
     def _delete_file(self, fuse_path):
         try:
             os.unlink(self._get_path_or_dummy(fuse_path))
-
-            # Delete all flags. This is hacky and should be cleaned up
-            self.metadata_store.delete(fuse_path)
-            try:
-                DirtyFlags(self.cache_folder).remove_dirty_flag(fuse_path)
-            except Exception:
-                # There may be no dirty flag
-                pass
-            ##
-
             uuid = self.remote_identifiers.get_uuid_or_none(fuse_path)
-            if uuid:
-                self.remote_identifiers.delete(path=fuse_path)
+            self.write_buffer.discard(fuse_path)
+            self.state_store.delete(fuse_path)
             FileDeleteEvent(self.events_channel).submit(
                 uuid=uuid, path=fuse_path
             )
@@ -300,11 +424,57 @@ class Cache:
             log.error(e)
 
     def getattributes(self, fuse_path):
+        hit, attributes = self.attributes.get(fuse_path)
+        if hit:
+            if attributes is None:
+                raise FuseOSError(errno.ENOENT)
+            return dict(attributes)
+        generation = self.attributes.generation
+        # getattr does not take a lock. In multithreaded mode, the file may be
+        # swapped between dummy and real file while we look at it, so retry.
+        for _ in range(GETATTR_ATTEMPTS):
+            try:
+                attributes = self._getattributes(fuse_path)
+            except FileNotFoundError:
+                continue
+            except FuseOSError as e:
+                if e.errno == errno.ENOENT:
+                    self.attributes.put_missing(fuse_path, generation)
+                raise
+            self.attributes.put(fuse_path, attributes, generation)
+            return dict(attributes)
+        raise FuseOSError(errno.ENOENT)
+
+    def _getattributes(self, fuse_path):
+        # Files are answered from the state store with a single lookup
+        entry = self.state_store.get(fuse_path)
+        if entry is not None:
+            pending_write = self.write_buffer.get(fuse_path)
+            if pending_write is not None:
+                timestamp, end = pending_write
+                entry.update(
+                    atime=timestamp,
+                    mtime=timestamp,
+                    ctime=timestamp,
+                    size=max(entry["size"], end),
+                )
+            return {
+                "st_atime": entry["atime"],
+                "st_ctime": entry["ctime"],
+                "st_gid": entry["gid"],
+                "st_mode": entry["mode"],
+                "st_mtime": entry["mtime"],
+                "st_nlink": 1,
+                "st_size": entry["size"],
+                "st_uid": entry["uid"],
+            }
+        # Directories, symlinks and files that were put into the
+        # cache folder without going through fuse
         cache_path = self._get_path_or_dummy(fuse_path)
         if cache_path is None:
             raise FuseOSError(errno.ENOENT)
         stat = os.lstat(cache_path)
-        stat_dict = dict(
+        return dict(
             (key, getattr(stat, key))
             for key in (
                 "st_atime",
@@ -317,30 +487,32 @@ class Cache:
                 "st_uid",
             )
         )
-        if not os.path.isdir(cache_path):
-            # If not a directory
-            stat_dict["st_atime"] = self.metadata_store.get_access_time(
-                path=fuse_path
-            )
-            stat_dict["st_mtime"] = self.metadata_store.get_modification_time(
-                path=fuse_path
-            )
-            stat_dict["st_ctime"] = self.metadata_store.get_change_time(
-                path=fuse_path
-            )
-            print(stat_dict)
-        return stat_dict
+
+    def chmod(self, path, mode):
+        cache_path = self._get_path_or_dummy(path)
+        os.chmod(cache_path, mode)
+        self.state_store.set_mode_and_owner(path, os.lstat(cache_path))
+        self.attributes.invalidate(path)
+
+    def chown(self, path, uid, gid):
+        cache_path = self._get_path_or_dummy(path)
+        os.chown(cache_path, uid, gid)
+        self.state_store.set_mode_and_owner(path, os.lstat(cache_path))
+        self.attributes.invalidate(path)
 
     @staticmethod
     def is_link(cache_path):
         return os.path.islink(cache_path)
 
     def replace_dummy(self, path):
-        with PathLock(path, lock_creator="replace_dummy"):
-            self._replace_dummy(path)
+        """Hydrates a file for the balancer. The download is aborted,
+        leaving the file remote, if the fuse process needs the path.
+        """
+        with PathLock(path, lock_creator="replace_dummy") as lock:
+            self._replace_dummy(path, abort_requested=lock.abort_requested)
             FileLoadedIntoCacheEvent(self.events_channel).submit(path=path)
 
-    def _replace_dummy(self, path):
+    def _replace_dummy(self, path, abort_requested=None):
         print(f"Replacing dummy [path]")
         if not self.states.current_state_is_remote(path):
             log.warn(
@@ -348,17 +520,51 @@ class Cache:
                 "because file is not remote."
             )
             return
-        self.states.remote_to_clean(path)
         cache_path = self.converter.to_cache_path(path)
         uuid = self.remote_identifiers.get_uuid_or_none(path)
-        with open(cache_path, "w+b") as file:
+        # Stream the download into the dummy, which sits next to the cache path
+        # and carries the permissions of the file. Only once the content is
+        # complete, the dummy is renamed into place. This way, memory use does
+        # not depend on the file size and an interrupted download never
+        # leaves a partial file in the clean state.
+        dummy_cache_path = self.converter.add_dummy_ending(cache_path)
+        with open(dummy_cache_path, "wb") as file:
+            stream = file
+            if abort_requested is not None:
+                stream = _AbortableStream(file, abort_requested)
             try:
-                file.write(self.api.download(uuid).read())
-            except ConnectionError:
-                raise FuseOSError(errno.ENETUNREACH)
+                self.api.download_to(
+                    uuid, stream, read_local_copy=self._read_local_copy
+                )
+                file.flush()
+                os.fsync(file.fileno())
+            except BaseException as e:
+                # Whatever went wrong, the content of a dummy
+                # is meaningless, leave it empty.
+                file.truncate(0)
+                if isinstance(e, ConnectionError):
+                    raise FuseOSError(errno.ENETUNREACH)
+                raise
+        self.states.remote_to_clean(path)
+
+    def _read_local_copy(self, uuid, offset, length):
+        """Reads from the cached copy of a file that was uploaded
+        as `uuid`, so that chunks that it shares with a file that is
+        being downloaded do not have to be downloaded.
+        """
+        path = self.state_store.get_clean_path(uuid)
+        if path is None:
+            return None
+        try:
+            with open(self.converter.to_cache_path(path), "rb") as file:
+                return os.pread(file.fileno(), length, offset)
+        except FileNotFoundError:
+            return None
 
     def create_dummy(self, path):
-        with PathLock(path, lock_creator="create_dummy"):
+        with PathLock(
+            path, lock_creator="create_dummy", exclude_open_handles=True
+        ):
             # This can happen if the file was written to in the meantime
             if not os.path.isfile(self.converter.to_cache_path(path)):
                 raise PathDoesNotExistException(
@@ -1,20 +1,36 @@
 import logging
-import subprocess
 from zero.remote_identifiers import RemoteIdentifiers
 from zero.dirty_flags import DirtyFlags
-from zero.cache import PathDoesNotExistException
+from zero.cache import PathDoesNotExistException, DownloadAbortException
 from zero.states import WrongInitialStateException
 from zero.locking import NodeLockedException
 from .ranker import Ranker
 from .rank_store import RankStore
+from .planner import Planner, ACTIONS, select_evictees, select_primees
+from .priming_pool import PrimingPool, PRIMING_WORKERS
+from zero.state_store import STATES
 import time
+import queue
 
 logger = logging.getLogger("spam_application")
 
+# How many files of lowest or highest rank are looked at for one batch
+CANDIDATES_PER_BATCH = 10000
+# How many remote files of highest rank are looked at to find the
+# size of the next file to swap in
+PRIMEE_CANDIDATES = 10
+
 
 class Balancer:
 
-    def __init__(self, cache, api, target_disk_usage, db_file):
+    def __init__(
+        self,
+        cache,
+        api,
+        target_disk_usage,
+        db_file,
+        priming_workers=PRIMING_WORKERS,
+    ):
         self.api = api
         self.target_disk_usage = target_disk_usage
         # Todo: Write methods in the cache class which wrap the
@@ -27,31 +43,20 @@ class Balancer:
         self.dirty_flags = DirtyFlags(cache_folder)
         self.ranker = Ranker(db_file, cache_folder=cache_folder)
         self.read_only_rank_store = RankStore(db_path=db_file)
-
-    def get_size_of_biggest_file(self):
-        """In GB"""
-        # TODO: Implement this in a reasonably efficient way by caching file sizes
-        path = self.converter.to_cache_path("/")
-        command = (
-            f"find {path} -type f -exec du -a {{}} + | sort -n -r | head -n 1"
+        self.planner = Planner(target=target_disk_usage * 1e9)
+        self.priming_pool = PrimingPool(
+            self._prime_path, workers=priming_workers
         )
-        response = subprocess.check_output(command, shell=True)
-        try:
-            du_output = response.split()[0].decode("utf-8")
-        except IndexError:
-            # There is no file.
-            return 0
-        return float(du_output) / (1000 * 1000)
+        # The rank store must only be used from the thread that opened
+        # it, so the primers leave the paths to re-index here.
+        self.paths_to_re_index = queue.Queue()
 
     def get_disk_usage(self):
-        """Returns cache disk use in GB"""
-        path = self.converter.to_cache_path("/")
-        du_output = (
-            subprocess.check_output(["du", "-s", path])
-            .split()[0]
-            .decode("utf-8")
-        )
-        return float(du_output) / (1000 * 1000)
+        """Returns cache disk use in GB.
+        This is the size of the files that are in the cache,
+        which the state store keeps a running total of.
+        """
+        return self.cache.state_store.get_resident_size() / 1e9
 
     def get_eviction_candidates(self, limit):
         # To decide which files to evict, look at files with low rank who are CLEAN
@@ -61,10 +66,25 @@ class Balancer:
         # To decide which files to prime with, look at files with high rank who are REMOTE
         return self.read_only_rank_store.get_remote_and_high_rank_paths(limit)
 
-    def evict(self, number_of_files):
-        """Remove unneeded files from cache"""
-        evictees = self.get_eviction_candidates(number_of_files)
-        print(evictees)
+    def get_primee_size(self):
+        """Returns the size of the remote file of highest rank,
+        or None if there is none.
+        """
+        candidates = self.get_priming_candidates(PRIMEE_CANDIDATES)
+        sizes = self.cache.state_store.get_sizes(candidates, STATES.REMOTE)
+        for path in candidates:
+            if path in sizes:
+                return sizes[path]
+        return None
+
+    def evict(self, amount):
+        """Remove unneeded files from cache,
+        about `amount` bytes of them.
+        """
+        candidates = self.get_eviction_candidates(CANDIDATES_PER_BATCH)
+        sizes = self.cache.state_store.get_sizes(candidates, STATES.CLEAN)
+        evictees = select_evictees(candidates, sizes, amount)
+        print(f"Evicting {len(evictees)} files")
         for path in evictees:
             try:
                 self.cache.create_dummy(path)
@@ -75,47 +95,60 @@ class Balancer:
                     f"Cannot evict {path} because node is locked. This is probably okay."
                 )
 
-    def prime(self, number_of_files):
+    def prime(self, amount):
         """Fill the cache with files from remote
-        that are predicted to be needed.
+        that are predicted to be needed, up to `amount` bytes.
         """
-        primees = self.get_priming_candidates(number_of_files)
-        for path in primees:
-            try:
-                self.cache.replace_dummy(path)
-            except (PathDoesNotExistException, WrongInitialStateException):
-                self.ranker.re_index(path)
-            except NodeLockedException:
-                print(
-                    f"Cannot evict {path} because node is locked. This is probably okay."
-                )
+        candidates = self.get_priming_candidates(CANDIDATES_PER_BATCH)
+        sizes = self.cache.state_store.get_sizes(candidates, STATES.REMOTE)
+        primees = select_primees(candidates, sizes, amount)
+        print(f"Priming {len(primees)} files")
+        self.api.load_file_info(
+            list(self.cache.state_store.get_uuids(primees).values())
+        )
+        self.priming_pool.submit(primees)
+
+    def _prime_path(self, path):
+        try:
+            self.cache.replace_dummy(path)
+        except (PathDoesNotExistException, WrongInitialStateException):
+            self.paths_to_re_index.put(path)
+        except NodeLockedException:
+            print(
+                f"Cannot prime {path} because node is locked. This is probably okay."
+            )
+        except DownloadAbortException:
+            print(f"Priming of {path} was aborted because fuse needs it.")
 
     def order_cache(self):
-        # TODO: Make sure that biggest file < 0.1 * target_disk_usage, else this won't work.
-        if (
-            abs(self.get_disk_usage() - self.target_disk_usage)
-            < 1.2 * self.get_size_of_biggest_file()
-            and self.ranker.is_sufficiently_sorted()
-        ):
+        while not self.paths_to_re_index.empty():
+            self.ranker.re_index(self.paths_to_re_index.get())
+        if not self.priming_pool.is_idle():
+            # The files that are being primed are not part of the
+            # disk usage yet, so there is nothing to plan until they are.
+            return
+        # The planner works in bytes, the target is in GB
+        state_store = self.cache.state_store
+        is_sorted = self.ranker.is_sufficiently_sorted()
+        plan = self.planner.plan(
+            usage=state_store.get_resident_size(),
+            biggest_file_size=state_store.get_biggest_resident_size(),
+            is_sorted=is_sorted,
+            primee_size=None if is_sorted else self.get_primee_size(),
+        )
+        if plan is None:
             print(
                 f"""Cache has the right size and is filled with the right files.
                 Current disk usage {self.get_disk_usage()}
                 Target disk usage {self.target_disk_usage}
-                Tolerance {1.2 * self.get_size_of_biggest_file()}
                 """
             )
             return
-        elif self.get_disk_usage() > self.target_disk_usage:
-            # If I want to evict and prime with a higher number
-            # of files then I need to make sure I don't overshoot,
-            # so I have to get slower as I approach the boundary
-            # or increase the tolerance to a higher multiple of the
-            # biggest file
-            print("Evicting")
-            self.evict(1)
+        print(plan)
+        if plan.action == ACTIONS.EVICT:
+            self.evict(plan.amount)
         else:
-            print("Priming")
-            self.prime(1)
+            self.prime(plan.amount)
 
     def run(self):
         while True:
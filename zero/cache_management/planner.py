@@ -0,0 +1,93 @@
+class ACTIONS:
+    EVICT = "EVICT"
+    PRIME = "PRIME"
+
+
+# The cache is left alone while its size is within this fraction
+# of the target. Once it leaves that band, it is brought back
+# to the target in one batch.
+WATERMARK_FRACTION = 0.1
+
+
+class Plan:
+
+    def __init__(self, action, amount):
+        self.action = action
+        # Bytes to evict or to prime
+        self.amount = amount
+
+    def __repr__(self):
+        return f"Plan({self.action}, {self.amount} bytes)"
+
+
+class Planner:
+    """Decides how many bytes to move in or out of the cache.
+
+    The high and low watermark are above and below the target by
+    a fraction of the target, but at least by a bit more than the
+    biggest file, so that moving a single file never takes the
+    cache across the band.
+    """
+
+    def __init__(self, target, watermark_fraction=WATERMARK_FRACTION):
+        self.target = target
+        self.watermark_fraction = watermark_fraction
+
+    def get_margin(self, biggest_file_size):
+        return max(
+            self.target * self.watermark_fraction, 1.2 * biggest_file_size
+        )
+
+    def plan(self, usage, biggest_file_size, is_sorted, primee_size=None):
+        """Returns a Plan, or None if the cache should be left as it is.
+        `primee_size` is the size of the remote file of highest rank,
+        or None if there is none. All sizes are in bytes.
+        """
+        margin = self.get_margin(biggest_file_size)
+        if usage > self.target + margin:
+            return Plan(ACTIONS.EVICT, usage - self.target)
+        if usage < self.target - margin:
+            return Plan(ACTIONS.PRIME, self.target - usage)
+        if is_sorted or primee_size is None or primee_size > margin:
+            # A swap would have to take the cache out of the band
+            return None
+        # Within the band, files of low rank are swapped for remote
+        # files of high rank by evicting until the remote file of
+        # highest rank fits below the target, and priming up to the
+        # target again. Every step moves at least one file.
+        room = self.target - usage
+        if room < primee_size:
+            return Plan(ACTIONS.EVICT, primee_size - room)
+        return Plan(ACTIONS.PRIME, room)
+
+
+def select_evictees(candidates, sizes, amount):
+    """Takes candidates, lowest rank first, until their sizes
+    add up to `amount` bytes. `sizes` maps the paths of
+    the candidates that can be evicted to their size.
+    """
+    selected = []
+    total = 0
+    for path in candidates:
+        if total >= amount:
+            break
+        if path not in sizes:
+            continue
+        selected.append(path)
+        total += sizes[path]
+    return selected
+
+
+def select_primees(candidates, sizes, amount):
+    """Takes candidates, highest rank first, as long as they
+    fit into `amount` bytes. Files that are too big are skipped
+    in favour of smaller ones of lower rank.
+    """
+    selected = []
+    total = 0
+    for path in candidates:
+        if path not in sizes or total + sizes[path] > amount:
+            continue
+        selected.append(path)
+        total += sizes[path]
+    return selected
@@ -0,0 +1,64 @@
+import logging
+import threading
+from collections import deque
+from multiprocessing import current_process
+
+log = logging.getLogger(current_process().name)
+
+PRIMING_WORKERS = 4
+
+
+class PrimingPool:
+    """Hydrates remote files with several downloads at once.
+
+    Paths are primed in the order in which they are submitted, which
+    is the order of their rank. A path that is already queued or being
+    primed is not queued again.
+    Hydrations that the fuse process needs right away take a high
+    priority lease on the path, which aborts the download of a worker.
+    """
+
+    def __init__(self, prime, workers=PRIMING_WORKERS):
+        """`prime` is called with one path at a time,
+        from several threads at once.
+        """
+        self.prime = prime
+        self.queue = deque()
+        # Queued or being primed
+        self.paths = set()
+        self.condition = threading.Condition()
+        for number in range(workers):
+            threading.Thread(
+                target=self._work, name=f"primer {number}", daemon=True
+            ).start()
+
+    def submit(self, paths):
+        with self.condition:
+            for path in paths:
+                if path in self.paths:
+                    continue
+                self.paths.add(path)
+                self.queue.append(path)
+            self.condition.notify_all()
+
+    def is_idle(self):
+        with self.condition:
+            return not self.paths
+
+    def wait_until_idle(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.paths, timeout)
+
+    def _work(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue)
+                path = self.queue.popleft()
+            try:
+                self.prime(path)
+            except Exception:
+                log.exception(f"Could not prime {path}")
+            finally:
+                with self.condition:
+                    self.paths.discard(path)
+                    self.condition.notify_all()
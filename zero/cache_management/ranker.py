@@ -84,7 +84,8 @@ class Ranker:
                 FileLoadedIntoCacheEvent.topic,
                 FileRenameOrMoveEvent.topic,
                 FolderRenameOrMoveEvent.topic,
-            )
+            ),
+            consumer="ranker",
         ) as multi_topic_listener:
             while True:
                 time.sleep(0.1)
@@ -0,0 +1,112 @@
+import os
+import hashlib
+
+# Chunk boundaries are chosen by the content of the file (FastCDC), so
+# that an insertion or deletion only changes the chunks around it.
+MIN_CHUNK_SIZE = 256 * 1024  # Bytes
+AVERAGE_CHUNK_SIZE = 1024 * 1024  # Bytes
+MAX_CHUNK_SIZE = 4 * 1024 * 1024  # Bytes
+# Finding the boundaries takes a pass over every byte in Python, which
+# manages only a few MB/s and holds the GIL. Bigger files are cut into
+# chunks of MAX_CHUNK_SIZE instead, which only costs the hashing.
+CONTENT_DEFINED_CHUNKING_LIMIT = 16 * 1024 * 1024  # Bytes
+
+_HASH_MASK = (1 << 64) - 1
+
+
+def _make_gear_table():
+    # The table must never change, or the same content
+    # would be cut into different chunks.
+    return [
+        int.from_bytes(hashlib.sha256(bytes([byte])).digest()[:8], "big")
+        for byte in range(256)
+    ]
+
+
+_GEAR = _make_gear_table()
+
+
+def _top_bits_mask(bits):
+    # The gear hash is shifted to the left with each byte,
+    # so its top bits depend on the most bytes.
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+_AVERAGE_BITS = AVERAGE_CHUNK_SIZE.bit_length() - 1
+# Normalized chunking: cutting before the average size is made harder
+# and after it easier, which keeps chunk sizes close to the average.
+_MASK_SMALL = _top_bits_mask(_AVERAGE_BITS + 2)
+_MASK_LARGE = _top_bits_mask(_AVERAGE_BITS - 2)
+
+
+def hash_chunk(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def find_chunk_end(data, start, end):
+    """Returns where the chunk that starts at `start` ends.
+    `data[start:end]` must hold at least MAX_CHUNK_SIZE bytes,
+    unless it is the end of the file.
+    """
+    if end - start <= MIN_CHUNK_SIZE:
+        return end
+    normal = min(start + AVERAGE_CHUNK_SIZE, end)
+    limit = min(start + MAX_CHUNK_SIZE, end)
+    gear = _GEAR
+    fingerprint = 0
+    position = start + MIN_CHUNK_SIZE
+    for mask, stop in ((_MASK_SMALL, normal), (_MASK_LARGE, limit)):
+        for byte in data[position:stop]:
+            fingerprint = ((fingerprint << 1) + gear[byte]) & _HASH_MASK
+            position += 1
+            if not fingerprint & mask:
+                return position
+    return limit
+
+
+def split_into_chunks(file_descriptor):
+    """Returns (offset, length, hash) of each chunk of the file"""
+    size = os.fstat(file_descriptor).st_size
+    if size > CONTENT_DEFINED_CHUNKING_LIMIT:
+        return _split_into_fixed_chunks(file_descriptor, size)
+    return _split_at_content(file_descriptor)
+
+
+def _split_into_fixed_chunks(file_descriptor, size):
+    chunks = []
+    for offset in range(0, size, MAX_CHUNK_SIZE):
+        data = os.pread(file_descriptor, MAX_CHUNK_SIZE, offset)
+        if not data:
+            # The file was truncated in the meantime
+            break
+        chunks.append((offset, len(data), hash_chunk(data)))
+    return chunks
+
+
+def _split_at_content(file_descriptor):
+    chunks = []
+    buffer = b""
+    # Offset of the start of the buffer in the file
+    buffer_offset = 0
+    start = 0
+    end_of_file = False
+    while True:
+        if not end_of_file and len(buffer) - start < MAX_CHUNK_SIZE:
+            buffer = buffer[start:]
+            buffer_offset += start
+            start = 0
+            data = os.pread(
+                file_descriptor,
+                2 * MAX_CHUNK_SIZE,
+                buffer_offset + len(buffer),
+            )
+            end_of_file = not data
+            buffer += data
+            continue
+        if start == len(buffer):
+            return chunks
+        end = find_chunk_end(buffer, start, len(buffer))
+        chunks.append(
+            (buffer_offset + start, end - start, hash_chunk(buffer[start:end]))
+        )
+        start = end
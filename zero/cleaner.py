@@ -1,118 +1,246 @@
+import os
 import logging
 import time
-from multiprocessing import Process
+import threading
 from .locking import NodeLockedException, PathLock
 from .remote_identifiers import RemoteIdentifiers
 from .events import EventListener, FileUpdateOrCreateEvent
 from .dirty_flags import DirtyFlags
 from .states import StateMachine
 from .path_converter import PathConverter
+from .b2_api import UploadAbortException
+from .state_store import get_state_store, STATES
+from .upload_backlog import UploadBacklog
+from .packer import Packer
 
 logger = logging.getLogger("spam_application")
 
-
-class UploadAbortException(Exception):
-    pass
-
-
-def upload(api, file_to_upload, new_uuid):
-    api.upload(file=file_to_upload, file_uuid=new_uuid)
+UPLOAD_WORKERS = 4
+# How often packs that are mostly taken up by deleted files are rewritten,
+# and packed files that no path refers to are deleted
+COMPACTION_INTERVAL = 600  # seconds
+# How often interrupted uploads of paths that no longer need
+# uploading are cancelled
+STALE_UPLOAD_INTERVAL = 600  # seconds
 
 
 class Cleaner:
 
-    def __init__(self, cache_folder, api):
+    def __init__(self, cache_folder, api, workers=UPLOAD_WORKERS):
         self.converter = PathConverter(cache_folder)
         self.api = api
         self.converter = self.converter
         self.states = StateMachine(cache_folder=cache_folder)
         self.remote_identifiers = RemoteIdentifiers(cache_folder)
         self.dirty_flags = DirtyFlags(cache_folder)
+        self.state_store = get_state_store(cache_folder)
+        self.backlog = UploadBacklog()
+        self.workers = workers
+        self.packer = None
 
     def run_watcher(self):
+        if self.api.pack_store is not None:
+            self.packer = Packer(
+                self.api.upload_pack, self._finish_packing, self._retry_packing
+            )
+            threading.Thread(
+                target=self._compact_packs, name="compactor", daemon=True
+            ).start()
+        for number in range(self.workers):
+            threading.Thread(
+                target=self._work, name=f"uploader {number}", daemon=True
+            ).start()
+        threading.Thread(
+            target=self._cancel_stale_uploads_periodically,
+            name="stale upload canceller",
+            daemon=True,
+        ).start()
+        # Events about these may have been lost when zero went down
+        for path in self.state_store.get_paths_in_state(STATES.DIRTY):
+            self.backlog.add(path)
         with EventListener(
-            (FileUpdateOrCreateEvent.topic,)
+            (FileUpdateOrCreateEvent.topic,), consumer="cleaner"
         ) as cleaning_listener:
             while True:
                 time.sleep(1)
                 for message in cleaning_listener.yield_events():
+                    # Files are often still being written when we hear
+                    # about them. The backlog holds on to them until
+                    # they have been left alone for a while.
+                    self.backlog.add(message["path"])
 
-                    path = message["path"]
-                    print("Received message to clean " + path)
-                    if not self.states.current_state_is_dirty(path):
-                        print(
-                            "No dirty flag found on path. Probably already uploaded"
-                        )
-                        continue
-                    # It is impotant to take it easy here - often, after receiving a message,
-                    # the file is still being written. There is no point starting to upload
-                    # immediately
-                    # By having this sleep AFTER the first dirty check, we can speed through messages that
-                    # tell us a file is dirty that isn't actually dirty.
-                    # By having this sleep BEFORE the path lock, we give fuse a chance to finish writing the file
-                    # before we are attempting an upload.
-                    time.sleep(1)
-                    # In the long run we may have to think of smarter ways to handle duplicate messages here.
-                    # We might want to keep an internal de-duplciated backlog of file that we still have to clean,
-                    # and then have one worker to fill the backlog and (eliminating duplicates) and another
-                    # worker working off it
-                    try:
-                        with PathLock(
-                            path,
-                            exclusive_lock_on_leaf=False,
-                            high_priority=False,
-                            lock_creator="Cleaner",
-                        ) as lock:
-                            # - check if file exists and is still dirty
-                            if not self.states.current_state_is_dirty(path):
-                                print(
-                                    "No dirty flag found on path. Some other thread cleaned it within the last second."
-                                )
-                                continue
-
-                            # - get old uuid if it exists
-                            old_uuid = self.remote_identifiers.get_uuid_or_none(
-                                path
-                            )
-                            if old_uuid:
-                                # - If yes, delete old version of file on remote
-                                self.api.delete(old_uuid)
-
-                            try:
-                                new_uuid = self.upload_file(
-                                    path=path, lock=lock
-                                )
-                                self.states.dirty_to_clean(path)
-                                self.remote_identifiers.set_uuid(
-                                    path=path, uuid=new_uuid
-                                )
-                            except UploadAbortException:
-                                print(f"upload of {path} was ABORTED")
-                    except NodeLockedException:
-                        # Let's postpone this for a bit
-                        # TODO: This aproach for setting ourselves a reminder is hacky beause it may confuse
-                        # other event listeners. Find a better way
-                        print(
-                            "Could not obtain lock on path for cleaning. This can happen"
-                        )
-                        FileUpdateOrCreateEvent.submit(path=path)
+    def _work(self):
+        while True:
+            path = self.backlog.take()
+            try:
+                self.clean(path)
+            except Exception:
+                logger.exception(f"Could not clean {path}")
+            finally:
+                self.backlog.done(path)
+
+    def clean(self, path):
+        print("Cleaning " + path)
+        if not self.states.current_state_is_dirty(path):
+            print("No dirty flag found on path. Probably already uploaded")
+            return
+        try:
+            with PathLock(
+                path,
+                exclusive_lock_on_leaf=False,
+                high_priority=False,
+                lock_creator="Cleaner",
+            ) as lock:
+                # - check if file exists and is still dirty
+                if not self.states.current_state_is_dirty(path):
+                    print(
+                        "No dirty flag found on path. Some other thread cleaned it in the meantime."
+                    )
+                    return
+
+                cache_path = self.converter.to_cache_path(path)
+                if self.packer is not None and self.api.should_pack(
+                    os.path.getsize(cache_path)
+                ):
+                    with open(cache_path, "rb") as file:
+                        data = file.read()
+                    # The file stays dirty until its pack is uploaded
+                    self.packer.add(
+                        path, RemoteIdentifiers.generate_uuid(), data
+                    )
+                    return
+
+                # - get old uuid if it exists
+                old_uuid = self.remote_identifiers.get_uuid_or_none(path)
+
+                try:
+                    new_uuid = self.upload_file(path=path, lock=lock)
+                    self.states.dirty_to_clean(path)
+                    self.remote_identifiers.set_uuid(path=path, uuid=new_uuid)
+                except UploadAbortException:
+                    print(f"upload of {path} was ABORTED")
+                    self.backlog.add(path)
+                    return
+                if old_uuid:
+                    # - If yes, delete old version of file on remote.
+                    # This happens after the upload, so that chunks that
+                    # the versions have in common stay on the remote.
+                    # The deleter takes care of it together with the
+                    # other deletes.
+                    self.api.schedule_delete(old_uuid)
+        except NodeLockedException:
+            # Let's postpone this for a bit
+            print(
+                "Could not obtain lock on path for cleaning. This can happen"
+            )
+            self.backlog.add(path)
 
     def upload_file(self, path, lock):
-        new_uuid = RemoteIdentifiers.generate_uuid()
+        """Uploads in this process. The upload checks for abort requests
+        between its parts and, if it is aborted, the next upload of the
+        path carries on where it stopped. Returns the new uuid.
+        """
         with open(self.converter.to_cache_path(path), "rb") as file_to_upload:
             print(f"cleaning {path}")
-            # since I don't want to mess with the b2 library code
-            # but I do want to be able to interrupt the upload
-            # the best option seems to be using python multiprocessing
-            # https://docs.python.org/3/library/multiprocessing.html#the-process-class
-            upload_process = Process(
-                target=upload, args=(self.api, file_to_upload, new_uuid)
+            return self.api.upload(
+                file=file_to_upload,
+                file_uuid=RemoteIdentifiers.generate_uuid(),
+                abort_requested=lock.abort_requested,
+                upload_key=path,
             )
-            upload_process.start()
-            while upload_process.is_alive():
-                print(f"upload of {path} is alive")
-                time.sleep(0.1)
-                if lock.abort_requested():
-                    upload_process.terminate()
-                    raise UploadAbortException
-        return new_uuid
+
+    def _cancel_stale_uploads_periodically(self):
+        while True:
+            try:
+                self.cancel_stale_uploads()
+            except Exception:
+                logger.exception("Could not cancel stale uploads")
+            time.sleep(STALE_UPLOAD_INTERVAL)
+
+    def cancel_stale_uploads(self):
+        """Cancels the interrupted uploads of paths that are not dirty
+        anymore, for example because they were deleted or renamed, so
+        that their parts do not stay on the remote. The path is locked
+        as for cleaning, so an upload that is under way is left alone.
+        """
+        for path in self.api.get_unfinished_uploads():
+            try:
+                with PathLock(
+                    path,
+                    exclusive_lock_on_leaf=False,
+                    high_priority=False,
+                    lock_creator="Cleaner",
+                ):
+                    if self.states.current_state_is_dirty(path):
+                        continue
+                    print(f"Cancelling the interrupted upload of {path}")
+                    self.api.cancel_unfinished_upload(path)
+            except NodeLockedException:
+                # Tried again next time
+                pass
+
+    def _finish_packing(self, members):
+        for path, file_uuid, data in members:
+            try:
+                self._mark_packed(path, file_uuid, data)
+            except Exception:
+                logger.exception(f"Could not finish cleaning {path}")
+
+    def _mark_packed(self, path, file_uuid, data):
+        try:
+            with PathLock(
+                path,
+                exclusive_lock_on_leaf=False,
+                high_priority=False,
+                lock_creator="Cleaner",
+            ):
+                is_dirty = self.states.current_state_is_dirty(path)
+                if not (is_dirty and self._has_content(path, data)):
+                    # Written to, cleaned or removed since it was read.
+                    # A write puts it into the backlog again.
+                    self.api.schedule_delete(file_uuid)
+                    return
+                old_uuid = self.remote_identifiers.get_uuid_or_none(path)
+                self.states.dirty_to_clean(path)
+                self.remote_identifiers.set_uuid(path=path, uuid=file_uuid)
+        except NodeLockedException:
+            self.api.schedule_delete(file_uuid)
+            self.backlog.add(path)
+            return
+        if old_uuid:
+            self.api.schedule_delete(old_uuid)
+
+    def _has_content(self, path, data):
+        try:
+            with open(self.converter.to_cache_path(path), "rb") as file:
+                return file.read() == data
+        except FileNotFoundError:
+            return False
+
+    def _retry_packing(self, members):
+        for path, _, _ in members:
+            self.backlog.add(path)
+
+    def _compact_packs(self):
+        orphans = set()
+        while True:
+            time.sleep(COMPACTION_INTERVAL)
+            try:
+                orphans = self.delete_orphaned_packed_files(orphans)
+                self.api.compact_packs()
+            except Exception:
+                logger.exception("Could not compact packs")
+
+    def delete_orphaned_packed_files(self, earlier_orphans):
+        """Schedules the deletion of packed files that no path refers to,
+        for example because zero went down after their pack was uploaded.
+        Files of a pack that is being finished have no path yet either,
+        so only those that had none last time, `earlier_orphans`, are
+        deleted. Returns the packed files without a path.
+        """
+        file_uuids = self.api.get_packed_files()
+        orphans = set(file_uuids) - self.state_store.get_used_uuids(file_uuids)
+        for file_uuid in orphans & earlier_orphans:
+            logger.warning(f"Deleting packed file {file_uuid} without a path")
+            self.api.schedule_delete(file_uuid)
+        return orphans
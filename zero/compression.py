@@ -0,0 +1,169 @@
+import os
+import zlib
+
+# Codecs by the name that is recorded in the header of an object.
+# A codec must offer the interface of the zlib module.
+CODECS = {"zlib": zlib}
+DEFAULT_CODEC = "zlib"
+COMPRESSION_LEVEL = 6
+# Every compressed object starts with this, followed by
+# the length of the name of the codec and the name.
+MAGIC = b"ZERO"
+# Files are read and decompressed in blocks of this size,
+# so that memory use does not depend on the file size.
+BLOCK_SIZE = 1024 * 1024  # Bytes
+# Only the first bytes of a file are compressed on trial to
+# decide whether the whole file is worth compressing.
+SAMPLE_SIZE = 64 * 1024  # Bytes
+# A file is not compressed if this does not save at least 10%.
+MAX_COMPRESSED_FRACTION = 0.9
+# Formats that are compressed already. Files with these extensions
+# are not even sampled.
+COMPRESSED_EXTENSIONS = {
+    ".7z",
+    ".avi",
+    ".bz2",
+    ".docx",
+    ".flac",
+    ".gif",
+    ".gz",
+    ".heic",
+    ".jar",
+    ".jpeg",
+    ".jpg",
+    ".m4a",
+    ".mkv",
+    ".mov",
+    ".mp3",
+    ".mp4",
+    ".ogg",
+    ".png",
+    ".rar",
+    ".tgz",
+    ".webm",
+    ".webp",
+    ".xlsx",
+    ".xz",
+    ".zip",
+    ".zst",
+}
+
+
+class CompressionError(Exception):
+    pass
+
+
+def has_compressed_extension(file_name):
+    return (
+        isinstance(file_name, str)
+        and os.path.splitext(file_name)[1].lower() in COMPRESSED_EXTENSIONS
+    )
+
+
+def is_worth_compressing(sample, file_name=None):
+    if has_compressed_extension(file_name):
+        return False
+    if not sample:
+        return False
+    # The lowest level is fast and tells compressible data apart well enough
+    compressed = zlib.compress(sample[:SAMPLE_SIZE], 1)
+    return len(compressed) <= MAX_COMPRESSED_FRACTION * len(sample)
+
+
+def make_header(codec):
+    name = codec.encode()
+    return MAGIC + bytes([len(name)]) + name
+
+
+def parse_header(data):
+    """Returns the codec and the length of the header,
+    or None if `data` does not hold the whole header yet.
+    """
+    if len(data) < len(MAGIC) + 1:
+        return None
+    if not data.startswith(MAGIC):
+        raise CompressionError("Object has no compression header")
+    name_end = len(MAGIC) + 1 + data[len(MAGIC)]
+    if len(data) < name_end:
+        return None
+    codec = data[len(MAGIC) + 1 : name_end].decode()
+    if codec not in CODECS:
+        raise CompressionError(f"Unknown codec {codec}")
+    return codec, name_end
+
+
+def compress(data, codec=DEFAULT_CODEC):
+    return make_header(codec) + CODECS[codec].compress(data, COMPRESSION_LEVEL)
+
+
+def compress_file(
+    file_descriptor, output, codec=DEFAULT_CODEC, abort_requested=None
+):
+    """Writes the compressed content of the file into `output`,
+    one block at a time. Stops and returns False as soon as
+    `abort_requested` returns True before a block.
+    """
+    output.write(make_header(codec))
+    compressor = CODECS[codec].compressobj(COMPRESSION_LEVEL)
+    offset = 0
+    while True:
+        if abort_requested is not None and abort_requested():
+            return False
+        block = os.pread(file_descriptor, BLOCK_SIZE, offset)
+        if not block:
+            break
+        offset += len(block)
+        output.write(compressor.compress(block))
+    output.write(compressor.flush())
+    return True
+
+
+class DecompressingStream:
+    """Stream that the download of a compressed object is written into.
+    Writes the decompressed bytes from `first` to `last`, inclusive,
+    into `stream` as they arrive. Since compressed objects cannot be
+    downloaded in ranges, the bytes outside the range are dropped.
+    """
+
+    def __init__(self, stream, first=0, last=None):
+        self.stream = stream
+        self.first = first
+        self.last = last
+        self.header = b""
+        self.decompressor = None
+        # Number of decompressed bytes so far
+        self.position = 0
+
+    def write(self, data):
+        if self.decompressor is None:
+            self.header += data
+            parsed = parse_header(self.header)
+            if parsed is None:
+                return
+            codec, header_length = parsed
+            data = self.header[header_length:]
+            self.header = b""
+            self.decompressor = CODECS[codec].decompressobj()
+        while data:
+            self._write_decompressed(
+                self.decompressor.decompress(data, BLOCK_SIZE)
+            )
+            data = self.decompressor.unconsumed_tail
+
+    def finish(self):
+        """Must be called once the whole object has been written"""
+        if self.decompressor is None:
+            raise CompressionError("Object ended within the header")
+        self._write_decompressed(self.decompressor.flush())
+        if not self.decompressor.eof:
+            raise CompressionError("Object ended before the compressed data")
+
+    def _write_decompressed(self, data):
+        start = self.position
+        self.position += len(data)
+        end = len(data)
+        if self.last is not None:
+            end = min(end, self.last + 1 - start)
+        begin = max(self.first - start, 0)
+        if begin < end:
+            self.stream.write(data[begin:end])
@@ -1,6 +1,7 @@
 import argparse
 import yaml
 from os.path import expanduser
+from .attribute_cache import ATTRIBUTE_TIMEOUT
 
 
 def get_config():
@@ -12,4 +13,49 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("mountpoint", type=str, help="Mountpoint")
     parser.add_argument("cache_folder", type=str, help="Cache folder")
+    parser.add_argument(
+        "--multithreaded",
+        action="store_true",
+        help="Serve fuse requests from multiple threads",
+    )
+    parser.add_argument(
+        "--progressive-hydration",
+        action="store_true",
+        help="Serve reads of remote files while they are being downloaded",
+    )
+    parser.add_argument(
+        "--local-events",
+        action="store_true",
+        help="Send events between the processes without RabbitMQ",
+    )
+    parser.add_argument(
+        "--event-journal",
+        action="store_true",
+        help="Keep events in a journal in the cache folder, so that "
+        "the workers catch up on them after a restart",
+    )
+    parser.add_argument(
+        "--priming-workers",
+        type=int,
+        default=4,
+        help="Number of files that the balancer downloads at once",
+    )
+    parser.add_argument(
+        "--upload-workers",
+        type=int,
+        default=4,
+        help="Number of files that are uploaded at once",
+    )
+    parser.add_argument(
+        "--delete-workers",
+        type=int,
+        default=8,
+        help="Number of files that are deleted from the remote at once",
+    )
+    parser.add_argument(
+        "--attribute-timeout",
+        type=float,
+        default=ATTRIBUTE_TIMEOUT,
+        help="Seconds for which file attributes and missing paths are cached",
+    )
     return parser.parse_args()
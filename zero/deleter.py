@@ -1,17 +1,58 @@
 import logging
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from .events import EventListener, FileDeleteEvent
 
 logger = logging.getLogger("spam_application")
 
+DELETE_WORKERS = 8
+# Deletes are run in batches of up to this many files
+DELETE_BATCH_SIZE = 100
+# A failed delete is retried after this delay, which doubles with
+# every failed attempt up to the maximum.
+RETRY_DELAY = 10  # seconds
+MAX_RETRY_DELAY = 3600  # seconds
+
+
+def get_retry_delay(attempts):
+    return min(RETRY_DELAY * 2**attempts, MAX_RETRY_DELAY)
+
 
 class Deleter:
+    """Deletes files from the remote, several at once.
+
+    Deletes are kept in a queue in the file info store until they
+    succeed, so that none are lost when a delete fails or zero goes
+    down. The cleaner adds the deletes of overwritten versions to the
+    same queue, and a file that is in the queue already is not added
+    again. A delete event is only acknowledged once its delete is in
+    the queue.
+    """
 
-    def __init__(self, api):
+    def __init__(self, api, workers=DELETE_WORKERS):
         self.api = api
+        self.file_info_store = api.file_info_store
+        self.workers = workers
+        # Set when deletes have been added to the queue
+        self.arrived = threading.Event()
 
     def run_watcher(self):
-        with EventListener((FileDeleteEvent.topic,)) as deletion_listener:
+        threading.Thread(
+            target=self._listen, name="delete listener", daemon=True
+        ).start()
+        with ThreadPoolExecutor(self.workers) as executor:
+            is_idle = False
+            while True:
+                if is_idle:
+                    self.arrived.wait(timeout=1)
+                self.arrived.clear()
+                is_idle = not self.delete_due(executor)
+
+    def _listen(self):
+        with EventListener(
+            (FileDeleteEvent.topic,), consumer="deleter"
+        ) as deletion_listener:
             while True:
                 time.sleep(1)
                 for message in deletion_listener.yield_events():
@@ -19,4 +60,36 @@ class Deleter:
                     # TODO: the message must contain the uuid of the file to be deleted already,
                     # since the path may no longer exist.
                     if uuid is not None:
-                        self.api.delete(uuid)
+                        # Stored before the event is acknowledged,
+                        # which happens when the next one is taken
+                        self.add(uuid)
+
+    def add(self, uuid):
+        self.file_info_store.add_pending_deletes([uuid], time.time())
+        self.arrived.set()
+
+    def delete_due(self, executor):
+        """Runs a batch of the deletes that are due.
+        Returns False if there were none.
+        """
+        batch = self.file_info_store.get_due_deletes(
+            time.time(), DELETE_BATCH_SIZE
+        )
+        if not batch:
+            return False
+        errors = self.api.delete_many([uuid for uuid, _ in batch], executor)
+        done = []
+        postponements = []
+        for uuid, attempts in batch:
+            if uuid in errors:
+                logger.error(
+                    f"Could not delete {uuid}, will retry: {errors[uuid]}"
+                )
+                postponements.append(
+                    (uuid, time.time() + get_retry_delay(attempts))
+                )
+            else:
+                done.append(uuid)
+        self.file_info_store.remove_pending_deletes(done)
+        self.file_info_store.postpone_pending_deletes(postponements)
+        return True
@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import threading
+import portalocker
+
+# The journal is split into segments of about this size.
+# Segments that all consumers are done with are deleted.
+SEGMENT_SIZE = 16 * 1024 * 1024  # Bytes
+SEGMENT_SUFFIX = ".log"
+# How often a consumer that is up to date looks for new events
+POLL_INTERVAL = 0.1  # seconds
+READ_BATCH_SIZE = 1000  # events
+# A consumer stores its offset at least every so many events
+COMMIT_INTERVAL = 1000  # events
+
+
+class EventJournal:
+    """Append-only log of events on disk that can be shared between
+    processes. Events are json lines and are addressed by their byte
+    offset in the journal. Each segment file is named after the
+    offset of its first byte.
+
+    Consumers store the offset up to which they have handled the events,
+    so that they can carry on from there after a restart.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.consumers_directory = os.path.join(directory, "consumers")
+        os.makedirs(self.consumers_directory, exist_ok=True)
+        # Appends of all processes are serialized by a lock on this file,
+        # and those of the threads of this process by the thread lock.
+        self.lock_file = open(os.path.join(directory, "lock"), "a")
+        self.thread_lock = threading.Lock()
+        self.segment = None
+        self.segment_file = None
+        # Segments are only listed again if the directory has changed
+        self.directory_modification_time = None
+
+    def append(self, message):
+        data = (message + "\n").encode()
+        with self.thread_lock:
+            portalocker.lock(self.lock_file, portalocker.LOCK_EX)
+            try:
+                self._append(data)
+            finally:
+                portalocker.unlock(self.lock_file)
+
+    def _append(self, data):
+        modification_time = os.stat(self.directory).st_mtime_ns
+        if modification_time != self.directory_modification_time:
+            segments = self._get_segments()
+            start = segments[-1] if segments else 0
+            if start != self.segment:
+                # Another process has started a new segment
+                self._open_segment(start)
+            self.directory_modification_time = modification_time
+        start = self.segment
+        size = os.fstat(self.segment_file.fileno()).st_size
+        if size > 0 and size + len(data) > self.segment_size:
+            self._open_segment(start + size)
+            self.compact()
+        self.segment_file.write(data)
+        self.segment_file.flush()
+
+    def _open_segment(self, start):
+        if self.segment_file is not None:
+            self.segment_file.close()
+        self.segment = start
+        self.segment_file = open(self._segment_path(start), "ab")
+
+    def _segment_path(self, start):
+        return os.path.join(self.directory, f"{start:020d}{SEGMENT_SUFFIX}")
+
+    def _get_segments(self):
+        return sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def get_end_offset(self):
+        segments = self._get_segments()
+        if not segments:
+            return 0
+        return segments[-1] + os.path.getsize(self._segment_path(segments[-1]))
+
+    def read(self, offset, limit=READ_BATCH_SIZE):
+        """Returns up to `limit` events from `offset` on,
+        each with the offset of the event after it.
+        """
+        segments = self._get_segments()
+        events = []
+        for index, start in enumerate(segments):
+            end = segments[index + 1] if index + 1 < len(segments) else None
+            if end is not None and end <= offset:
+                continue
+            try:
+                segment_file = open(self._segment_path(start), "rb")
+            except FileNotFoundError:
+                # Compacted in the meantime
+                continue
+            with segment_file:
+                segment_file.seek(max(offset - start, 0))
+                for line in segment_file:
+                    if not line.endswith(b"\n"):
+                        # Still being written
+                        return events
+                    offset = max(offset, start) + len(line)
+                    events.append((offset, line.decode()))
+                    if len(events) >= limit:
+                        return events
+            if end is not None:
+                offset = end
+        return events
+
+    def get_offset(self, consumer):
+        try:
+            with open(self._consumer_path(consumer)) as offset_file:
+                return int(offset_file.read())
+        except FileNotFoundError:
+            # A new consumer starts with the oldest event that is kept
+            segments = self._get_segments()
+            return segments[0] if segments else 0
+
+    def set_offset(self, consumer, offset):
+        path = self._consumer_path(consumer)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as offset_file:
+            offset_file.write(str(offset))
+        os.replace(temporary_path, path)
+
+    def _consumer_path(self, consumer):
+        return os.path.join(self.consumers_directory, consumer)
+
+    def compact(self):
+        """Deletes the segments that all consumers are done with.
+        The segment that is written to is always kept.
+        """
+        offsets = [
+            self.get_offset(consumer)
+            for consumer in os.listdir(self.consumers_directory)
+            if not consumer.endswith(".tmp")
+        ]
+        if not offsets:
+            return
+        segments = self._get_segments()
+        for start, next_start in zip(segments, segments[1:]):
+            if next_start > min(offsets):
+                break
+            os.remove(self._segment_path(start))
+
+
+class JournalChannel:
+    """Publishes events by appending them to the journal"""
+
+    def __init__(self, journal):
+        self.journal = journal
+
+    def basic_publish(self, exchange, routing_key, body):
+        self.journal.append(body)
+
+
+class JournalSubscription:
+    """Reads the events of `topics` from the journal.
+
+    A named consumer starts where it left off and stores its offset
+    as it goes. Events are handled at least once: the offset of an
+    event is stored only after the next event has been asked for.
+    Without a name, only the events from now on are read.
+    """
+
+    def __init__(self, journal, topics, consumer=None):
+        self.journal = journal
+        self.topics = set(topics)
+        self.consumer = consumer
+        if consumer is None:
+            self.offset = journal.get_end_offset()
+        else:
+            self.offset = journal.get_offset(consumer)
+            self.journal.set_offset(consumer, self.offset)
+        self.committed = self.offset
+
+    def yield_events(self):
+        uncommitted = 0
+        while True:
+            events = self.journal.read(self.offset)
+            if not events:
+                self._commit()
+                time.sleep(POLL_INTERVAL)
+                continue
+            for next_offset, line in events:
+                message = json.loads(line)
+                if message["topic"] in self.topics:
+                    yield message
+                self.offset = next_offset
+                uncommitted += 1
+                if uncommitted >= COMMIT_INTERVAL:
+                    self._commit()
+                    uncommitted = 0
+
+    def close(self):
+        self._commit()
+
+    def _commit(self):
+        if self.consumer is not None and self.offset != self.committed:
+            self.journal.set_offset(self.consumer, self.offset)
+            self.committed = self.offset
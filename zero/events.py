@@ -1,10 +1,61 @@
 import json
+import time
 import pika
+import threading
 import logging
+from collections import deque
 from multiprocessing import current_process
+from .local_events import LocalChannel, subscribe
+from .event_journal import EventJournal, JournalChannel, JournalSubscription
 
 log = logging.getLogger(current_process().name)
 
+# Repeated events for the same path within this time are sent only once
+COALESCING_WINDOW = 1.0  # seconds
+# Events that are waiting for the broker. When the buffer is full,
+# the oldest events are dropped.
+EVENT_BUFFER_SIZE = 10000
+EVENT_BATCH_SIZE = 100
+# Events that wait longer than this are counted as delayed
+EVENT_DELAY_THRESHOLD = 1.0  # seconds
+MAX_RECONNECT_DELAY = 30  # seconds
+
+
+# Directory of the local event transport. If it is not set,
+# events go through RabbitMQ.
+_local_events_directory = None
+
+
+def use_local_transport(directory):
+    """Send the events of this process and the processes forked from it
+    directly to the listeners, without a broker. Named consumers read
+    them from a journal in `directory`, so that they do not miss any.
+    """
+    global _local_events_directory
+    _local_events_directory = directory
+
+
+# Directory of the event journal. If it is set, events are kept on disk
+# and workers carry on where they left off after a restart.
+_event_journal_directory = None
+
+
+def use_event_journal(directory):
+    """Keep the events of this process and the processes forked from it
+    in a journal on disk instead of sending them to the listeners.
+    """
+    global _event_journal_directory
+    _event_journal_directory = directory
+
+
+def connect():
+    """Returns a connection and a channel to publish events on"""
+    if _event_journal_directory is not None:
+        return None, JournalChannel(EventJournal(_event_journal_directory))
+    if _local_events_directory is not None:
+        return None, LocalChannel(_local_events_directory)
+    return get_rabbitmq()
+
 
 def get_rabbitmq():
     connection = pika.BlockingConnection(
@@ -20,6 +71,216 @@ def close_rabbitmq(connection, channel):
     connection.close()
 
 
+class SynchronizedChannel:
+    """Wraps a channel so that it can be shared between the threads of
+    a multithreaded fuse process. pika's BlockingConnection is not
+    thread safe, so publishing is serialized.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.lock = threading.Lock()
+
+    def basic_publish(self, **kwargs):
+        with self.lock:
+            self.channel.basic_publish(**kwargs)
+
+
+class BackgroundPublisher:
+    """Stands in for a channel, but returns from basic_publish right
+    away. The events are kept in a bounded buffer and published in
+    batches by a background thread, which also reconnects to the broker
+    when the connection is lost. If the broker is unreachable for long,
+    the oldest events are dropped, as is an event that fails to publish
+    for any other reason.
+    """
+
+    def __init__(
+        self,
+        connect=connect,
+        buffer_size=EVENT_BUFFER_SIZE,
+        batch_size=EVENT_BATCH_SIZE,
+    ):
+        self.connect = connect
+        self.buffer = deque()
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.delayed = 0
+        threading.Thread(
+            target=self._run, name="event publisher", daemon=True
+        ).start()
+
+    def basic_publish(self, exchange, routing_key, body):
+        with self.condition:
+            self._append((time.monotonic(), exchange, routing_key, body))
+            self.condition.notify()
+
+    def _append(self, message):
+        if len(self.buffer) >= self.buffer_size:
+            self.buffer.popleft()
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                log.warning(f"Dropped {self.dropped} events so far")
+        self.buffer.append(message)
+
+    def _take_batch(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.buffer)
+            return [
+                self.buffer.popleft()
+                for _ in range(min(self.batch_size, len(self.buffer)))
+            ]
+
+    def _put_back(self, batch):
+        with self.condition:
+            unsent = list(batch) + list(self.buffer)
+            self.buffer.clear()
+            for message in unsent:
+                self._append(message)
+
+    def _disconnect(self, connection, channel):
+        # The local transports have no connection to close
+        if connection is None:
+            return
+        try:
+            close_rabbitmq(connection, channel)
+        except Exception as e:
+            log.warning(f"Could not close the connection to the broker: {e}")
+
+    def _run(self):
+        connection = None
+        channel = None
+        reconnect_delay = 1
+        while True:
+            batch = self._take_batch()
+            try:
+                if channel is None:
+                    connection, channel = self.connect()
+                    reconnect_delay = 1
+                while batch:
+                    queued_at, exchange, routing_key, body = batch[0]
+                    channel.basic_publish(
+                        exchange=exchange, routing_key=routing_key, body=body
+                    )
+                    batch.pop(0)
+                    if time.monotonic() - queued_at > EVENT_DELAY_THRESHOLD:
+                        self.delayed += 1
+            except Exception as e:
+                if channel is not None and not isinstance(
+                    e, (pika.exceptions.AMQPError, OSError)
+                ):
+                    # Something is wrong with the event itself. It is
+                    # dropped, so that it does not hold up the others.
+                    log.exception(f"Dropping an event on {batch[0][2]}")
+                    batch.pop(0)
+                    with self.condition:
+                        self.dropped += 1
+                    self._put_back(batch)
+                    continue
+                log.error(
+                    f"Publishing events failed, retrying in {reconnect_delay}s"
+                    f" ({self.dropped} dropped, {self.delayed} delayed): {e}"
+                )
+                if channel is not None:
+                    self._disconnect(connection, channel)
+                connection = None
+                channel = None
+                self._put_back(batch)
+                time.sleep(reconnect_delay)
+                reconnect_delay = min(2 * reconnect_delay, MAX_RECONNECT_DELAY)
+
+
+class _Window:
+
+    def __init__(self, exchange, path, end):
+        self.exchange = exchange
+        self.path = path
+        self.end = end
+        self.pending = False
+
+
+class CoalescingChannel(SynchronizedChannel):
+    """Collapses identical events of the `topics` that are published
+    within `window` seconds.
+
+    The first event is sent right away. Repeats within the window are
+    sent once when the window is over, so at most one event per path
+    and topic goes out per window. Other events are sent right away,
+    after the collapsed events of the same path, to keep their order.
+    """
+
+    def __init__(self, channel, topics, window=COALESCING_WINDOW):
+        super().__init__(channel)
+        self.topics = set(topics)
+        self.window = window
+        # (routing_key, body) -> _Window
+        self.windows = {}
+        self.windows_lock = threading.Lock()
+        threading.Thread(
+            target=self._close_windows_periodically,
+            name="event coalescing",
+            daemon=True,
+        ).start()
+
+    def basic_publish(self, exchange, routing_key, body):
+        path = json.loads(body).get("path")
+        if routing_key not in self.topics:
+            self.flush(path)
+            super().basic_publish(
+                exchange=exchange, routing_key=routing_key, body=body
+            )
+            return
+        with self.windows_lock:
+            window = self.windows.get((routing_key, body))
+            if window is not None and window.end > time.monotonic():
+                window.pending = True
+                return
+            self.windows[(routing_key, body)] = _Window(
+                exchange, path, time.monotonic() + self.window
+            )
+        super().basic_publish(
+            exchange=exchange, routing_key=routing_key, body=body
+        )
+
+    def flush(self, path):
+        """Sends the collapsed events of the path now"""
+        with self.windows_lock:
+            due = [
+                (key, window)
+                for key, window in self.windows.items()
+                if window.path == path and window.pending
+            ]
+            for _, window in due:
+                window.pending = False
+        self._publish(due)
+
+    def _close_windows_periodically(self):
+        while True:
+            time.sleep(self.window)
+            now = time.monotonic()
+            with self.windows_lock:
+                due = []
+                for key, window in list(self.windows.items()):
+                    if window.end > now:
+                        continue
+                    if window.pending:
+                        # The trailing event opens the next window
+                        window.pending = False
+                        window.end = now + self.window
+                        due.append((key, window))
+                    else:
+                        del self.windows[key]
+            self._publish(due)
+
+    def _publish(self, due):
+        for (routing_key, body), window in due:
+            super().basic_publish(
+                exchange=window.exchange, routing_key=routing_key, body=body
+            )
+
+
 def register_subscriber(channel, topics):
     result = channel.queue_declare(queue="", exclusive=True)
     queue_name = result.method.queue
@@ -37,20 +298,44 @@ def unregister_subscriber(channel):
 
 class EventListener:
 
-    def __init__(self, topics):
+    def __init__(self, topics, consumer=None):
+        """With the event journal or the local transport, a listener
+        with a `consumer` name also gets the events that were published
+        while it was not running.
+        """
         self.topics = topics
+        self.consumer = consumer
+        self.subscription = None
 
     def __enter__(self):
+        if _event_journal_directory is not None:
+            self.subscription = JournalSubscription(
+                EventJournal(_event_journal_directory),
+                self.topics,
+                consumer=self.consumer,
+            )
+            return self
+        if _local_events_directory is not None:
+            self.subscription = subscribe(
+                _local_events_directory, self.topics, consumer=self.consumer
+            )
+            return self
         # Creating queue connection
         self.connection, self.channel = get_rabbitmq()
         self.queue_name = register_subscriber(self.channel, self.topics)
         return self
 
     def __exit__(self, *args):
+        if self.subscription is not None:
+            self.subscription.close()
+            return
         unregister_subscriber(self.channel)
         close_rabbitmq(connection=self.connection, channel=self.channel)
 
     def yield_events(self):
+        if self.subscription is not None:
+            yield from self.subscription.yield_events()
+            return
         for method_frame, properties, body in self.channel.consume(
             queue=self.queue_name
         ):
@@ -74,7 +359,9 @@ class Event:
                 f"Submit method of {self.topic} events is expecting the following arguments: {self.arguments}"
             )
         kwargs = {
-            key: value for key, value in kwargs.items() if key in self.arguments
+            key: value
+            for key, value in kwargs.items()
+            if key in self.arguments
         }
         # This is a bit of a hack, I could get the topic also from rabbitmq
         kwargs["topic"] = self.topic
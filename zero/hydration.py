@@ -0,0 +1,241 @@
+import os
+import logging
+import threading
+from multiprocessing import current_process
+
+log = logging.getLogger(current_process().name)
+
+# Size of the blocks that are fetched with ranged requests when a reader
+# jumps ahead of the background download.
+RANGE_FETCH_SIZE = 4 * 1024 * 1024  # Bytes
+# If a read is at most this far ahead of the background download,
+# we simply wait for the download to get there.
+STREAM_AHEAD_TOLERANCE = 8 * 1024 * 1024  # Bytes
+# The background download is written to disk in pieces of this size.
+# Readers are woken up after each piece.
+WRITE_BUFFER_SIZE = 256 * 1024  # Bytes
+
+
+class HydrationFailedException(Exception):
+    """The bytes that a reader waits for could not be downloaded"""
+
+
+class _PositionalWriter:
+    """File-like object that the download writes into.
+    Writes the bytes into the file descriptor at the position
+    where they belong and reports progress to the hydration.
+    """
+
+    def __init__(self, hydration, offset):
+        self.hydration = hydration
+        self.offset = offset
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        os.pwrite(self.hydration.fd, self.buffer, self.offset)
+        self.offset += len(self.buffer)
+        self.buffer = bytearray()
+        self.hydration._record_streamed_until(self.offset)
+
+
+class _BlockWriter:
+
+    def __init__(self, hydration, offset):
+        self.hydration = hydration
+        self.offset = offset
+
+    def write(self, data):
+        os.pwrite(self.hydration.fd, data, self.offset)
+        self.offset += len(data)
+
+
+class Hydration:
+    """Downloads a remote file into its dummy file in the background,
+    while the parts that have already arrived can be read.
+
+    The background download streams the file front to back.
+    Readers that jump ahead of it fetch the blocks they need with
+    ranged requests, unless the file is stored compressed.
+    Since the dummy is later renamed into place, file handles that were
+    opened on it stay valid once the hydration is complete.
+    """
+
+    def __init__(self, api, uuid, file_path, on_complete, on_failure):
+        self.api = api
+        self.uuid = uuid
+        self.file_path = file_path
+        self.on_complete = on_complete
+        self.on_failure = on_failure
+        self.ranged_reads = api.supports_ranged_reads(uuid)
+        self.condition = threading.Condition()
+        self.content_length = None
+        self.streamed_until = 0
+        self.fetched_blocks = set()
+        self.blocks_in_flight = set()
+        self.complete = False
+        self.error = None
+        self.fd = os.open(file_path, os.O_RDWR)
+        self.thread = threading.Thread(
+            target=self._download, name=f"hydration {file_path}", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def wait_for(self, offset, size):
+        """Blocks until the bytes between offset and offset + size
+        are available in the file.
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.content_length is not None or self._is_over()
+            )
+        self._raise_if_failed()
+        end = min(offset + size, self.content_length)
+        while not self._has_range(offset, end):
+            if (
+                self.ranged_reads
+                and offset > self.streamed_until + STREAM_AHEAD_TOLERANCE
+            ):
+                self._fetch_blocks(offset, end)
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self._has_range(offset, end)
+                    or self._is_over()
+                    or self._blocks_ready_to_fetch(offset, end)
+                )
+            self._raise_if_failed()
+
+    def wait_until_complete(self):
+        with self.condition:
+            self.condition.wait_for(self._is_over)
+        self._raise_if_failed()
+
+    def _is_over(self):
+        return self.complete or self.error is not None
+
+    def _raise_if_failed(self):
+        if self.error is not None:
+            raise HydrationFailedException from self.error
+
+    def _has_range(self, start, end):
+        if start >= end or end <= self.streamed_until:
+            return True
+        if self.complete:
+            return True
+        return all(
+            block in self.fetched_blocks
+            for block in _blocks_between(max(start, self.streamed_until), end)
+        )
+
+    def _blocks_ready_to_fetch(self, start, end):
+        # True if a block that we need is neither there nor being fetched,
+        # for example because another ranged fetch failed.
+        if not self.ranged_reads:
+            return False
+        return start > self.streamed_until + STREAM_AHEAD_TOLERANCE and any(
+            block not in self.fetched_blocks
+            and block not in self.blocks_in_flight
+            for block in _blocks_between(start, end)
+        )
+
+    def _fetch_blocks(self, start, end):
+        with self.condition:
+            if self._is_over():
+                return
+            blocks = [
+                block
+                for block in _blocks_between(start, end)
+                if block not in self.fetched_blocks
+                and block not in self.blocks_in_flight
+            ]
+            self.blocks_in_flight.update(blocks)
+        try:
+            for block in blocks:
+                self._fetch_block(block)
+        finally:
+            with self.condition:
+                self.blocks_in_flight.difference_update(blocks)
+                self.condition.notify_all()
+
+    def _fetch_block(self, block):
+        first_byte = block * RANGE_FETCH_SIZE
+        last_byte = min(first_byte + RANGE_FETCH_SIZE, self.content_length) - 1
+        if first_byte + RANGE_FETCH_SIZE <= self.streamed_until:
+            return
+        try:
+            self.api.download_to(
+                self.uuid,
+                _BlockWriter(self, first_byte),
+                range_=(first_byte, last_byte),
+            )
+        except ConnectionError as e:
+            raise HydrationFailedException from e
+        with self.condition:
+            self.fetched_blocks.add(block)
+            self.condition.notify_all()
+
+    def _set_content_length(self, content_length):
+        # Give the file its final size right away, so that ranged
+        # fetches can write anywhere and getattr reports the right size.
+        os.ftruncate(self.fd, content_length)
+        with self.condition:
+            self.content_length = content_length
+            self.condition.notify_all()
+
+    def _record_streamed_until(self, offset):
+        with self.condition:
+            self.streamed_until = offset
+            self.condition.notify_all()
+
+    def _close(self):
+        # Ranged fetches that are still running write into the descriptor.
+        with self.condition:
+            self.condition.wait_for(lambda: not self.blocks_in_flight)
+        if self.error is not None:
+            # The content of a dummy is meaningless, leave it empty.
+            os.ftruncate(self.fd, 0)
+        os.close(self.fd)
+
+    def _download(self):
+        writer = _PositionalWriter(self, offset=0)
+        try:
+            self.api.download_to(
+                self.uuid,
+                writer,
+                on_content_length=self._set_content_length,
+            )
+            writer.flush()
+            os.fsync(self.fd)
+        except Exception as e:
+            log.error(f"Hydration of {self.file_path} failed: {e}")
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+            self._close()
+            self.on_failure(self)
+            return
+        self._close()
+        try:
+            self.on_complete(self)
+        except Exception as e:
+            log.error(f"Finishing hydration of {self.file_path} failed: {e}")
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+            return
+        with self.condition:
+            self.complete = True
+            self.condition.notify_all()
+
+
+def _blocks_between(start, end):
+    return range(start // RANGE_FETCH_SIZE, (end - 1) // RANGE_FETCH_SIZE + 1)
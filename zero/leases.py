@@ -0,0 +1,166 @@
+import threading
+from .locking import (
+    LockLostException,
+    NodeLockedException,
+    PathLock,
+    node_lock,
+    open_handles_lock_id,
+)
+
+LEASE_ACQUISITION_TIMEOUT = 100  # seconds
+
+
+class Lease:
+    """Lock on a path that the fuse process holds while the file is open,
+    so that reads and writes do not have to lock the path on every call.
+
+    The lease starts out shared, which keeps the balancer from evicting
+    the file, and is made exclusive on the first write, which also keeps
+    the cleaner from uploading the file while it is being written.
+    The folders of the path are locked with intention locks, so that
+    they cannot be locked exclusively while the file is open.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.holders = 0
+        self.exclusive = False
+        self.is_held = False
+        # Serializes changes to the file between the threads of the fuse process
+        self.mutex = threading.RLock()
+        self.path_lock = None
+        self.open_handles_lock = None
+
+    def _lock(self, path, exclusive):
+        """Returns the lock on the open handles and the lock on the path"""
+        open_handles_lock = node_lock(
+            lock_id=open_handles_lock_id(path),
+            exclusive=False,
+            high_priority=True,
+            acquisition_timeout=LEASE_ACQUISITION_TIMEOUT,
+            lock_creator="CACHE LEASE",
+        )
+        path_lock = PathLock(
+            path,
+            exclusive_lock_on_leaf=exclusive,
+            high_priority=True,
+            acquisition_timeout=LEASE_ACQUISITION_TIMEOUT,
+            lock_creator="CACHE LEASE",
+        )
+        open_handles_lock.__enter__()
+        try:
+            path_lock.__enter__()
+        except NodeLockedException:
+            open_handles_lock.__exit__()
+            raise
+        return open_handles_lock, path_lock
+
+    def hold(self, exclusive):
+        self.open_handles_lock, self.path_lock = self._lock(
+            self.path, exclusive
+        )
+        self.exclusive = exclusive
+        self.is_held = True
+
+    def let_go(self):
+        self.path_lock.__exit__()
+        self.open_handles_lock.__exit__()
+        self.is_held = False
+
+    def make_exclusive(self):
+        with self.mutex:
+            if self.exclusive or not self.is_held:
+                return
+            # flock cannot upgrade a lock atomically. While we let go of the
+            # shared lock, the lock on the open handles keeps the balancer
+            # from evicting the file.
+            try:
+                self.path_lock.upgrade()
+            except LockLostException:
+                # The path is not locked anymore, so neither is the lease
+                self.let_go()
+                raise
+            self.exclusive = True
+
+    def move(self, new_path):
+        """Locks `new_path` in the same way before letting go of the path"""
+        with self.mutex:
+            if self.is_held:
+                locks = self._lock(new_path, self.exclusive)
+                self.let_go()
+                self.open_handles_lock, self.path_lock = locks
+                self.is_held = True
+            self.path = new_path
+
+
+class LeaseTable:
+    """Keeps one lease per path for all open handles on the path and
+    maps file handles to their leases.
+    """
+
+    def __init__(self):
+        self.leases = {}
+        self.handles = {}
+        self.table_lock = threading.Lock()
+
+    def acquire(self, path, exclusive=False):
+        with self.table_lock:
+            lease = self.leases.get(path)
+            if lease is None:
+                lease = self.leases[path] = Lease(path)
+            lease.holders += 1
+        try:
+            with lease.mutex:
+                if not lease.is_held:
+                    lease.hold(exclusive)
+                elif exclusive:
+                    lease.make_exclusive()
+        except Exception:
+            self.release(lease)
+            raise
+        return lease
+
+    def release(self, lease):
+        with self.table_lock:
+            lease.holders -= 1
+            if lease.holders > 0:
+                return
+            # A lease that was displaced by a move is no longer in the table
+            if self.leases.get(lease.path) is lease:
+                del self.leases[lease.path]
+            if lease.is_held:
+                lease.let_go()
+
+    def move(self, old_path, new_path):
+        """Moves the leases on `old_path`, and on the paths in it if it is
+        a folder, to the same place under `new_path`. Leases that were on
+        these places already belong to files that have been replaced, so
+        they are let go of. Their handles stay open on the replaced files.
+        """
+        prefix = old_path.rstrip("/") + "/"
+        with self.table_lock:
+            moved = [
+                lease
+                for path, lease in self.leases.items()
+                if path == old_path or path.startswith(prefix)
+            ]
+            for lease in moved:
+                del self.leases[lease.path]
+            for lease in moved:
+                destination = new_path + lease.path[len(old_path) :]
+                displaced = self.leases.pop(destination, None)
+                if displaced is not None:
+                    with displaced.mutex:
+                        if displaced.is_held:
+                            displaced.let_go()
+                lease.move(destination)
+                self.leases[destination] = lease
+
+    def register_handle(self, file_handle, lease):
+        self.handles[file_handle] = lease
+
+    def get_by_handle(self, file_handle):
+        return self.handles[file_handle]
+
+    def release_handle(self, file_handle):
+        self.release(self.handles.pop(file_handle))
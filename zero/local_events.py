@@ -0,0 +1,184 @@
+import os
+import json
+import queue
+import time
+import socket
+import logging
+import threading
+from uuid import uuid4
+from multiprocessing import current_process
+from .event_journal import EventJournal, JournalSubscription
+
+log = logging.getLogger(current_process().name)
+
+# Events are small json objects, this is plenty
+MAX_EVENT_SIZE = 64 * 1024  # Bytes
+# Some file systems keep modification times in steps of up to this much.
+# A listing of a topic directory that was taken within this time of its
+# modification may miss a listener that registered in the same step.
+MTIME_GRANULARITY = 2 * 10**9  # Nanoseconds
+
+
+def _listener_socket_path(directory, listener_id):
+    return os.path.join(directory, "listeners", f"{listener_id}.sock")
+
+
+def _topic_directory(directory, topic):
+    return os.path.join(directory, "topics", topic)
+
+
+def get_journal(directory):
+    """Returns the journal that the events for named consumers are kept in"""
+    return EventJournal(os.path.join(directory, "journal"))
+
+
+def subscribe(directory, topics, consumer=None):
+    """A named consumer reads its events from the journal, so that it
+    gets those that it has not handled before it went away. Other
+    listeners get the events over their socket.
+    """
+    if consumer is not None:
+        return JournalSubscription(
+            get_journal(directory), topics, consumer=consumer
+        )
+    return LocalSubscription(directory, topics)
+
+
+class LocalChannel:
+    """Publishes events to the listeners of their topic on this machine,
+    without a broker.
+
+    Every event is appended to a journal, from which named consumers
+    read it. They store the offset of the events they have handled, so
+    an event that a consumer did not get to before it died is handed
+    to it again when it comes back.
+
+    Other listeners have a unix datagram socket and register for a
+    topic by putting a file named after it into the directory of the
+    topic. They only get the events that are published while they are
+    around, and the events are sent without waiting: a listener that
+    lags so far behind that its socket is full misses events. These
+    are counted in `dropped`.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.journal = get_journal(directory)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        # topic -> (modification time of the topic directory,
+        # time of the listing, listener ids)
+        self.listeners = {}
+        self.dropped = 0
+
+    def basic_publish(self, exchange, routing_key, body):
+        self.journal.append(body)
+        data = body.encode()
+        for listener_id in self._get_listeners(routing_key):
+            try:
+                self.socket.sendto(
+                    data, _listener_socket_path(self.directory, listener_id)
+                )
+            except (ConnectionError, FileNotFoundError):
+                # The listener died without unregistering
+                self._unregister(routing_key, listener_id)
+                self.listeners.pop(routing_key, None)
+            except OSError as e:
+                # Typically a full socket
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    log.warning(
+                        f"Listener {listener_id} missed a {routing_key}, "
+                        f"{self.dropped} events dropped so far: {e}"
+                    )
+
+    def close(self):
+        self.socket.close()
+
+    def _get_listeners(self, topic):
+        topic_directory = _topic_directory(self.directory, topic)
+        try:
+            modification_time = os.stat(topic_directory).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        cached = self.listeners.get(topic)
+        if (
+            cached is not None
+            and cached[0] == modification_time
+            # Otherwise the directory may have changed since the listing
+            # without its modification time changing
+            and cached[1] - modification_time > MTIME_GRANULARITY
+        ):
+            return cached[2]
+        listed_at = time.time_ns()
+        listener_ids = os.listdir(topic_directory)
+        self.listeners[topic] = (modification_time, listed_at, listener_ids)
+        return listener_ids
+
+    def _unregister(self, topic, listener_id):
+        for path in (
+            os.path.join(_topic_directory(self.directory, topic), listener_id),
+            _listener_socket_path(self.directory, listener_id),
+        ):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class LocalSubscription:
+    """Receives the events of `topics` that are published with a
+    LocalChannel. A background thread takes the events off the socket
+    as they arrive, so that the socket rarely fills up.
+    As with the exclusive queues on RabbitMQ, events that have not been
+    handled are lost when the listener goes away. Listeners that must
+    not miss events are named consumers, see `subscribe`.
+    """
+
+    def __init__(self, directory, topics):
+        self.directory = directory
+        self.topics = topics
+        self.listener_id = str(uuid4())
+        self.events = queue.Queue()
+        os.makedirs(os.path.join(directory, "listeners"), exist_ok=True)
+        self.socket_path = _listener_socket_path(directory, self.listener_id)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.socket_path)
+        threading.Thread(
+            target=self._receive, name="event receiver", daemon=True
+        ).start()
+        for topic in topics:
+            topic_directory = _topic_directory(directory, topic)
+            os.makedirs(topic_directory, exist_ok=True)
+            open(os.path.join(topic_directory, self.listener_id), "w").close()
+
+    def _receive(self):
+        while True:
+            try:
+                data = self.socket.recv(MAX_EVENT_SIZE)
+            except OSError:
+                data = None
+            if not data:
+                # The subscription was closed
+                return
+            self.events.put(data)
+
+    def yield_events(self):
+        while True:
+            yield json.loads(self.events.get())
+
+    def close(self):
+        for topic in self.topics:
+            try:
+                os.remove(
+                    os.path.join(
+                        _topic_directory(self.directory, topic),
+                        self.listener_id,
+                    )
+                )
+            except FileNotFoundError:
+                pass
+        # Shutting down wakes up the receiver thread
+        self.socket.shutdown(socket.SHUT_RDWR)
+        self.socket.close()
+        os.remove(self.socket_path)
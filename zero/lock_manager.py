@@ -0,0 +1,228 @@
+import os
+import json
+import itertools
+import threading
+import socketserver
+
+# Lock modes. Intention modes (IS, IX) are taken on the ancestors of a
+# path before the path itself is locked shared (S) or exclusively (X).
+IS = "IS"
+IX = "IX"
+S = "S"
+X = "X"
+
+COMPATIBLE = {
+    IS: {IS, IX, S},
+    IX: {IS, IX},
+    S: {IS, S},
+    X: set(),
+}
+
+
+def intention_mode(mode):
+    """Mode to take on the ancestors of a node that is locked in `mode`"""
+    return IX if mode == X else IS
+
+
+class _Request:
+
+    def __init__(self, owner, nodes, high_priority, sequence, converting):
+        self.owner = owner
+        self.nodes = nodes
+        self.high_priority = high_priority
+        self.converting = converting
+        # Fuse requests are queued before requests of the workers,
+        # otherwise requests are served in the order they arrive.
+        self.key = (not high_priority, sequence)
+
+    def conflicts_with(self, nodes):
+        return any(
+            node in nodes and mode not in COMPATIBLE[nodes[node]]
+            for node, mode in self.nodes.items()
+        )
+
+
+class LockTable:
+    """In-memory table of the granted and waiting lock requests.
+
+    An owner is whatever object asked for the lock. It must have
+    a `request_abort` method, which is called when a high priority
+    request has to wait for a lock that the owner holds.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # node -> {owner: mode}
+        self.granted = {}
+        self.waiting = []
+        self.sequence = itertools.count()
+
+    def acquire(self, owner, nodes, high_priority=False, timeout=0):
+        """Grants all of `nodes`, a mapping of node to mode, at once.
+        Returns False if that was not possible within `timeout` seconds.
+        """
+        request = _Request(
+            owner,
+            nodes,
+            high_priority,
+            next(self.sequence),
+            converting=False,
+        )
+        return self._wait_and_grant(request, timeout)
+
+    def convert(self, owner, node, mode, timeout=0):
+        """Changes the mode in which `owner` holds `node` without
+        letting go of the node in between.
+        """
+        request = _Request(
+            owner,
+            {node: mode},
+            high_priority=True,
+            sequence=next(self.sequence),
+            converting=True,
+        )
+        return self._wait_and_grant(request, timeout)
+
+    def release_all(self, owner):
+        with self.condition:
+            for node in list(self.granted):
+                holders = self.granted[node]
+                holders.pop(owner, None)
+                if not holders:
+                    del self.granted[node]
+            self.condition.notify_all()
+
+    def _wait_and_grant(self, request, timeout):
+        with self.condition:
+            if request.converting and self._is_conversion_pending(request):
+                # Two holders would wait for each other to let go
+                return False
+            if not self._is_grantable(request):
+                if request.high_priority:
+                    self._request_abort_from_holders(request)
+                if timeout <= 0:
+                    return False
+                self.waiting.append(request)
+                granted = self.condition.wait_for(
+                    lambda: self._is_grantable(request), timeout
+                )
+                self.waiting.remove(request)
+                # Requests queued behind this one may now be grantable
+                self.condition.notify_all()
+                if not granted:
+                    return False
+            for node, mode in request.nodes.items():
+                self.granted.setdefault(node, {})[request.owner] = mode
+            return True
+
+    def _is_grantable(self, request):
+        for node, mode in request.nodes.items():
+            for owner, held_mode in self.granted.get(node, {}).items():
+                if owner is not request.owner and (
+                    held_mode not in COMPATIBLE[mode]
+                ):
+                    return False
+        if request.converting:
+            # The converting owner holds the node already, so requests
+            # that are queued for it would wait forever for each other.
+            return True
+        return not any(
+            waiting.key < request.key
+            and waiting.owner is not request.owner
+            and waiting.conflicts_with(request.nodes)
+            for waiting in self.waiting
+        )
+
+    def _is_conversion_pending(self, request):
+        # Conversions to modes that are compatible, like those of intention
+        # locks, can both be granted once the other holders are gone.
+        return any(
+            waiting.converting and waiting.conflicts_with(request.nodes)
+            for waiting in self.waiting
+        )
+
+    def _request_abort_from_holders(self, request):
+        for node, mode in request.nodes.items():
+            for owner, held_mode in self.granted.get(node, {}).items():
+                if owner is not request.owner and (
+                    held_mode not in COMPATIBLE[mode]
+                ):
+                    owner.request_abort()
+
+
+class _ConnectionHandler(socketserver.StreamRequestHandler):
+    """Each connection holds one lock. The lock is released when the
+    connection is closed, which also happens when the client dies.
+
+    Messages are json objects, one per line:
+    {"op": "acquire", "nodes": [[node, mode], ...],
+     "high_priority": bool, "timeout": seconds, "creator": name}
+    {"op": "convert", "node": node, "mode": mode, "timeout": seconds}
+    Both are answered with {"granted": bool}.
+    The server sends {"abort": true} when a high priority request
+    is waiting for the lock.
+    """
+
+    def setup(self):
+        super().setup()
+        self.send_lock = threading.Lock()
+        self.abort_sent = False
+        self.creator = "Unknown"
+
+    def handle(self):
+        table = self.server.table
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                if message["op"] == "acquire":
+                    self.creator = message.get("creator") or self.creator
+                    granted = table.acquire(
+                        self,
+                        dict(message["nodes"]),
+                        high_priority=message["high_priority"],
+                        timeout=message["timeout"],
+                    )
+                elif message["op"] == "convert":
+                    granted = table.convert(
+                        self,
+                        message["node"],
+                        message["mode"],
+                        timeout=message["timeout"],
+                    )
+                else:
+                    raise ValueError(f"Unknown operation {message['op']}")
+                self._send({"granted": granted})
+        except (ConnectionError, ValueError) as e:
+            print(f"Lock manager dropping connection of {self.creator}: {e}")
+        finally:
+            table.release_all(self)
+
+    def request_abort(self):
+        if self.abort_sent:
+            return
+        self.abort_sent = True
+        print(f"Requesting {self.creator} to abort")
+        try:
+            self._send({"abort": True})
+        except OSError:
+            # The connection is going away, and with it the lock
+            pass
+
+    def _send(self, message):
+        with self.send_lock:
+            self.wfile.write(json.dumps(message).encode() + b"\n")
+            self.wfile.flush()
+
+
+class LockManager(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves the locks of all zero processes from one in-memory table."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+        self.table = LockTable()
+        super().__init__(socket_path, _ConnectionHandler)
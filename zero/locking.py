@@ -1,23 +1,59 @@
 import os
+import json
 import time
+import queue
+import socket
+import threading
 import portalocker
 import hashlib
 from .path_utils import yield_partials
+from .lock_manager import IS, IX, S, X, intention_mode
 
 LOCKDIR = "/tmp/zero-locks/"
 ABORT_REQUEST_DIR = "/tmp/zero-abort-requests/"
+OPEN_HANDLES_LOCK_SUFFIX = "[open handles]"
+# A node lock that is busy is tried again after this long at first.
+# The interval doubles with every attempt up to the maximum.
+MIN_POLL_INTERVAL = 0.01  # seconds
+MAX_POLL_INTERVAL = 0.1  # seconds
+
+# Unix socket of the lock manager. If it is not set,
+# locks are taken with flock on files in LOCKDIR.
+_lock_manager_socket = None
+
+
+def use_lock_manager(socket_path):
+    """Take all locks of this process and the processes forked from it
+    through the lock manager that listens on `socket_path`.
+    """
+    global _lock_manager_socket
+    _lock_manager_socket = socket_path
 
 
 class NodeLockedException(Exception):
     pass
 
 
+class LockLostException(NodeLockedException):
+    """A failed upgrade could not take the shared lock back either,
+    so the node is not locked anymore.
+    """
+
+
 def hash_string(string):
     string_hash = hashlib.new("md5")
     string_hash.update(string.encode())
     return string_hash.hexdigest()
 
 
+def open_handles_lock_id(path):
+    """Id of the node that is locked in shared mode while a file has open
+    handles in the fuse process. Acquiring it exclusively makes sure that
+    the file is not open.
+    """
+    return hash_string(path + OPEN_HANDLES_LOCK_SUFFIX)
+
+
 class PathLock:
 
     def __init__(
@@ -27,7 +63,8 @@ class PathLock:
         exclusive_lock_on_path=False,
         exclusive_lock_on_leaf=True,
         high_priority=False,
-        acquisition_max_retries=0,
+        acquisition_timeout=0,
+        exclude_open_handles=False,
     ):
         """A path has the form /path/path/path/path/leaf.
         A trailing slash is ignored, the last node is always
@@ -35,35 +72,58 @@ class PathLock:
         By default, a shared lock will be obtained on all nodes
         of the path except the last one and an exclusive
         lock on the last node, the "leaf" of the path.
+        With the lock manager, the nodes of the path are locked
+        with intention locks instead of shared locks.
+        With `exclude_open_handles`, the lock can only be obtained
+        while the fuse process has no open handles on the path.
+        If a node is locked, we wait up to `acquisition_timeout` seconds
+        for each node to become free.
         """
         partials = list(yield_partials(path))
-        self.locks = []
-        # Locks for non-leaf-partials
-        for path in partials[:-1]:
-            self.locks.append(
-                NodeLock(
-                    lock_id=hash_string(path),
-                    exclusive=exclusive_lock_on_path,
-                    acquisition_max_retries=acquisition_max_retries,
-                    high_priority=high_priority,
+        leaf_mode = X if exclusive_lock_on_leaf else S
+        if exclusive_lock_on_path:
+            path_mode = X
+        else:
+            path_mode = intention_mode(leaf_mode)
+        nodes = [
+            (hash_string(partial), path_mode) for partial in partials[:-1]
+        ]
+        nodes.append((hash_string(partials[-1]), leaf_mode))
+        if exclude_open_handles:
+            nodes.append((open_handles_lock_id(partials[-1]), X))
+        if _lock_manager_socket is not None:
+            # The lock manager grants all nodes at once in a single request.
+            self.locks = [
+                ManagedLock(
+                    nodes,
                     lock_creator=lock_creator,
+                    acquisition_timeout=acquisition_timeout,
+                    high_priority=high_priority,
                 )
-            )
-        # Lock for leaf
-        path = partials[-1]
-        self.locks.append(
+            ]
+            return
+        self.locks = [
             NodeLock(
-                lock_id=hash_string(path),
-                exclusive=exclusive_lock_on_leaf,
-                acquisition_max_retries=acquisition_max_retries,
+                lock_id=lock_id,
+                # Intention locks on the path are shared locks on files
+                exclusive=mode == X,
+                acquisition_timeout=acquisition_timeout,
                 high_priority=high_priority,
                 lock_creator=lock_creator,
             )
-        )
+            for lock_id, mode in nodes
+        ]
 
     def __enter__(self):
-        for lock in self.locks:
-            lock.__enter__()
+        acquired = []
+        try:
+            for lock in self.locks:
+                lock.__enter__()
+                acquired.append(lock)
+        except NodeLockedException:
+            for lock in acquired:
+                lock.__exit__()
+            raise
         return self
 
     def __exit__(self, *args):
@@ -76,6 +136,19 @@ class PathLock:
                 return True
         return False
 
+    def upgrade(self):
+        """Makes a shared lock on the leaf exclusive. Only for locks that
+        were taken without `exclude_open_handles`.
+        """
+        self.locks[-1].upgrade()
+
+
+def node_lock(lock_id, exclusive, **kwargs):
+    """Lock on a single node, taken through the lock manager if it is used"""
+    if _lock_manager_socket is not None:
+        return ManagedLock([(lock_id, X if exclusive else S)], **kwargs)
+    return NodeLock(lock_id, exclusive, **kwargs)
+
 
 class NodeLock:
 
@@ -83,81 +156,210 @@ class NodeLock:
         self,
         lock_id,
         exclusive,
-        lock_creator,
-        acquisition_max_retries=0,
+        lock_creator=None,
+        acquisition_timeout=0,
         high_priority=False,
     ):
         self.exclusive = exclusive
-        self.acquisition_max_retries = acquisition_max_retries
+        self.acquisition_timeout = acquisition_timeout
         self.lock_id = lock_id
         self.high_priority = high_priority
         self.lock_creator = lock_creator or "Unknown"
+        self.lost = False
 
     def __enter__(self):
-        # Lock database while setting lock
         if self._try_locking():
             return self
-        for counter in range(self.acquisition_max_retries):
-            time.sleep(1.)
-            # 1000 ms - We wait this long because a big upload might be locking
-            # TODO: Reduce likelihood of huge uploads locking.
-            # For example, when big files are written, the worker should avoid uploading
-            # while the files is still being written. This is not a stric rule, more of a performence consideration
-            if self._try_locking():
+        # We may have to wait long because a big upload might be locking
+        # TODO: Reduce likelihood of huge uploads locking.
+        # For example, when big files are written, the worker should avoid uploading
+        # while the files is still being written. This is not a stric rule, more of a performence consideration
+        # flock cannot time out, and a blocking flock in a helper thread
+        # would stay blocked after we give up, so we poll instead.
+        deadline = time.monotonic() + self.acquisition_timeout
+        interval = MIN_POLL_INTERVAL
+        while time.monotonic() < deadline:
+            time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+            if self._try_locking(request_abort=False):
                 return self
+            interval = min(2 * interval, MAX_POLL_INTERVAL)
         raise NodeLockedException
 
     def __exit__(self, *args):
+        if self.lost:
+            return
         self._unlock()
         # print(f"unlocked {self.lock_id}")
 
+    def upgrade(self):
+        """Turns a shared lock into an exclusive lock.
+        flock cannot do that atomically: the shared lock is let go of
+        first, so another process may get the lock in between and change
+        the node. Callers must check again whatever they found out while
+        holding the shared lock. If the shared lock cannot be taken back
+        after the exclusive lock was refused, LockLostException is raised
+        and the node is not locked anymore.
+        """
+        self._unlock()
+        self.exclusive = True
+        try:
+            self.__enter__()
+        except NodeLockedException:
+            self.exclusive = False
+            try:
+                self.__enter__()
+            except NodeLockedException:
+                self.lost = True
+                raise LockLostException
+            raise
+
     def _get_abort_request_file_name(self):
         return f"{ABORT_REQUEST_DIR}{self.lock_id}"
 
     def abort_requested(self):
         return os.path.exists(self._get_abort_request_file_name())
 
-    def _try_locking(self):
-        if not os.path.exists(LOCKDIR):
-            os.mkdir(LOCKDIR)
+    def _get_lock_file_name(self):
+        return LOCKDIR + str(self.lock_id)
+
+    def _try_locking(self, request_abort=True):
+        # Several threads and processes may race to create the directory.
+        os.makedirs(LOCKDIR, exist_ok=True)
         # print(f"try locking {self.lock_id}")
+        # We don't use portalocker.Lock and its retry functionality,
+        # because we want to be able to "request_abort" and because
+        # it waits by polling.
+        lock_file = open(self._get_lock_file_name(), "a")
         try:
-            # portalocker.Lock has its own retry functionality,
-            # But we cannot use it here, because we want to be able
-            # to "request_abort".
-            # It's a bit of a layered approach to build a high-level api
-            # on top of another high-level api such as portalocker.Lock.
-            # But since things are still evolving around here, it will leave it as is.
-            self.lock = portalocker.Lock(
-                filename=LOCKDIR + str(self.lock_id),
-                fail_when_locked=True,
-                flags=self._get_flags(),
-            )
-            self.lock.acquire()
-        except portalocker.exceptions.AlreadyLocked:
+            portalocker.lock(lock_file, self._get_flags())
+        except portalocker.exceptions.LockException:
             # print("Failed to lock")
-            if self.high_priority:
+            lock_file.close()
+            if self.high_priority and request_abort:
                 self._request_abort()
             return False
         # print(f"Managed to lock {self.lock_id}")
-        self._remove_abort_request()
+        self._hold(lock_file)
         return True
 
+    def _hold(self, lock_file):
+        self.lock_file = lock_file
+        self.lost = False
+        self._remove_abort_request()
+
     def _get_flags(self):
         if self.exclusive:
-            return portalocker.LOCK_NB | portalocker.LOCK_EX
-        else:
-            return portalocker.LOCK_NB | portalocker.LOCK_SH
+            return portalocker.LOCK_EX | portalocker.LOCK_NB
+        return portalocker.LOCK_SH | portalocker.LOCK_NB
 
     def _unlock(self):
-        self.lock.release()
+        portalocker.unlock(self.lock_file)
+        self.lock_file.close()
 
     def _remove_abort_request(self):
-        if self.abort_requested():
+        try:
             os.remove(self._get_abort_request_file_name())
+        except FileNotFoundError:
+            pass
 
     def _request_abort(self):
         print(f"{self.lock_creator} is requesting abort")
-        if not os.path.exists(ABORT_REQUEST_DIR):
-            os.mkdir(ABORT_REQUEST_DIR)
+        os.makedirs(ABORT_REQUEST_DIR, exist_ok=True)
         open(self._get_abort_request_file_name(), "w").close()
+
+
+class ManagedLock:
+    """Lock on one or more nodes that is held by the lock manager
+    for as long as the connection to it is open.
+    """
+
+    def __init__(
+        self,
+        nodes,
+        lock_creator=None,
+        acquisition_timeout=0,
+        high_priority=False,
+    ):
+        self.nodes = nodes
+        self.lock_creator = lock_creator or "Unknown"
+        self.acquisition_timeout = acquisition_timeout
+        self.high_priority = high_priority
+
+    def __enter__(self):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(_lock_manager_socket)
+        self.reader = self.connection.makefile("r")
+        self.aborted = threading.Event()
+        self.replies = queue.Queue()
+        self._send(
+            op="acquire",
+            nodes=self.nodes,
+            high_priority=self.high_priority,
+            timeout=self.acquisition_timeout,
+            creator=self.lock_creator,
+        )
+        if not self._read_reply()["granted"]:
+            self._close()
+            raise NodeLockedException
+        # Abort requests are pushed by the lock manager at any time
+        threading.Thread(target=self._listen, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._close()
+
+    def abort_requested(self):
+        return self.aborted.is_set()
+
+    def upgrade(self):
+        """Makes the lock on the leaf, the last node, exclusive without
+        letting go of it. Shared intention locks on the other nodes are
+        turned into intention locks for an exclusive lock first.
+        """
+        for index, (node, mode) in enumerate(self.nodes):
+            if index == len(self.nodes) - 1:
+                new_mode = X
+            elif mode == IS:
+                new_mode = IX
+            else:
+                continue
+            self._send(
+                op="convert",
+                node=node,
+                mode=new_mode,
+                timeout=self.acquisition_timeout,
+            )
+            if not self.replies.get()["granted"]:
+                raise NodeLockedException
+            self.nodes[index] = (node, new_mode)
+
+    def _send(self, **message):
+        self.connection.sendall(json.dumps(message).encode() + b"\n")
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Lock manager closed the connection")
+        return json.loads(line)
+
+    def _listen(self):
+        try:
+            while True:
+                message = self._read_reply()
+                if message.get("abort"):
+                    self.aborted.set()
+                else:
+                    self.replies.put(message)
+        except (ConnectionError, OSError, ValueError):
+            # Not waiting for a reply anymore once the lock is released
+            self.replies.put({"granted": False})
+
+    def _close(self):
+        # Shutting down wakes up the listener thread
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.reader.close()
+        self.connection.close()
+
@@ -1,4 +1,3 @@
-
 from fuse import FUSE
 
 
@@ -6,17 +5,40 @@ from .operations import Filesystem
 from .cache import Cache
 from .cache_management.balancer import Balancer
 from .cache_management.ranker import Ranker
-from .b2_api import FileAPI
+from .b2_api import (
+    FileAPI,
+    LARGE_FILE_THRESHOLD,
+    PART_SIZE,
+    UPLOAD_CONCURRENCY,
+)
 from .deleter import Deleter
 from .cleaner import Cleaner
-from .events import get_rabbitmq
-
+from .events import (
+    connect,
+    SynchronizedChannel,
+    use_local_transport,
+    use_event_journal,
+    BackgroundPublisher,
+    CoalescingChannel,
+    FileAccessEvent,
+    FileUpdateOrCreateEvent,
+)
+from .lock_manager import LockManager
+from . import locking
+from .state_store import import_sidecar_files
+from .globals import ANTI_COLLISION_HASH
+
+import os
 import multiprocessing
 
 
 from .config_utils import get_config, parse_args
 
 TARGET_DISK_USAGE = 0.001  # GB
+LOCK_MANAGER_SOCKET = "/tmp/zero-lock-manager.sock"
+LOCAL_EVENTS_DIRECTORY = "/tmp/zero-events/"
+# Contains the anti collision hash, so it is not listed in the mount
+EVENT_JOURNAL_DIRECTORY = f".{ANTI_COLLISION_HASH}_events"
 
 
 def main():
@@ -24,11 +46,31 @@ def main():
     args = parse_args()
     config = get_config()
 
+    # Caches that were written by earlier versions keep
+    # the state of each file in files next to it.
+    import_sidecar_files(args.cache_folder)
+
+    # The socket is bound before forking, so that the other processes
+    # can connect to it right away.
+    lock_manager_server = LockManager(LOCK_MANAGER_SOCKET)
+    lock_manager = multiprocessing.Process(
+        name="lock_manager", target=lock_manager_server.serve_forever
+    )
+    locking.use_lock_manager(LOCK_MANAGER_SOCKET)
+    if args.local_events:
+        use_local_transport(LOCAL_EVENTS_DIRECTORY)
+    if args.event_journal:
+        use_event_journal(
+            os.path.join(args.cache_folder, EVENT_JOURNAL_DIRECTORY)
+        )
+
     fuse = multiprocessing.Process(
         name="fuse", target=fuse_main, args=(args, config)
     )
     ranker_watcher = multiprocessing.Process(
-        name="ranker_watcher", target=ranker_events_watcher, args=(args, config)
+        name="ranker_watcher",
+        target=ranker_events_watcher,
+        args=(args, config),
     )
 
     # ranker_scanner = multiprocessing.Process(
@@ -47,6 +89,7 @@ def main():
         name="cleaner", target=clean_watcher, args=(args, config)
     )
 
+    lock_manager.start()
     fuse.start()
     deleter.start()
     cleaner.start()
@@ -55,53 +98,70 @@ def main():
     balancer.start()
 
 
-def fuse_main(args, config):
-    print("Starting fuse main")
-    _, events_channel = get_rabbitmq()
-    api = FileAPI(
+def get_file_api(config):
+    return FileAPI(
         account_id=config["accountId"],
         application_key=config["applicationKey"],
         bucket_id=config["bucketId"],
         db_file=config["sqliteFileLocation"],
+        large_file_threshold=config.get(
+            "largeFileThreshold", LARGE_FILE_THRESHOLD
+        ),
+        part_size=config.get("uploadPartSize", PART_SIZE),
+        upload_concurrency=config.get("uploadConcurrency", UPLOAD_CONCURRENCY),
+        content_addressed=config.get("contentAddressed", False),
+        compression=config.get("compression", False),
+        pack_small_files=config.get("packSmallFiles", False),
     )
+
+
+def fuse_main(args, config):
+    print("Starting fuse main")
+    # Fuse operations never wait for the broker
+    events_channel = BackgroundPublisher()
+    # Writes and reads produce the same events over and over
+    events_channel = CoalescingChannel(
+        events_channel,
+        topics=(FileAccessEvent.topic, FileUpdateOrCreateEvent.topic),
+    )
+    api = get_file_api(config)
     cache = Cache(
-        cache_folder=args.cache_folder, api=api, events_channel=events_channel
+        cache_folder=args.cache_folder,
+        api=api,
+        events_channel=events_channel,
+        progressive_hydration=args.progressive_hydration,
+        attribute_timeout=args.attribute_timeout,
     )
     filesystem = Filesystem(cache)
     FUSE(
         filesystem,
         args.mountpoint,
-        nothreads=True,
+        nothreads=not args.multithreaded,
         foreground=True,
         big_writes=True,
+        attr_timeout=args.attribute_timeout,
+        entry_timeout=args.attribute_timeout,
+        negative_timeout=args.attribute_timeout,
     )
 
 
 def clean_watcher(args, config):
     print("Starting cleaner")
 
-    api = FileAPI(
-        account_id=config["accountId"],
-        application_key=config["applicationKey"],
-        bucket_id=config["bucketId"],
-        db_file=config["sqliteFileLocation"],
-    )
+    api = get_file_api(config)
 
-    cleaner = Cleaner(cache_folder=args.cache_folder, api=api)
+    cleaner = Cleaner(
+        cache_folder=args.cache_folder, api=api, workers=args.upload_workers
+    )
     cleaner.run_watcher()
 
 
 def delete_watcher(args, config):
     print("Starting deleter")
 
-    api = FileAPI(
-        account_id=config["accountId"],
-        application_key=config["applicationKey"],
-        bucket_id=config["bucketId"],
-        db_file=config["sqliteFileLocation"],
-    )
+    api = get_file_api(config)
 
-    deleter = Deleter(api=api)
+    deleter = Deleter(api=api, workers=args.delete_workers)
     deleter.run_watcher()
 
 
@@ -123,21 +183,20 @@ def ranker_scanner(args, config):
 
 def run_balancer(args, config):
     print("Starting balancer")
-    _, events_channel = get_rabbitmq()
-    api = FileAPI(
-        account_id=config["accountId"],
-        application_key=config["applicationKey"],
-        bucket_id=config["bucketId"],
-        db_file=config["sqliteFileLocation"],
-    )
+    _, events_channel = connect()
+    api = get_file_api(config)
     cache = Cache(
-        cache_folder=args.cache_folder, api=api, events_channel=events_channel
+        cache_folder=args.cache_folder,
+        api=api,
+        # The files are primed from several threads
+        events_channel=SynchronizedChannel(events_channel),
     )
     balancer = Balancer(
         cache=cache,
         api=api,
         target_disk_usage=TARGET_DISK_USAGE,
         db_file=config["sqliteFileLocation"],
+        priming_workers=args.priming_workers,
     )
     balancer.run()
 
@@ -1,8 +1,6 @@
-import os
-from datetime import datetime
-import json
-from .path_converter import PathConverter
-from .globals import ANTI_COLLISION_HASH
+import time
+import threading
+from .state_store import get_state_store, now
 
 
 class TIMES:
@@ -11,89 +9,107 @@ class TIMES:
     CTIME = "ctime"
 
 
-# TODO: Add other metadata? Or is some of it stored via the dummy?:
-
-#             "st_gid",
-#             "st_mode",
-#             "st_nlink",
-#             "st_size",
-#             "st_uid",
-
-
-APPENDIX = "METADATA"
+# Like relatime: the atime is only updated if it is not newer
+# than the mtime or ctime, or if it is older than this.
+RELATIME_THRESHOLD = 24 * 60 * 60  # seconds
+# Times and sizes of files that are being written are
+# written to the state store at least this often.
+FLUSH_INTERVAL = 5  # seconds
 
 
 class MetaData:
 
     def __init__(self, cache_folder):
-        self.path_converter = PathConverter(cache_folder)
+        self.store = get_state_store(cache_folder)
 
     """Stores meta data about the file such as file access times."""
 
     # TODO: These hooks need to get called in more places.
     def record_content_modification(self, path):
-        cache_path = self.path_converter.to_cache_path(path)
-        self._record_change(cache_path)
-        self._record_modification(cache_path)
-        self._record_access(cache_path)
+        self.store.touch(path, TIMES.CTIME, TIMES.MTIME, TIMES.ATIME)
 
     def record_access(self, path):
-        cache_path = self.path_converter.to_cache_path(path)
-        self._record_access(cache_path)
-
-    def _record_access(self, cache_path):
-        """Sets the atime"""
-        self._set_to_now(cache_path, TIMES.ATIME)
-
-    def _record_modification(self, cache_path):
-        """Sets the mtime"""
-        self._set_to_now(cache_path, TIMES.MTIME)
-
-    def _record_change(self, cache_path):
-        """Sets the ctime"""
-        self._set_to_now(cache_path, TIMES.CTIME)
+        """Sets the atime if it is due. Returns True if it was set."""
+        entry = self.store.get(path)
+        if entry is None:
+            return False
+        atime = entry[TIMES.ATIME]
+        if (
+            atime > entry[TIMES.MTIME]
+            and atime > entry[TIMES.CTIME]
+            and now() - atime < RELATIME_THRESHOLD
+        ):
+            return False
+        return self.store.touch(path, TIMES.ATIME)
 
     def get_access_time(self, path):
-        cache_path = self.path_converter.to_cache_path(path)
-        return self._get_time(cache_path, TIMES.ATIME)
+        return self.store.get_value(path, TIMES.ATIME)
 
     def get_modification_time(self, path):
-        cache_path = self.path_converter.to_cache_path(path)
-        return self._get_time(cache_path, TIMES.MTIME)
+        return self.store.get_value(path, TIMES.MTIME)
 
     def get_change_time(self, path):
-        cache_path = self.path_converter.to_cache_path(path)
-        return self._get_time(cache_path, TIMES.CTIME)
+        return self.store.get_value(path, TIMES.CTIME)
 
     def delete(self, path):
-        cache_path = self.path_converter.to_cache_path(path)
-        return os.remove(_metadata_cache_path_from_cache_path(cache_path))
-
-    def _get_time(self, cache_path, property: TIMES):
-        with open(
-            _metadata_cache_path_from_cache_path(cache_path), "r"
-        ) as metadata_file:
-            return json.load(metadata_file)[property]
-
-    def create(self, cache_path):
-        with open(
-            _metadata_cache_path_from_cache_path(cache_path), "w"
-        ) as metadata_file:
-            data = {
-                TIMES.CTIME: datetime.now().timestamp(),
-                TIMES.MTIME: datetime.now().timestamp(),
-                TIMES.ATIME: datetime.now().timestamp(),
-            }
-            json.dump(data, metadata_file)
-
-    def _set_to_now(self, cache_path: str, property: TIMES):
-        metadata_path = _metadata_cache_path_from_cache_path(cache_path)
-        with open(metadata_path, "r") as metadata_file:
-            data = json.load(metadata_file)
-        data[property] = datetime.now().timestamp()
-        with open(metadata_path, "w") as metadata_file:
-            json.dump(data, metadata_file)
-
-
-def _metadata_cache_path_from_cache_path(cache_path):
-    return f"{cache_path}_{ANTI_COLLISION_HASH}_{APPENDIX}"
+        self.store.delete(path)
+
+
+class WriteBuffer:
+    """Keeps the times and sizes of files that are being written in memory,
+    so that not every write has to update the state store.
+
+    The first write to a file goes to the store right away, which
+    marks the file as dirty. Later writes are collected and flushed
+    on release and fsync, and by a background thread.
+    """
+
+    def __init__(self, store, flush_interval=FLUSH_INTERVAL):
+        self.store = store
+        self.flush_interval = flush_interval
+        # path -> (time of the last write, end of the file)
+        self.pending = {}
+        self.lock = threading.Lock()
+        threading.Thread(
+            target=self._flush_periodically, name="write buffer", daemon=True
+        ).start()
+
+    def record_write(self, path, end):
+        with self.lock:
+            entry = self.pending.get(path)
+            if entry is not None:
+                self.pending[path] = (now(), max(entry[1], end))
+                return
+            self.pending[path] = (now(), end)
+            self.store.record_write(path, end)
+
+    def get(self, path):
+        """Returns the time of the last write and the
+        end of the file, or None if nothing is pending.
+        """
+        with self.lock:
+            return self.pending.get(path)
+
+    def flush(self, path):
+        # The store is updated under the lock, so that a flush cannot
+        # overtake a truncate that follows it.
+        with self.lock:
+            entry = self.pending.pop(path, None)
+            if entry is not None:
+                timestamp, end = entry
+                self.store.record_write(path, end, timestamp=timestamp)
+
+    def discard(self, path):
+        with self.lock:
+            self.pending.pop(path, None)
+
+    def flush_all(self):
+        with self.lock:
+            paths = list(self.pending)
+        for path in paths:
+            self.flush(path)
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush_all()
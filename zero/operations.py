@@ -29,13 +29,11 @@ class Filesystem(Operations):
         print("getattr", path)
         return self.cache.getattributes(path)
 
-    @on_cache_path_or_dummy
     def chmod(self, path, mode):
-        return os.chmod(path, mode)
+        return self.cache.chmod(path, mode)
 
-    @on_cache_path_or_dummy
     def chown(self, path, uid, gid):
-        return os.chown(path, uid, gid)
+        return self.cache.chown(path, uid, gid)
 
     getxattr = None
 
@@ -61,10 +59,11 @@ class Filesystem(Operations):
 
     def release(self, path, fh):
         print("release", path, fh)
-        return os.close(fh)
+        return self.cache.release(path, fh)
 
     def flush(self, path, fh):
         print("flush", path, fh)
+        self.cache.flush_metadata(path)
         return os.fsync(fh)
 
     def fsync(self, path, datasync, fh):
@@ -72,6 +71,7 @@ class Filesystem(Operations):
         # for it happened, right?
         # Or am I safe if I just upload *closed* files?
         print("fsync", path, fh)
+        self.cache.flush_metadata(path)
         if datasync != 0:
             return os.fdatasync(fh)
         else:
@@ -95,9 +95,8 @@ class Filesystem(Operations):
     def readlink(self, path):
         return os.readlink(path)
 
-    @on_cache_path
     def symlink(self, path, target):
-        return os.symlink(target, path)
+        return self.cache.symlink(path, target)
 
     def truncate(self, path, length, fh=None):
         return self.cache.truncate(path, length)
@@ -0,0 +1,98 @@
+import time
+import logging
+import threading
+from multiprocessing import current_process
+from .b2_api import PACK_SIZE
+
+log = logging.getLogger(current_process().name)
+
+# A pack is uploaded at the latest this long after its first file was
+# added, even if it is not full.
+PACKING_DELAY = 5  # seconds
+
+
+class Packer:
+    """Collects small files and uploads them together, in a thread
+    of its own, once they add up to `pack_size` bytes or the first of
+    them has waited for `delay` seconds.
+
+    A path that is added again before its pack is uploaded replaces
+    the earlier version. `on_packed` is called with the members of
+    each uploaded pack, `on_failure` with those of a pack that could
+    not be uploaded. Members are (path, file_uuid, data).
+    """
+
+    def __init__(
+        self,
+        upload_pack,
+        on_packed,
+        on_failure,
+        pack_size=PACK_SIZE,
+        delay=PACKING_DELAY,
+    ):
+        """`upload_pack` takes a list of (file_uuid, data, file_name)"""
+        self.upload_pack = upload_pack
+        self.on_packed = on_packed
+        self.on_failure = on_failure
+        self.pack_size = pack_size
+        self.delay = delay
+        # path -> (file_uuid, data), in the order in which they came
+        self.pending = {}
+        self.pending_size = 0
+        # When the oldest of the pending files was added
+        self.pending_since = None
+        self.condition = threading.Condition()
+        threading.Thread(target=self._work, name="packer", daemon=True).start()
+
+    def add(self, path, file_uuid, data):
+        with self.condition:
+            replaced = self.pending.pop(path, None)
+            if replaced is not None:
+                self.pending_size -= len(replaced[1])
+            self.pending[path] = (file_uuid, data)
+            self.pending_size += len(data)
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+            self.condition.notify_all()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.pending)
+
+    def _take_pack(self):
+        """Waits until a pack is due and returns its members"""
+        with self.condition:
+            while True:
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+                wait = self.pending_since + self.delay - time.monotonic()
+                if self.pending_size >= self.pack_size or wait <= 0:
+                    break
+                self.condition.wait(wait)
+            members = [
+                (path, file_uuid, data)
+                for path, (file_uuid, data) in self.pending.items()
+            ]
+            self.pending = {}
+            self.pending_size = 0
+            self.pending_since = None
+            return members
+
+    def _work(self):
+        while True:
+            members = self._take_pack()
+            try:
+                self.upload_pack(
+                    [
+                        (file_uuid, data, path)
+                        for path, file_uuid, data in members
+                    ]
+                )
+            except Exception:
+                log.exception(
+                    f"Could not upload a pack of {len(members)} files"
+                )
+                self.on_failure(members)
+                continue
+            self.on_packed(members)
@@ -1,38 +1,21 @@
 from uuid import uuid4
-import json
-import os
-from .path_converter import PathConverter
-from .globals import ANTI_COLLISION_HASH
-
-
-FILENAME_APPENDIX = "UUID"
+from .state_store import get_state_store
 
 
 class RemoteIdentifiers:
 
     def __init__(self, cache_folder):
-        self.path_converter = PathConverter(cache_folder)
+        self.store = get_state_store(cache_folder)
 
     @staticmethod
     def generate_uuid():
         return str(uuid4())
 
     def get_uuid_or_none(self, path):
-        try:
-            with open(self._uuid_path_from_fuse_path(path), "r") as uuid_file:
-                return json.load(uuid_file)
-        except IOError:
-            # TODO: Make sure that we really only
-            # catch the case where the file does not exist
-            return None
+        return self.store.get_value(path, "uuid")
 
     def set_uuid(self, path, uuid):
-        with open(self._uuid_path_from_fuse_path(path), "w") as uuid_file:
-            json.dump(uuid, uuid_file)
+        self.store.set_value(path, "uuid", uuid)
 
     def delete(self, path):
-        os.remove(self._uuid_path_from_fuse_path(path))
-
-    def _uuid_path_from_fuse_path(self, path):
-        cache_path = self.path_converter.to_cache_path(path)
-        return f"{cache_path}_{ANTI_COLLISION_HASH}_{FILENAME_APPENDIX}"
+        self.store.set_value(path, "uuid", None)
@@ -0,0 +1,470 @@
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from .globals import ANTI_COLLISION_HASH
+from .path_converter import PathConverter
+
+
+class STATES:
+    CLEAN = "CLEAN"
+    DIRTY = "DIRTY"
+    REMOTE = "REMOTE"
+
+
+# The file name contains the anti collision hash, so that the
+# database (and the files that sqlite creates next to it) are not listed.
+DB_FILE_NAME = f".{ANTI_COLLISION_HASH}_state.db"
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_state_store(cache_folder):
+    """Returns the state store of the cache folder for this process.
+    sqlite connections must not be shared with forked processes,
+    so every process opens its own.
+    """
+    key = (os.getpid(), cache_folder)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = StateStore(cache_folder)
+        return _stores[key]
+
+
+def now():
+    return datetime.now().timestamp()
+
+
+class StateStore:
+    """Everything that zero knows about a file, keyed by its fuse path:
+    state, remote uuid, times, size, mode and owner.
+    Directories and symlinks are not in the store.
+
+    The database is in WAL mode, so that the workers can read while
+    the fuse process writes. It is safe to share between the threads
+    of a process, access is serialized by the lock.
+    """
+
+    def __init__(self, cache_folder):
+        self.connection = sqlite3.connect(
+            os.path.join(cache_folder, DB_FILE_NAME),
+            timeout=30,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # Durable enough in WAL mode: a crash of the machine can lose
+            # the last transactions, but does not corrupt the database.
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    uuid TEXT,
+                    atime REAL NOT NULL,
+                    mtime REAL NOT NULL,
+                    ctime REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    mode INTEGER NOT NULL,
+                    uid INTEGER NOT NULL,
+                    gid INTEGER NOT NULL
+                )""")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS files_by_uuid ON files (uuid)"
+            )
+            self._create_totals()
+
+    def _create_totals(self):
+        """Number and bytes of the files in each state, kept up to date
+        by triggers, so that the size of the cache is known without
+        walking the cache folder. The index on (state, size) answers
+        the question for the biggest file in a state.
+        """
+        is_new = not self.connection.execute("""SELECT 1 FROM sqlite_master
+            WHERE type = 'table' AND name = 'totals'""").fetchone()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS totals (
+                    state TEXT PRIMARY KEY,
+                    files INTEGER NOT NULL,
+                    bytes INTEGER NOT NULL
+                )""")
+            self.connection.execute(
+                """CREATE INDEX IF NOT EXISTS files_by_state_and_size
+                ON files (state, size)"""
+            )
+            self.connection.execute("""CREATE TRIGGER IF NOT EXISTS
+                totals_after_insert AFTER INSERT ON files BEGIN
+                    UPDATE totals SET files = files + 1,
+                    bytes = bytes + NEW.size WHERE state = NEW.state;
+                END""")
+            self.connection.execute("""CREATE TRIGGER IF NOT EXISTS
+                totals_after_delete AFTER DELETE ON files BEGIN
+                    UPDATE totals SET files = files - 1,
+                    bytes = bytes - OLD.size WHERE state = OLD.state;
+                END""")
+            self.connection.execute("""CREATE TRIGGER IF NOT EXISTS
+                totals_after_update AFTER UPDATE OF state, size ON files
+                BEGIN
+                    UPDATE totals SET files = files - 1,
+                    bytes = bytes - OLD.size WHERE state = OLD.state;
+                    UPDATE totals SET files = files + 1,
+                    bytes = bytes + NEW.size WHERE state = NEW.state;
+                END""")
+            for state in (STATES.CLEAN, STATES.DIRTY, STATES.REMOTE):
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO totals VALUES (?, 0, 0)", (state,)
+                )
+            if is_new:
+                # The files table may be from before there were totals
+                self.connection.execute("""UPDATE totals SET
+                    files = (SELECT COUNT(*) FROM files
+                        WHERE files.state = totals.state),
+                    bytes = (SELECT COALESCE(SUM(size), 0) FROM files
+                        WHERE files.state = totals.state)""")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def _execute(self, query, parameters=()):
+        with self.lock:
+            return self.connection.execute(query, parameters)
+
+    def _transaction(self, statements):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                cursors = [
+                    self.connection.execute(query, parameters)
+                    for query, parameters in statements
+                ]
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+        return cursors
+
+    def add(self, path, stat, state, uuid=None, times=None):
+        """Inserts the file, taking size, mode and owner from `stat`.
+        If the path is already known, its remote uuid is kept, so that
+        the old version can still be deleted from the remote.
+        """
+        atime, mtime, ctime = times or (now(), now(), now())
+        self._execute(
+            """INSERT INTO files
+            (path, state, uuid, atime, mtime, ctime, size, mode, uid, gid)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET
+            state = excluded.state,
+            uuid = COALESCE(excluded.uuid, uuid),
+            atime = excluded.atime,
+            mtime = excluded.mtime,
+            ctime = excluded.ctime,
+            size = excluded.size,
+            mode = excluded.mode,
+            uid = excluded.uid,
+            gid = excluded.gid""",
+            (
+                path,
+                state,
+                uuid,
+                atime,
+                mtime,
+                ctime,
+                stat.st_size,
+                stat.st_mode,
+                stat.st_uid,
+                stat.st_gid,
+            ),
+        )
+
+    def adopt(self, path, cache_path):
+        """Adds a file that was put into the cache folder without
+        going through fuse. It is considered clean.
+        """
+        stat = os.lstat(cache_path)
+        self._execute(
+            """INSERT OR IGNORE INTO files
+            (path, state, uuid, atime, mtime, ctime, size, mode, uid, gid)
+            VALUES (?, ?, NULL, ?, ?, ?, ?, ?, ?, ?)""",
+            (
+                path,
+                STATES.CLEAN,
+                stat.st_atime,
+                stat.st_mtime,
+                stat.st_ctime,
+                stat.st_size,
+                stat.st_mode,
+                stat.st_uid,
+                stat.st_gid,
+            ),
+        )
+
+    def get(self, path):
+        cursor = self._execute(
+            """SELECT state, uuid, atime, mtime, ctime, size, mode, uid, gid
+            FROM files WHERE path = ?""",
+            (path,),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(
+            zip(
+                (
+                    "state",
+                    "uuid",
+                    "atime",
+                    "mtime",
+                    "ctime",
+                    "size",
+                    "mode",
+                    "uid",
+                    "gid",
+                ),
+                row,
+            )
+        )
+
+    def get_value(self, path, column):
+        cursor = self._execute(
+            f"SELECT {column} FROM files WHERE path = ?", (path,)
+        )
+        row = cursor.fetchone()
+        return row and row[0]
+
+    def set_value(self, path, column, value):
+        self._execute(
+            f"UPDATE files SET {column} = ? WHERE path = ?", (value, path)
+        )
+
+    def set_mode_and_owner(self, path, stat):
+        self._execute(
+            """UPDATE files SET mode = ?, uid = ?, gid = ?, ctime = ?
+            WHERE path = ?""",
+            (stat.st_mode, stat.st_uid, stat.st_gid, now(), path),
+        )
+
+    def touch(self, path, *columns):
+        """Sets the given time columns to now.
+        Returns False if the path is not in the store.
+        """
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        cursor = self._execute(
+            f"UPDATE files SET {assignments} WHERE path = ?",
+            (*(now() for _ in columns), path),
+        )
+        return cursor.rowcount > 0
+
+    def record_write(self, path, end, timestamp=None):
+        """Bookkeeping for writes that ended at byte `end`:
+        the times, the size and the dirty state in one statement.
+        """
+        timestamp = timestamp or now()
+        self._execute(
+            """UPDATE files SET
+            atime = ?, mtime = ?, ctime = ?, size = MAX(size, ?),
+            state = CASE WHEN state = ? THEN ? ELSE state END
+            WHERE path = ?""",
+            (
+                timestamp,
+                timestamp,
+                timestamp,
+                end,
+                STATES.CLEAN,
+                STATES.DIRTY,
+                path,
+            ),
+        )
+
+    def record_truncate(self, path, length):
+        timestamp = now()
+        self._execute(
+            """UPDATE files SET
+            atime = ?, mtime = ?, ctime = ?, size = ?,
+            state = CASE WHEN state = ? THEN ? ELSE state END
+            WHERE path = ?""",
+            (
+                timestamp,
+                timestamp,
+                timestamp,
+                length,
+                STATES.CLEAN,
+                STATES.DIRTY,
+                path,
+            ),
+        )
+
+    def transition(self, path, from_state, to_state):
+        """Returns False if the file was not in `from_state`"""
+        cursor = self._execute(
+            "UPDATE files SET state = ? WHERE path = ? AND state = ?",
+            (to_state, path, from_state),
+        )
+        return cursor.rowcount > 0
+
+    def get_resident_size(self):
+        """Bytes of the files whose content is in the cache folder"""
+        cursor = self._execute(
+            "SELECT SUM(bytes) FROM totals WHERE state IN (?, ?)",
+            (STATES.CLEAN, STATES.DIRTY),
+        )
+        return cursor.fetchone()[0] or 0
+
+    def get_biggest_resident_size(self):
+        # One lookup in the index per state
+        sizes = [
+            self._execute(
+                "SELECT MAX(size) FROM files WHERE state = ?", (state,)
+            ).fetchone()[0]
+            or 0
+            for state in (STATES.CLEAN, STATES.DIRTY)
+        ]
+        return max(sizes)
+
+    def get_clean_path(self, uuid):
+        """Returns the path of the clean file that was uploaded as `uuid`,
+        which means that the cache has its content, or None.
+        """
+        cursor = self._execute(
+            "SELECT path FROM files WHERE uuid = ? AND state = ?",
+            (uuid, STATES.CLEAN),
+        )
+        row = cursor.fetchone()
+        return row and row[0]
+
+    def get_paths_in_state(self, state):
+        cursor = self._execute(
+            "SELECT path FROM files WHERE state = ?", (state,)
+        )
+        return [path for (path,) in cursor.fetchall()]
+
+    def get_uuids(self, paths):
+        """Returns the uuids of those of `paths` that have one"""
+        uuids = {}
+        for start in range(0, len(paths), 500):
+            chunk = paths[start : start + 500]
+            cursor = self._execute(
+                f"""SELECT path, uuid FROM files WHERE uuid IS NOT NULL
+                AND path IN ({", ".join("?" * len(chunk))})""",
+                chunk,
+            )
+            uuids.update(cursor.fetchall())
+        return uuids
+
+    def get_used_uuids(self, uuids):
+        """Returns the set of those of `uuids` that a path refers to"""
+        used = set()
+        for start in range(0, len(uuids), 500):
+            chunk = uuids[start : start + 500]
+            cursor = self._execute(
+                f"""SELECT uuid FROM files
+                WHERE uuid IN ({", ".join("?" * len(chunk))})""",
+                chunk,
+            )
+            used.update(uuid for (uuid,) in cursor.fetchall())
+        return used
+
+    def get_sizes(self, paths, state):
+        """Returns the sizes of those of `paths` that are in `state`"""
+        sizes = {}
+        # Stay well below the limit on the number of sql variables
+        for start in range(0, len(paths), 500):
+            chunk = paths[start : start + 500]
+            cursor = self._execute(
+                f"""SELECT path, size FROM files WHERE state = ?
+                AND path IN ({", ".join("?" * len(chunk))})""",
+                (state, *chunk),
+            )
+            sizes.update(cursor.fetchall())
+        return sizes
+
+    def delete(self, path):
+        self._execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def move(self, old_path, new_path):
+        """Moves a file, or all files below a directory, in one transaction.
+        Whatever was stored at the new path is replaced.
+        """
+        old_prefix = old_path.rstrip("/") + "/"
+        new_prefix = new_path.rstrip("/") + "/"
+        self._transaction(
+            [
+                (
+                    """DELETE FROM files WHERE path = ?
+                    OR substr(path, 1, ?) = ?""",
+                    (new_path, len(new_prefix), new_prefix),
+                ),
+                (
+                    "UPDATE files SET path = ? WHERE path = ?",
+                    (new_path, old_path),
+                ),
+                (
+                    """UPDATE files SET path = ? || substr(path, ?)
+                    WHERE substr(path, 1, ?) = ?""",
+                    (
+                        new_prefix,
+                        len(old_prefix) + 1,
+                        len(old_prefix),
+                        old_prefix,
+                    ),
+                ),
+            ]
+        )
+
+
+# Suffixes of the files in which the state used to be kept
+# next to each file in the cache folder.
+_SIDECAR_METADATA = f"_{ANTI_COLLISION_HASH}_METADATA"
+_SIDECAR_DIRTY = f"{ANTI_COLLISION_HASH}_DIRTY"
+_SIDECAR_UUID = f"_{ANTI_COLLISION_HASH}_UUID"
+
+
+def import_sidecar_files(cache_folder):
+    """Moves the state of a cache folder from the old per-file
+    sidecar files into the state store.
+    """
+    store = get_state_store(cache_folder)
+    converter = PathConverter(cache_folder)
+    for directory, _, file_names in os.walk(cache_folder):
+        for file_name in file_names:
+            if ANTI_COLLISION_HASH in file_name:
+                continue
+            item = os.path.join(directory, file_name)
+            cache_path = converter.strip_dummy_ending(item)
+            metadata_path = cache_path + _SIDECAR_METADATA
+            if not os.path.exists(metadata_path):
+                continue
+            with open(metadata_path) as metadata_file:
+                metadata = json.load(metadata_file)
+            uuid = None
+            if os.path.exists(cache_path + _SIDECAR_UUID):
+                with open(cache_path + _SIDECAR_UUID) as uuid_file:
+                    uuid = json.load(uuid_file)
+            if cache_path != item:
+                # The size of remote files was not recorded
+                state = STATES.REMOTE
+            elif os.path.exists(cache_path + _SIDECAR_DIRTY):
+                state = STATES.DIRTY
+            else:
+                state = STATES.CLEAN
+            store.add(
+                converter.to_fuse_path(cache_path),
+                os.lstat(item),
+                state,
+                uuid=uuid,
+                times=(
+                    metadata["atime"],
+                    metadata["mtime"],
+                    metadata["ctime"],
+                ),
+            )
+            for sidecar in (_SIDECAR_METADATA, _SIDECAR_DIRTY, _SIDECAR_UUID):
+                try:
+                    os.remove(cache_path + sidecar)
+                except FileNotFoundError:
+                    pass
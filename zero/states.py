@@ -1,6 +1,5 @@
 import os
-from .dirty_flags import DirtyFlags
-from .remote_identifiers import RemoteIdentifiers
+from .state_store import get_state_store, STATES
 from .path_converter import PathConverter
 
 
@@ -9,11 +8,10 @@ class WrongInitialStateException(Exception):
 
 
 class StateMachine:
-    """ This class is NOT thread safe. We assume that the path has write-locked (or is a read lock enough?)"""
+    """This class is NOT thread safe. We assume that the path has write-locked (or is a read lock enough?)"""
 
     def __init__(self, cache_folder):
-        self.remote_identifiers = RemoteIdentifiers(cache_folder)
-        self.dirty_flags = DirtyFlags(cache_folder)
+        self.store = get_state_store(cache_folder)
         self.path_converter = PathConverter(cache_folder)
 
     def dirty_or_clean_to_dirty(self, path):
@@ -23,24 +21,23 @@ class StateMachine:
             self.clean_to_dirty(path)
 
     def clean_to_dirty(self, path):
-        if not self.current_state_is_clean(path):
-            raise WrongInitialStateException("State should be clean but is not")
-        self.dirty_flags.set_dirty_flag(path=path)
+        self._transition(path, STATES.CLEAN, STATES.DIRTY)
 
     def dirty_to_clean(self, path):
-        if not self.current_state_is_dirty(path):
-            raise WrongInitialStateException("State should be dirty but is not")
-        self.dirty_flags.remove_dirty_flag(path=path)
+        self._transition(path, STATES.DIRTY, STATES.CLEAN)
 
     def clean_to_remote(self, path):
         if not self.current_state_is_clean(path):
-            raise WrongInitialStateException("State should be clean but is not")
+            raise WrongInitialStateException(
+                "State should be clean but is not"
+            )
         cache_path = self.path_converter.to_cache_path(path)
         cache_dummy_path = self.path_converter.add_dummy_ending(cache_path)
         # Re-name to preserve file permissions, user id.
         os.rename(cache_path, cache_dummy_path)
         # Truncate
         open(cache_dummy_path, "w").close()
+        self._transition(path, STATES.CLEAN, STATES.REMOTE)
 
     def remote_to_clean(self, path):
         if not self.current_state_is_remote(path):
@@ -51,18 +48,31 @@ class StateMachine:
         cache_dummy_path = self.path_converter.add_dummy_ending(cache_path)
         # Re-name to preserve file permissions, user id.
         os.rename(cache_dummy_path, cache_path)
+        self._transition(path, STATES.REMOTE, STATES.CLEAN)
+
+    def _transition(self, path, from_state, to_state):
+        self._get_state(path)
+        if not self.store.transition(path, from_state, to_state):
+            raise WrongInitialStateException(
+                f"State should be {from_state.lower()} but is not"
+            )
+
+    def _get_state(self, path):
+        state = self.store.get_value(path, "state")
+        if state is None:
+            # Files that were put into the cache folder
+            # without going through fuse are clean.
+            cache_path = self.path_converter.to_cache_path(path)
+            if os.path.isfile(cache_path):
+                self.store.adopt(path, cache_path)
+                return STATES.CLEAN
+        return state
 
     def current_state_is_clean(self, path):
-        return (not self.current_state_is_dirty(path)) and (
-            not self.current_state_is_remote(path)
-        )
+        return self._get_state(path) == STATES.CLEAN
 
     def current_state_is_dirty(self, path):
-        return self.dirty_flags.has_dirty_flag(path)
+        return self._get_state(path) == STATES.DIRTY
 
     def current_state_is_remote(self, path):
-        return os.path.isfile(
-            self.path_converter.add_dummy_ending(
-                self.path_converter.to_cache_path(path)
-            )
-        )
+        return self._get_state(path) == STATES.REMOTE
@@ -0,0 +1,69 @@
+import unittest
+from zero.attribute_cache import AttributeCache
+
+ATTRIBUTES = {"st_size": 3}
+
+
+class AttributeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = AttributeCache(ttl=60)
+
+    def test_remembers_attributes_and_missing_paths(self):
+        self.cache.put("/dir/file", ATTRIBUTES, self.cache.generation)
+        self.cache.put_missing("/dir/other", self.cache.generation)
+        assert self.cache.get("/dir/file") == (True, ATTRIBUTES)
+        assert self.cache.get("/dir/other") == (True, None)
+        assert self.cache.get("/dir/unknown") == (False, None)
+
+    def test_invalidate_forgets_path_and_parent(self):
+        self.cache.put("/dir", ATTRIBUTES, self.cache.generation)
+        self.cache.put("/dir/file", ATTRIBUTES, self.cache.generation)
+        self.cache.put("/dir/other", ATTRIBUTES, self.cache.generation)
+        self.cache.invalidate("/dir/file")
+        assert self.cache.get("/dir") == (False, None)
+        assert self.cache.get("/dir/file") == (False, None)
+        assert self.cache.get("/dir/other") == (True, ATTRIBUTES)
+
+    def test_invalidate_tree_forgets_everything_below(self):
+        self.cache.put("/dir/sub/file", ATTRIBUTES, self.cache.generation)
+        self.cache.put("/directory", ATTRIBUTES, self.cache.generation)
+        self.cache.invalidate_tree("/dir")
+        assert self.cache.get("/dir/sub/file") == (False, None)
+        assert self.cache.get("/directory") == (True, ATTRIBUTES)
+
+    def test_lookup_that_overlapped_invalidation_is_not_cached(self):
+        generation = self.cache.generation
+        self.cache.invalidate("/dir/file")
+        self.cache.put("/dir/file", ATTRIBUTES, generation)
+        assert self.cache.get("/dir/file") == (False, None)
+
+    def test_entries_expire(self):
+        cache = AttributeCache(ttl=-1)
+        cache.put("/file", ATTRIBUTES, cache.generation)
+        assert cache.get("/file") == (False, None)
+
+    def test_invalidation_of_other_path_does_not_stop_lookup(self):
+        generation = self.cache.generation
+        self.cache.invalidate("/other/file")
+        self.cache.put("/dir/file", ATTRIBUTES, generation)
+        assert self.cache.get("/dir/file") == (True, ATTRIBUTES)
+
+    def test_lookup_that_overlapped_tree_invalidation_is_not_cached(self):
+        generation = self.cache.generation
+        self.cache.invalidate_tree("/dir")
+        self.cache.put("/dir/sub/file", ATTRIBUTES, generation)
+        assert self.cache.get("/dir/sub/file") == (False, None)
+
+    def test_forgotten_invalidations_stop_older_lookups(self):
+        from unittest.mock import patch
+
+        generation = self.cache.generation
+        with patch("zero.attribute_cache.MAX_INVALIDATED_PATHS", 2):
+            self.cache.invalidate("/dir/file")
+            self.cache.invalidate("/dir/other")
+        assert len(self.cache.invalidations) <= 2
+        self.cache.put("/dir/file", ATTRIBUTES, generation)
+        assert self.cache.get("/dir/file") == (False, None)
+        self.cache.put("/dir/file", ATTRIBUTES, self.cache.generation)
+        assert self.cache.get("/dir/file") == (True, ATTRIBUTES)
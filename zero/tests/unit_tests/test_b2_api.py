@@ -0,0 +1,432 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+from b2.part import Part
+from b2.exception import B2ConnectionError
+from zero.b2_api import (
+    choose_part_ranges,
+    FileAPI,
+    ChunkStore,
+    PackStore,
+    UploadAbortException,
+    MAX_NUMBER_OF_PARTS,
+    LARGE_FILE_THRESHOLD,
+    PART_SIZE,
+)
+from zero.b2_file_info_store import FileInfoStore
+from zero.compression import DecompressingStream
+from zero.chunking import AVERAGE_CHUNK_SIZE
+
+
+def random_bytes(length):
+    # Always the same bytes, so that the chunks are the same in every run
+    return random.Random(length).randbytes(length)
+
+
+class PartRangesTest(unittest.TestCase):
+
+    def test_parts_cover_file(self):
+        ranges = choose_part_ranges(content_length=250, part_size=100)
+        assert ranges == [(0, 100), (100, 100), (200, 50)]
+
+    def test_part_size_grows_for_huge_files(self):
+        content_length = 3 * MAX_NUMBER_OF_PARTS * 100
+        ranges = choose_part_ranges(content_length, part_size=100)
+        assert len(ranges) <= MAX_NUMBER_OF_PARTS
+        assert sum(length for _, length in ranges) == content_length
+
+
+def fake_bucket_api(bucket):
+    """Keeps the uploaded objects in `bucket`,
+    by name. The file id of an object is its name.
+    """
+    bucket_api = MagicMock()
+
+    def upload_bytes(data, file_name):
+        bucket[file_name] = data
+        file_info = MagicMock()
+        file_info.as_dict.return_value = {"fileId": file_name}
+        return file_info
+
+    def download_file_by_id(file_id, download_dest, range_=None):
+        data = bucket[file_id]
+        if range_ is not None:
+            data = data[range_[0] : range_[1] + 1]
+        download_dest.stream.write(data)
+
+    def delete_file_version(file_id, file_name):
+        del bucket[file_name]
+
+    bucket_api.upload_bytes.side_effect = upload_bytes
+    bucket_api.download_file_by_id.side_effect = download_file_by_id
+    bucket_api.delete_file_version.side_effect = delete_file_version
+    return bucket_api
+
+
+class ResumableUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.api = FileAPI.__new__(FileAPI)
+        self.api.large_file_threshold = 0
+        self.api.part_size = 5
+        self.api.upload_concurrency = 1
+        self.api.chunk_store = None
+        self.api.compression = False
+        self.api.api = MagicMock()
+        self.api.api.account_info.get_minimum_part_size.return_value = 5
+        self.api.api.session.finish_large_file.return_value = {
+            "fileId": "file id"
+        }
+        self.api.bucket_api = MagicMock()
+        self.api.bucket_api.start_large_file.return_value.file_id = "file id"
+        self.api.file_info_store = FileInfoStore(
+            os.path.join(self.directory, "info.db")
+        )
+        # part number -> Part, as B2 would list them
+        self.parts = {}
+
+        def upload_part(url, token, part_number, length, sha1, stream):
+            self.parts[part_number] = Part(
+                "file id", part_number, length, sha1
+            )
+
+        self.api.api.raw_api.upload_part.side_effect = upload_part
+        self.api.bucket_api.list_parts.side_effect = lambda file_id: list(
+            self.parts.values()
+        )
+        self.file_path = os.path.join(self.directory, "file")
+        with open(self.file_path, "wb") as file:
+            file.write(b"0123456789ab")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def upload(self, file_uuid, abort_requested):
+        with open(self.file_path, "rb") as file:
+            return self.api.upload(
+                file,
+                file_uuid,
+                abort_requested=abort_requested,
+                upload_key="/file",
+            )
+
+    def test_aborted_upload_resumes_from_last_part(self):
+        checks = []
+
+        def abort_after_first_part():
+            checks.append(None)
+            return len(checks) > 1
+
+        with self.assertRaises(UploadAbortException):
+            self.upload("first uuid", abort_after_first_part)
+        assert list(self.parts) == [1]
+        self.api.bucket_api.cancel_large_file.assert_not_called()
+
+        assert self.upload("second uuid", lambda: False) == "first uuid"
+        # The first part was not uploaded again
+        assert self.api.api.raw_api.upload_part.call_count == 3
+        assert self.api.file_info_store.get_file_id("first uuid") == "file id"
+        assert self.api.file_info_store.get_unfinished_upload("/file") is None
+
+    def test_upload_starts_over_if_size_changed(self):
+        with self.assertRaises(UploadAbortException):
+            self.upload("first uuid", lambda: True)
+        with open(self.file_path, "ab") as file:
+            file.write(b"more")
+        assert self.upload("second uuid", lambda: False) == "second uuid"
+        self.api.bucket_api.cancel_large_file.assert_called_once_with(
+            "file id"
+        )
+
+    def test_failure_to_get_part_url_is_retried(self):
+        get_upload_part_url = self.api.api.session.get_upload_part_url
+        get_upload_part_url.side_effect = [B2ConnectionError("down")] + [
+            {"uploadUrl": "url", "authorizationToken": "token"}
+        ] * 3
+        assert self.upload("uuid", lambda: False) == "uuid"
+        assert sorted(self.parts) == [1, 2, 3]
+
+    def test_compression_stops_when_abort_is_requested(self):
+        self.api.compression = True
+        with open(self.file_path, "wb") as file:
+            file.write(b"a" * 1000)
+        with self.assertRaises(UploadAbortException):
+            self.upload("uuid", lambda: True)
+        self.api.bucket_api.start_large_file.assert_not_called()
+
+    def test_unfinished_upload_can_be_cancelled(self):
+        with self.assertRaises(UploadAbortException):
+            self.upload("uuid", lambda: True)
+        assert self.api.get_unfinished_uploads() == ["/file"]
+        self.api.cancel_unfinished_upload("/file")
+        self.api.bucket_api.cancel_large_file.assert_called_once_with(
+            "file id"
+        )
+        assert self.api.get_unfinished_uploads() == []
+
+    def test_file_that_compresses_below_threshold_is_uploaded_at_once(self):
+        self.api.compression = True
+        self.api.large_file_threshold = 100
+        content = b"a" * 1000
+        with open(self.file_path, "wb") as file:
+            file.write(content)
+        self.api.bucket_api.upload_bytes.return_value.as_dict.return_value = {
+            "fileId": "small id"
+        }
+        self.upload("uuid", lambda: False)
+        self.api.bucket_api.start_large_file.assert_not_called()
+        (data, file_name), _ = self.api.bucket_api.upload_bytes.call_args
+        assert file_name == "uuid"
+        stream = BytesIO()
+        decompressing_stream = DecompressingStream(stream)
+        decompressing_stream.write(data)
+        decompressing_stream.finish()
+        assert stream.getvalue() == content
+        assert self.api.file_info_store.get_file_id("uuid") == "small id"
+        assert self.api.file_info_store.get_compression("uuid") == (
+            "zlib",
+            1000,
+        )
+
+
+class ChunkStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.api = FileAPI.__new__(FileAPI)
+        self.api.upload_concurrency = 2
+        self.api.compression = False
+        # file name -> content, as in the bucket
+        self.bucket = {}
+        self.api.bucket_api = fake_bucket_api(self.bucket)
+        self.api.file_info_store = FileInfoStore(
+            os.path.join(self.directory, "info.db")
+        )
+        self.api.chunk_store = ChunkStore(self.api)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def upload(self, content, file_uuid, file_name=None):
+        path = os.path.join(self.directory, file_name or file_uuid)
+        with open(path, "wb") as file:
+            file.write(content)
+        with open(path, "rb") as file:
+            self.api.upload(file, file_uuid)
+
+    def test_identical_content_is_uploaded_once(self):
+        content = random_bytes(3 * AVERAGE_CHUNK_SIZE)
+        self.upload(content, "original")
+        number_of_chunks = len(self.bucket)
+        assert number_of_chunks > 1
+        self.upload(content, "copy")
+        assert len(self.bucket) == number_of_chunks
+        assert self.api.bucket_api.upload_bytes.call_count == number_of_chunks
+        assert self.api.download("copy").read() == content
+
+    def test_ranged_download_across_chunks(self):
+        content = random_bytes(3 * AVERAGE_CHUNK_SIZE)
+        self.upload(content, "file")
+        first_chunk_length = self.api.file_info_store.get_manifest("file")[0][
+            1
+        ]
+        stream = BytesIO()
+        first, last = first_chunk_length - 10, first_chunk_length + 10
+        self.api.download_to("file", stream, range_=(first, last))
+        assert stream.getvalue() == content[first : last + 1]
+
+    def test_chunks_are_deleted_with_their_last_file(self):
+        content = random_bytes(100)
+        self.upload(content, "original")
+        self.upload(content, "copy")
+        self.api.delete("original")
+        assert len(self.bucket) == 1
+        self.api.delete("copy")
+        assert self.bucket == {}
+        assert self.api.file_info_store.get_manifest("copy") is None
+
+    def test_chunk_that_cannot_be_deleted_is_left_to_the_deleter(self):
+        self.upload(random_bytes(100), "file")
+        [name] = self.bucket
+        self.api.bucket_api.delete_file_version.side_effect = (
+            B2ConnectionError("down")
+        )
+        self.api.delete("file")
+        assert self.api.file_info_store.get_manifest("file") is None
+        store = self.api.file_info_store
+        assert store.get_due_deletes(time.time(), 10) == [(name, 0)]
+        self.api.bucket_api.delete_file_version.side_effect = (
+            lambda file_id, file_name: self.bucket.pop(file_name)
+        )
+        with ThreadPoolExecutor(1) as executor:
+            assert self.api.delete_many([name], executor) == {}
+        assert self.bucket == {}
+
+    def test_chunks_of_failed_upload_are_left_to_the_deleter(self):
+        self.api.upload_concurrency = 1
+        self.api.chunk_store = ChunkStore(self.api)
+        upload_bytes = self.api.bucket_api.upload_bytes.side_effect
+
+        def upload_first_chunk_only(data, file_name):
+            if self.bucket:
+                raise B2ConnectionError("down")
+            return upload_bytes(data, file_name)
+
+        self.api.bucket_api.upload_bytes.side_effect = upload_first_chunk_only
+        with self.assertRaises(ConnectionError):
+            self.upload(random_bytes(3 * AVERAGE_CHUNK_SIZE), "file")
+        [name] = self.bucket
+        store = self.api.file_info_store
+        assert store.get_due_deletes(time.time(), 10) == [(name, 0)]
+
+    def test_download_takes_chunks_from_local_copies(self):
+        content = random_bytes(3 * AVERAGE_CHUNK_SIZE)
+        self.upload(content, "original")
+        self.upload(content[:100] + content, "modified")
+
+        def read_local_copy(file_uuid, offset, length):
+            if file_uuid == "original":
+                return content[offset : offset + length]
+
+        stream = BytesIO()
+        self.api.download_to(
+            "modified", stream, read_local_copy=read_local_copy
+        )
+        assert stream.getvalue() == content[:100] + content
+        # Only the first chunk has changed
+        assert self.api.bucket_api.download_file_by_id.call_count == 1
+
+    def test_compressible_chunks_are_stored_compressed(self):
+        self.api.compression = True
+        content = b"".join(
+            b"line %d of a log file\n" % number for number in range(200000)
+        )
+        self.upload(content, "log")
+        assert (
+            sum(len(data) for data in self.bucket.values()) < len(content) / 3
+        )
+        assert self.api.download("log").read() == content
+        stream = BytesIO()
+        self.api.download_to("log", stream, range_=(1000, 2999999))
+        assert stream.getvalue() == content[1000:3000000]
+
+    def test_compression_skips_compressed_formats(self):
+        self.api.compression = True
+        self.api.chunk_store = None
+        self.api.large_file_threshold = LARGE_FILE_THRESHOLD
+        self.api.part_size = PART_SIZE
+        self.api.api = MagicMock()
+        self.api.api.account_info.get_minimum_part_size.return_value = 0
+        content = b"text " * 20000
+        self.upload(content, "text", "text.txt")
+        self.upload(content, "photo", "photo.jpg")
+        assert len(self.bucket["text"]) < len(content) / 10
+        assert self.bucket["photo"] == content
+        assert not self.api.supports_ranged_reads("text")
+        assert self.api.supports_ranged_reads("photo")
+        lengths = []
+        stream = BytesIO()
+        self.api.download_to(
+            "text", stream, range_=(3, 12), on_content_length=lengths.append
+        )
+        assert stream.getvalue() == content[3:13]
+        assert lengths == [10]
+
+
+class PackStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.api = FileAPI.__new__(FileAPI)
+        self.api.compression = False
+        self.bucket = {}
+        self.api.bucket_api = fake_bucket_api(self.bucket)
+        self.api.file_info_store = FileInfoStore(
+            os.path.join(self.directory, "info.db")
+        )
+        self.api.pack_store = PackStore(self.api)
+        self.contents = {
+            f"uuid {number}": random_bytes(1000 + number)
+            for number in range(10)
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def upload_pack(self, file_uuids):
+        self.api.upload_pack(
+            [
+                (file_uuid, self.contents[file_uuid], "file")
+                for file_uuid in file_uuids
+            ]
+        )
+
+    def test_packed_files_are_read_from_their_pack(self):
+        self.upload_pack(self.contents)
+        assert len(self.bucket) == 1
+        for file_uuid, content in self.contents.items():
+            assert self.api.download(file_uuid).read() == content
+        stream = BytesIO()
+        self.api.download_to("uuid 3", stream, range_=(10, 19))
+        assert stream.getvalue() == self.contents["uuid 3"][10:20]
+        assert self.api.supports_ranged_reads("uuid 3")
+
+    def test_compressed_files_in_a_pack(self):
+        self.api.compression = True
+        self.api.pack_store = PackStore(self.api)
+        self.contents["text"] = b"text " * 1000
+        self.upload_pack(["uuid 0", "text", "uuid 1"])
+        assert len(next(iter(self.bucket.values()))) < 2 * 1000 + 2500
+        assert not self.api.supports_ranged_reads("text")
+        for file_uuid in ["uuid 0", "text", "uuid 1"]:
+            assert (
+                self.api.download(file_uuid).read() == self.contents[file_uuid]
+            )
+
+    def test_pack_is_deleted_with_its_last_file(self):
+        self.upload_pack(["uuid 0", "uuid 1"])
+        self.api.delete("uuid 0")
+        assert len(self.bucket) == 1
+        self.api.delete("uuid 1")
+        assert self.bucket == {}
+        assert self.api.file_info_store.get_packed_file("uuid 1") is None
+
+    def test_compaction_moves_files_out_of_sparse_packs(self):
+        self.upload_pack([f"uuid {number}" for number in range(5)])
+        self.upload_pack([f"uuid {number}" for number in range(5, 10)])
+        for number in range(1, 10):
+            if number not in (0, 5, 6):
+                self.api.delete(f"uuid {number}")
+        old_packs = set(self.bucket)
+        self.api.compact_packs()
+        # The old packs are kept until the next compaction
+        assert len(self.bucket) == 3
+        for file_uuid in ["uuid 0", "uuid 5", "uuid 6"]:
+            assert (
+                self.api.download(file_uuid).read() == self.contents[file_uuid]
+            )
+        self.api.compact_packs()
+        assert len(self.bucket) == 1
+        assert not set(self.bucket) & old_packs
+
+    def test_files_are_deleted_together(self):
+        self.upload_pack(["uuid 0"])
+        self.bucket["plain"] = b"content"
+        self.api.file_info_store.set_file_id("plain", "plain")
+        self.api.file_info_store.set_file_id("missing", "missing")
+        with ThreadPoolExecutor(2) as executor:
+            errors = self.api.delete_many(
+                ["plain", "uuid 0", "missing"], executor
+            )
+        assert list(errors) == ["missing"]
+        assert self.bucket == {}
+        assert self.api.file_info_store.get_many(["plain", "missing"]) == {
+            "missing": "missing"
+        }
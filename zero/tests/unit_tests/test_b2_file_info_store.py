@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+from zero.b2_file_info_store import FileInfoStore
+
+
+class FileInfoStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.directory, "info.db")
+        self.store = FileInfoStore(self.db_path, cache_size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_database_is_in_wal_mode(self):
+        (journal_mode,) = self.store.connection.execute(
+            "PRAGMA journal_mode"
+        ).fetchone()
+        assert journal_mode == "wal"
+
+    def test_bulk_operations(self):
+        for number in range(1000):
+            self.store.set_file_id(f"uuid {number}", f"id {number}")
+        self.store.set_file_id("compressed", "id", "zlib", 10)
+        file_ids = self.store.get_many(
+            [f"uuid {number}" for number in range(1000)] + ["unknown"]
+        )
+        assert len(file_ids) == 1000
+        assert file_ids["uuid 999"] == "id 999"
+        assert self.store.get_compression("compressed") == ("zlib", 10)
+        assert self.store.get_compression("uuid 1") is None
+        self.store.remove_many(["uuid 1", "uuid 2"])
+        assert self.store.get_file_id("uuid 1") is None
+        assert self.store.get_file_id("uuid 3") == "id 3"
+
+    def test_lookups_are_cached(self):
+        for number in range(3):
+            self.store.set_file_id(f"uuid {number}", "id")
+        assert len(self.store.file_info_cache) == 2
+        # Changed by another process, which does not happen to uuids
+        # that are in use. It shows which lookups are served from memory.
+        other_store = FileInfoStore(self.db_path)
+        other_store.set_file_id("uuid 0", "other id")
+        other_store.set_file_id("uuid 2", "other id")
+        assert self.store.get_file_id("uuid 0") == "other id"
+        assert self.store.get_file_id("uuid 2") == "id"
+        # "uuid 1" was dropped as the least recently used
+        assert list(self.store.file_info_cache) == ["uuid 0", "uuid 2"]
+
+    def test_packed_files_waiting_to_be_deleted_are_left_out(self):
+        self.store.add_pack(
+            "pack",
+            "id",
+            20,
+            [("a", 0, 10, None, 10), ("b", 10, 10, None, 10)],
+        )
+        self.store.add_pending_deletes(["b"], 0)
+        assert self.store.get_packed_uuids() == ["a"]
+
+    def test_location_is_looked_up_at_once(self):
+        self.store.set_manifest("chunked", [("hash", 10)])
+        self.store.add_pack(
+            "pack", "pack id", 10, [("packed", 0, 10, None, 10)]
+        )
+        self.store.set_file_id("object", "id", "zlib", 10)
+        assert self.store.get_location("chunked") == (
+            [("hash", 10)],
+            None,
+            None,
+        )
+        assert self.store.get_location("packed") == (
+            None,
+            ("pack id", 0, 10, None, 10),
+            None,
+        )
+        assert self.store.get_location("object") == (
+            None,
+            None,
+            ("id", "zlib", 10),
+        )
+        assert self.store.get_location("unknown") == (None, None, None)
+
+    def test_each_released_version_of_a_chunk_is_queued(self):
+        for file_id in ("id 1", "id 2"):
+            self.store.add_chunk("hash", file_id, 10)
+            assert self.store.release_chunks(["hash"], "chunks/", 0) == [
+                ("chunks/hash", file_id)
+            ]
+        assert self.store.get_due_deletes(0, 10) == [("id 1", 0), ("id 2", 0)]
+        assert self.store.get_pending_object_names(
+            ["id 1", "id 2", "uuid"]
+        ) == {"id 1": "chunks/hash", "id 2": "chunks/hash"}
@@ -0,0 +1,69 @@
+import time
+import random
+import tempfile
+import unittest
+from zero.chunking import (
+    split_into_chunks,
+    MIN_CHUNK_SIZE,
+    AVERAGE_CHUNK_SIZE,
+    MAX_CHUNK_SIZE,
+    CONTENT_DEFINED_CHUNKING_LIMIT,
+)
+
+
+def random_bytes(length):
+    # Always the same bytes, so that the chunks are the same in every run
+    return random.Random(length).randbytes(length)
+
+
+def get_chunks(content):
+    with tempfile.TemporaryFile() as file:
+        file.write(content)
+        file.flush()
+        return split_into_chunks(file.fileno())
+
+
+class ChunkingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.content = random_bytes(8 * AVERAGE_CHUNK_SIZE)
+        self.chunks = get_chunks(self.content)
+
+    def test_chunks_cover_file(self):
+        offset = 0
+        for chunk_offset, length, _ in self.chunks:
+            assert chunk_offset == offset
+            assert length <= MAX_CHUNK_SIZE
+            offset += length
+        assert offset == len(self.content)
+        assert all(
+            length >= MIN_CHUNK_SIZE for _, length, _ in self.chunks[:-1]
+        )
+
+    def test_insertion_only_changes_chunk_around_it(self):
+        position = 4 * AVERAGE_CHUNK_SIZE
+        modified = get_chunks(
+            self.content[:position] + b"inserted" + self.content[position:]
+        )
+        hashes = {chunk_hash for _, _, chunk_hash in self.chunks}
+        new_hashes = [
+            chunk_hash
+            for _, _, chunk_hash in modified
+            if chunk_hash not in hashes
+        ]
+        assert len(new_hashes) <= 2
+
+    def test_small_file_is_one_chunk(self):
+        assert len(get_chunks(b"small")) == 1
+        assert get_chunks(b"") == []
+
+    def test_big_file_is_chunked_quickly(self):
+        content = random_bytes(2 * CONTENT_DEFINED_CHUNKING_LIMIT + 1)
+        start = time.monotonic()
+        chunks = get_chunks(content)
+        # Content-defined chunking would take several seconds
+        assert time.monotonic() - start < 2
+        assert [length for _, length, _ in chunks[:-1]] == [MAX_CHUNK_SIZE] * (
+            len(chunks) - 1
+        )
+        assert sum(length for _, length, _ in chunks) == len(content)
@@ -0,0 +1,64 @@
+import os
+import random
+import tempfile
+import unittest
+from io import BytesIO
+from zero import compression
+from zero.compression import (
+    compress,
+    compress_file,
+    is_worth_compressing,
+    CompressionError,
+    DecompressingStream,
+)
+
+CONTENT = b"".join(
+    b"%d bottles of beer\n" % number for number in range(100000)
+)
+
+
+def decompress_in_pieces(compressed, piece_size, first=0, last=None):
+    stream = BytesIO()
+    decompressing_stream = DecompressingStream(stream, first, last)
+    for start in range(0, len(compressed), piece_size):
+        decompressing_stream.write(compressed[start : start + piece_size])
+    decompressing_stream.finish()
+    return stream.getvalue()
+
+
+class CompressionTest(unittest.TestCase):
+
+    def test_file_is_decompressed_in_pieces(self):
+        original_block_size = compression.BLOCK_SIZE
+        compression.BLOCK_SIZE = 1000
+        self.addCleanup(
+            setattr, compression, "BLOCK_SIZE", original_block_size
+        )
+        with tempfile.TemporaryFile() as file:
+            file.write(CONTENT)
+            file.flush()
+            compressed = BytesIO()
+            compress_file(file.fileno(), compressed)
+        compressed = compressed.getvalue()
+        assert compressed == compress(CONTENT)
+        # Pieces smaller than the header, and pieces that decompress
+        # to more than a block
+        for piece_size in (3, 100000):
+            assert decompress_in_pieces(compressed, piece_size) == CONTENT
+        assert (
+            decompress_in_pieces(compressed, 7, 5000, 25000)
+            == CONTENT[5000:25001]
+        )
+
+    def test_truncated_object_is_an_error(self):
+        compressed = compress(CONTENT)
+        with self.assertRaises(CompressionError):
+            decompress_in_pieces(compressed[:-10], 1000)
+        with self.assertRaises(CompressionError):
+            decompress_in_pieces(CONTENT, 1000)
+
+    def test_only_compressible_files_are_compressed(self):
+        assert is_worth_compressing(CONTENT, "bottles.txt")
+        assert not is_worth_compressing(CONTENT, "bottles.MP4")
+        assert not is_worth_compressing(os.urandom(10000), "random.bin")
+        assert not is_worth_compressing(b"")
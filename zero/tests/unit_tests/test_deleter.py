@@ -0,0 +1,73 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+from zero import deleter
+from zero.deleter import Deleter
+from zero.b2_file_info_store import FileInfoStore
+
+
+class DeleterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.api = MagicMock()
+        self.api.file_info_store = FileInfoStore(
+            os.path.join(self.directory, "info.db")
+        )
+        self.deleted = []
+        self.failures = set()
+
+        def delete_many(uuids, executor):
+            errors = {}
+            for uuid in uuids:
+                if uuid in self.failures:
+                    errors[uuid] = ConnectionError()
+                else:
+                    self.deleted.append(uuid)
+            return errors
+
+        self.api.delete_many.side_effect = delete_many
+        self.deleter = Deleter(self.api, workers=4)
+        self.executor = ThreadPoolExecutor(4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        shutil.rmtree(self.directory)
+
+    def test_deletes_are_run_in_batches(self):
+        for number in range(250):
+            self.deleter.add(f"uuid {number}")
+        # Overwritten version, deleted through the same queue
+        self.api.file_info_store.add_pending_deletes(["uuid 0"], time.time())
+        assert self.deleter.arrived.is_set()
+        batches = 0
+        while self.deleter.delete_due(self.executor):
+            batches += 1
+        assert batches == 3
+        assert sorted(self.deleted) == sorted(
+            f"uuid {number}" for number in range(250)
+        )
+
+    def test_failed_deletes_are_retried_later(self):
+        self.failures.add("bad uuid")
+        self.api.file_info_store.add_pending_deletes(
+            ["bad uuid", "good uuid"], time.time()
+        )
+        assert self.deleter.delete_due(self.executor)
+        assert self.deleted == ["good uuid"]
+        # Not due again before the retry delay
+        assert not self.deleter.delete_due(self.executor)
+        assert self.api.file_info_store.get_due_deletes(
+            time.time() + deleter.RETRY_DELAY, 10
+        ) == [("bad uuid", 1)]
+        self.failures.clear()
+        self.api.file_info_store.postpone_pending_deletes(
+            [("bad uuid", time.time())]
+        )
+        assert self.deleter.delete_due(self.executor)
+        assert self.deleted == ["good uuid", "bad uuid"]
+        assert self.api.file_info_store.get_due_deletes(time.time(), 10) == []
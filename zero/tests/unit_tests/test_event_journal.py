@@ -0,0 +1,70 @@
+import json
+import shutil
+import tempfile
+import unittest
+from zero.event_journal import (
+    EventJournal,
+    JournalChannel,
+    JournalSubscription,
+)
+
+
+class EventJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = EventJournal(self.directory, segment_size=100)
+        self.channel = JournalChannel(self.journal)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def publish(self, topic, number):
+        self.channel.basic_publish(
+            exchange="events",
+            routing_key=topic,
+            body=json.dumps({"topic": topic, "number": number}),
+        )
+
+    def test_events_are_read_across_segments(self):
+        for number in range(10):
+            self.publish("a", number)
+        assert len(self.journal._get_segments()) > 1
+        events = self.journal.read(0)
+        assert [json.loads(line)["number"] for _, line in events] == list(
+            range(10)
+        )
+        assert events[-1][0] == self.journal.get_end_offset()
+        # Reading from an offset continues with the event after it
+        offset = events[3][0]
+        assert json.loads(self.journal.read(offset)[0][1])["number"] == 4
+
+    def test_consumer_resumes_where_it_left_off(self):
+        subscription = JournalSubscription(self.journal, ["a"], "worker")
+        for number in range(4):
+            self.publish("a" if number % 2 else "b", number)
+        events = subscription.yield_events()
+        assert next(events)["number"] == 1
+        assert next(events)["number"] == 3
+        subscription.close()
+        events.close()
+        # Published while the consumer was not running
+        self.publish("a", 4)
+        subscription = JournalSubscription(self.journal, ["a"], "worker")
+        # The last event that was handed out is handed out again,
+        # because it may not have been handled completely.
+        events = subscription.yield_events()
+        assert next(events)["number"] == 3
+        assert next(events)["number"] == 4
+
+    def test_consumed_segments_are_deleted(self):
+        subscription = JournalSubscription(self.journal, ["a"], "worker")
+        events = subscription.yield_events()
+        for number in range(10):
+            self.publish("a", number)
+        for number in range(10):
+            assert next(events)["number"] == number
+        subscription.close()
+        self.journal.compact()
+        # Only the segment that is written to is left
+        assert len(self.journal._get_segments()) == 1
@@ -6,3 +6,131 @@ class EventTest(unittest.TestCase):
 
     def test_can_submit_event(self):
         FileAccessEvent.submit(path="/hello/to/this.path")
+
+
+class CoalescingChannelTest(unittest.TestCase):
+
+    def setUp(self):
+        from unittest.mock import MagicMock
+        from ...events import CoalescingChannel, FileAccessEvent
+
+        self.inner = MagicMock()
+        self.channel = CoalescingChannel(
+            self.inner, topics=(FileAccessEvent.topic,), window=0.05
+        )
+
+    def test_repeated_events_are_sent_once_per_window(self):
+        import time
+
+        for _ in range(100):
+            FileAccessEvent(self.channel).submit(path="/a")
+        assert self.inner.basic_publish.call_count == 1
+        time.sleep(0.2)
+        assert self.inner.basic_publish.call_count == 2
+
+    def test_flush_sends_collapsed_events(self):
+        FileAccessEvent(self.channel).submit(path="/a")
+        FileAccessEvent(self.channel).submit(path="/a")
+        FileAccessEvent(self.channel).submit(path="/b")
+        self.channel.flush("/a")
+        assert self.inner.basic_publish.call_count == 3
+        self.channel.flush("/a")
+        assert self.inner.basic_publish.call_count == 3
+
+    def test_other_events_are_sent_after_collapsed_events(self):
+        from ...events import FileDeleteEvent
+
+        FileAccessEvent(self.channel).submit(path="/a")
+        FileAccessEvent(self.channel).submit(path="/a")
+        FileDeleteEvent(self.channel).submit(path="/a", uuid=None)
+        topics = [
+            call.kwargs["routing_key"]
+            for call in self.inner.basic_publish.call_args_list
+        ]
+        assert topics == [
+            FileAccessEvent.topic,
+            FileAccessEvent.topic,
+            FileDeleteEvent.topic,
+        ]
+
+
+class BackgroundPublisherTest(unittest.TestCase):
+
+    def test_events_are_published_after_reconnect(self):
+        import time
+        from unittest.mock import MagicMock
+        from ...events import BackgroundPublisher
+
+        channel = MagicMock()
+        connect = MagicMock(side_effect=[OSError("down"), (None, channel)])
+        publisher = BackgroundPublisher(connect=connect)
+        publisher.basic_publish(exchange="events", routing_key="a", body="1")
+        publisher.basic_publish(exchange="events", routing_key="a", body="2")
+        deadline = time.monotonic() + 5
+        while channel.basic_publish.call_count < 2:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        bodies = [
+            call.kwargs["body"]
+            for call in channel.basic_publish.call_args_list
+        ]
+        assert bodies == ["1", "2"]
+
+    def test_event_that_fails_to_publish_does_not_stop_later_events(self):
+        import time
+        from unittest.mock import MagicMock
+        from ...events import BackgroundPublisher
+
+        channel = MagicMock()
+        channel.basic_publish.side_effect = [ValueError("bad event"), None]
+        connect = MagicMock(return_value=(None, channel))
+        publisher = BackgroundPublisher(connect=connect)
+        publisher.basic_publish(exchange="events", routing_key="a", body="1")
+        publisher.basic_publish(exchange="events", routing_key="a", body="2")
+        deadline = time.monotonic() + 5
+        while channel.basic_publish.call_count < 2:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        assert channel.basic_publish.call_args.kwargs["body"] == "2"
+        assert publisher.dropped == 1
+        # The channel was fine, so it is kept
+        assert connect.call_count == 1
+
+    def test_lost_connection_is_closed_before_reconnecting(self):
+        import time
+        from unittest.mock import MagicMock
+        from ...events import BackgroundPublisher
+
+        lost_connection, lost_channel = MagicMock(), MagicMock()
+        lost_channel.basic_publish.side_effect = OSError("connection lost")
+        channel = MagicMock()
+        connect = MagicMock(
+            side_effect=[(lost_connection, lost_channel), (None, channel)]
+        )
+        publisher = BackgroundPublisher(connect=connect)
+        publisher.basic_publish(exchange="events", routing_key="a", body="1")
+        deadline = time.monotonic() + 5
+        while not channel.basic_publish.called:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        lost_channel.close.assert_called_once()
+        lost_connection.close.assert_called_once()
+
+    def test_oldest_events_are_dropped_when_buffer_is_full(self):
+        import threading
+        from unittest.mock import MagicMock
+        from ...events import BackgroundPublisher
+
+        blocked = threading.Event()
+        publisher = BackgroundPublisher(
+            connect=MagicMock(side_effect=lambda: blocked.wait()),
+            buffer_size=2,
+            batch_size=1,
+        )
+        for body in ("1", "2", "3", "4"):
+            publisher.basic_publish(
+                exchange="events", routing_key="a", body=body
+            )
+        # One event may have been taken by the publisher thread
+        assert [message[3] for message in publisher.buffer] == ["3", "4"]
+        assert publisher.dropped >= 1
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from zero import hydration
+from zero.hydration import Hydration, HydrationFailedException
+
+FILE_CONTENT = bytes(range(256)) * 1000
+
+
+def fake_download_to(file_uuid, stream, range_=None, on_content_length=None):
+    if range_ is None:
+        content = FILE_CONTENT
+    else:
+        content = FILE_CONTENT[range_[0] : range_[1] + 1]
+    if on_content_length is not None:
+        on_content_length(len(content))
+    for start in range(0, len(content), 4096):
+        stream.write(content[start : start + 4096])
+
+
+class HydrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.directory, "dummy")
+        open(self.file_path, "w").close()
+        self.api = MagicMock()
+        self.api.download_to.side_effect = fake_download_to
+        self.on_complete = MagicMock()
+        self.on_failure = MagicMock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _hydrate(self):
+        return Hydration(
+            api=self.api,
+            uuid="uuid",
+            file_path=self.file_path,
+            on_complete=self.on_complete,
+            on_failure=self.on_failure,
+        ).start()
+
+    def test_read_while_hydrating(self):
+        hydration_in_flight = self._hydrate()
+        hydration_in_flight.wait_for(1000, 100)
+        with open(self.file_path, "rb") as file:
+            file.seek(1000)
+            assert file.read(100) == FILE_CONTENT[1000:1100]
+        hydration_in_flight.wait_until_complete()
+        with open(self.file_path, "rb") as file:
+            assert file.read() == FILE_CONTENT
+        self.on_complete.assert_called_once()
+
+    def test_jump_ahead_uses_ranged_download(self):
+        original_values = (
+            hydration.RANGE_FETCH_SIZE,
+            hydration.STREAM_AHEAD_TOLERANCE,
+        )
+        hydration.RANGE_FETCH_SIZE = 1000
+        hydration.STREAM_AHEAD_TOLERANCE = 0
+        self.addCleanup(
+            setattr, hydration, "RANGE_FETCH_SIZE", original_values[0]
+        )
+        self.addCleanup(
+            setattr, hydration, "STREAM_AHEAD_TOLERANCE", original_values[1]
+        )
+        hydration_in_flight = Hydration(
+            api=self.api,
+            uuid="uuid",
+            file_path=self.file_path,
+            on_complete=self.on_complete,
+            on_failure=self.on_failure,
+        )
+        # Pretend the background download got stuck after the first bytes
+        hydration_in_flight._set_content_length(len(FILE_CONTENT))
+        hydration_in_flight.wait_for(200500, 100)
+        with open(self.file_path, "rb") as file:
+            file.seek(200500)
+            assert file.read(100) == FILE_CONTENT[200500:200600]
+        self.api.download_to.assert_called_once()
+        assert self.api.download_to.call_args[1]["range_"] == (200000, 200999)
+
+    def test_failed_hydration_leaves_empty_dummy(self):
+        self.api.download_to.side_effect = ConnectionError
+        hydration_in_flight = self._hydrate()
+        with self.assertRaises(HydrationFailedException):
+            hydration_in_flight.wait_until_complete()
+        hydration_in_flight.thread.join()
+        assert os.path.getsize(self.file_path) == 0
+        self.on_failure.assert_called_once()
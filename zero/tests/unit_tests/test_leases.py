@@ -0,0 +1,96 @@
+import unittest
+from zero.leases import LeaseTable
+from zero.locking import PathLock, NodeLockedException
+
+PATH = "/some/file"
+
+
+class LeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.leases = LeaseTable()
+
+    def test_handles_on_same_path_share_a_lease(self):
+        first = self.leases.acquire(PATH)
+        second = self.leases.acquire(PATH)
+        assert first is second
+        self.leases.release(first)
+        assert first.is_held
+        self.leases.release(second)
+        assert not first.is_held
+        assert self.leases.leases == {}
+
+    def test_shared_lease_keeps_out_eviction_but_not_upload(self):
+        lease = self.leases.acquire(PATH)
+        with PathLock(PATH, exclusive_lock_on_leaf=False):
+            pass
+        with self.assertRaises(NodeLockedException):
+            PathLock(PATH, exclude_open_handles=True).__enter__()
+        self.leases.release(lease)
+        with PathLock(PATH, exclude_open_handles=True):
+            pass
+
+    def test_exclusive_lease_keeps_out_upload(self):
+        lease = self.leases.acquire(PATH)
+        lease.make_exclusive()
+        with self.assertRaises(NodeLockedException):
+            PathLock(PATH, exclusive_lock_on_leaf=False).__enter__()
+        self.leases.release(lease)
+        with PathLock(PATH, exclusive_lock_on_leaf=False):
+            pass
+
+    def test_lease_keeps_folder_from_being_locked(self):
+        lease = self.leases.acquire(PATH)
+        with self.assertRaises(NodeLockedException):
+            PathLock("/some").__enter__()
+        self.leases.release(lease)
+        with PathLock("/some"):
+            pass
+
+    def test_moved_lease_keeps_out_upload_at_new_path(self):
+        lease = self.leases.acquire(PATH)
+        lease.make_exclusive()
+        self.leases.move("/some", "/other")
+        assert lease.path == "/other/file"
+        assert self.leases.leases == {"/other/file": lease}
+        with self.assertRaises(NodeLockedException):
+            PathLock("/other/file", exclusive_lock_on_leaf=False).__enter__()
+        with PathLock(PATH, exclusive_lock_on_leaf=False):
+            pass
+        self.leases.release(lease)
+        assert self.leases.leases == {}
+
+    def test_lease_on_replaced_file_is_let_go_of(self):
+        replaced = self.leases.acquire("/some/other")
+        lease = self.leases.acquire(PATH, exclusive=True)
+        self.leases.move(PATH, "/some/other")
+        assert not replaced.is_held
+        assert self.leases.leases == {"/some/other": lease}
+        replaced.make_exclusive()
+        self.leases.release(replaced)
+        assert self.leases.leases == {"/some/other": lease}
+        self.leases.release(lease)
+        assert self.leases.leases == {}
+
+    def test_lease_is_let_go_of_if_upgrade_loses_the_lock(self):
+        from zero.locking import NodeLock
+
+        lease = self.leases.acquire(PATH)
+        leaf = lease.path_lock.locks[-1]
+        leaf.acquisition_timeout = 0
+        # Another process takes the lock while the shared lock is let go of
+        intruder = NodeLock(leaf.lock_id, exclusive=True)
+        unlock = leaf._unlock
+
+        def unlock_and_lose_the_lock():
+            unlock()
+            intruder.__enter__()
+
+        leaf._unlock = unlock_and_lose_the_lock
+        with self.assertRaises(NodeLockedException):
+            lease.make_exclusive()
+        assert not lease.is_held
+        intruder.__exit__()
+        self.leases.release(lease)
+        with PathLock(PATH, exclude_open_handles=True):
+            pass
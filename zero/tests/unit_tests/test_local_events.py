@@ -0,0 +1,89 @@
+import os
+import json
+import socket
+import shutil
+import tempfile
+import unittest
+import time
+from zero.local_events import LocalChannel, LocalSubscription, subscribe
+
+
+class LocalEventsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.channel = LocalChannel(self.directory)
+
+    def tearDown(self):
+        self.channel.close()
+        shutil.rmtree(self.directory)
+
+    def publish(self, topic, **message):
+        self.channel.basic_publish(
+            exchange="events",
+            routing_key=topic,
+            body=json.dumps({"topic": topic, **message}),
+        )
+
+    def test_events_go_to_all_listeners_of_their_topic(self):
+        first = LocalSubscription(self.directory, ["a"])
+        second = LocalSubscription(self.directory, ["a", "b"])
+        self.publish("a", number=1)
+        self.publish("b", number=2)
+        assert next(first.yield_events()) == {"topic": "a", "number": 1}
+        events = second.yield_events()
+        assert [next(events)["number"], next(events)["number"]] == [1, 2]
+        assert first.events.empty()
+        first.close()
+        second.close()
+
+    def test_listeners_that_went_away_are_unregistered(self):
+        subscription = LocalSubscription(self.directory, ["a"])
+        # Simulate a crash: the socket is gone, the registration is not
+        subscription.socket.shutdown(socket.SHUT_RDWR)
+        subscription.socket.close()
+        self.publish("a", number=1)
+        assert os.listdir(os.path.join(self.directory, "topics", "a")) == []
+
+    def test_named_consumer_gets_events_it_has_not_handled_again(self):
+        subscribe(self.directory, ["a"], consumer="worker").close()
+        for number in range(3):
+            self.publish("a", number=number)
+        subscription = subscribe(self.directory, ["a"], consumer="worker")
+        events = subscription.yield_events()
+        assert next(events)["number"] == 0
+        assert next(events)["number"] == 1
+        # The consumer dies while handling the second event
+        subscription.close()
+        events = subscribe(
+            self.directory, ["a"], consumer="worker"
+        ).yield_events()
+        assert [next(events)["number"], next(events)["number"]] == [1, 2]
+
+    def test_listener_that_falls_behind_does_not_block_publisher(self):
+        # A listener that never takes events off its socket
+        os.makedirs(os.path.join(self.directory, "listeners"))
+        os.makedirs(os.path.join(self.directory, "topics", "a"))
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        listener.bind(os.path.join(self.directory, "listeners", "stuck.sock"))
+        open(os.path.join(self.directory, "topics", "a", "stuck"), "w").close()
+        start = time.monotonic()
+        for number in range(1000):
+            self.publish("a", number=number, padding="x" * 1000)
+        assert time.monotonic() - start < 1
+        assert self.channel.dropped > 0
+        listener.close()
+
+    def test_listener_that_registers_within_the_same_mtime_is_found(self):
+        first = LocalSubscription(self.directory, ["a"])
+        self.publish("a", number=1)
+        topic_directory = os.path.join(self.directory, "topics", "a")
+        modification_time = os.stat(topic_directory).st_mtime_ns
+        second = LocalSubscription(self.directory, ["a"])
+        # As on a file system with coarse timestamps
+        os.utime(topic_directory, ns=(modification_time, modification_time))
+        self.publish("a", number=2)
+        event = json.loads(second.events.get(timeout=1))
+        assert event == {"topic": "a", "number": 2}
+        first.close()
+        second.close()
@@ -0,0 +1,73 @@
+import unittest
+import threading
+from unittest.mock import MagicMock
+
+
+class LockTableTest(unittest.TestCase):
+
+    def setUp(self):
+        from zero.lock_manager import LockTable
+
+        self.table = LockTable()
+
+    def test_intention_locks_are_compatible(self):
+        from zero.lock_manager import IX, X
+
+        self.assertTrue(
+            self.table.acquire(MagicMock(), {"dir": IX, "dir/a": X})
+        )
+        self.assertTrue(
+            self.table.acquire(MagicMock(), {"dir": IX, "dir/b": X})
+        )
+
+    def test_exclusive_lock_on_directory_conflicts_with_intention_lock(self):
+        from zero.lock_manager import IS, S, X
+
+        self.table.acquire(MagicMock(), {"dir": IS, "dir/a": S})
+        self.assertFalse(self.table.acquire(MagicMock(), {"dir": X}))
+
+    def test_high_priority_request_asks_holder_to_abort(self):
+        from zero.lock_manager import S, X
+
+        holder = MagicMock()
+        self.table.acquire(holder, {"a": S})
+        self.assertFalse(
+            self.table.acquire(MagicMock(), {"a": X}, high_priority=True)
+        )
+        holder.request_abort.assert_called_once()
+
+    def test_waiting_request_is_granted_on_release(self):
+        from zero.lock_manager import X
+
+        holder = MagicMock()
+        self.table.acquire(holder, {"a": X})
+        threading.Timer(0.05, self.table.release_all, args=(holder,)).start()
+        self.assertTrue(self.table.acquire(MagicMock(), {"a": X}, timeout=5))
+
+    def test_convert_shared_to_exclusive(self):
+        from zero.lock_manager import S, X
+
+        owner = MagicMock()
+        self.table.acquire(owner, {"a": S})
+        self.assertTrue(self.table.convert(owner, "a", X))
+        self.assertFalse(self.table.acquire(MagicMock(), {"a": S}))
+
+    def test_intention_locks_of_two_holders_can_be_converted(self):
+        from zero.lock_manager import IS, IX, S
+
+        first, second = MagicMock(), MagicMock()
+        self.table.acquire(first, {"dir": IS})
+        self.table.acquire(second, {"dir": IS})
+        reader = MagicMock()
+        self.table.acquire(reader, {"dir": S})
+        threading.Timer(0.05, self.table.release_all, args=(reader,)).start()
+        converted = []
+        thread = threading.Thread(
+            target=lambda: converted.append(
+                self.table.convert(first, "dir", IX, timeout=5)
+            )
+        )
+        thread.start()
+        self.assertTrue(self.table.convert(second, "dir", IX, timeout=5))
+        thread.join()
+        self.assertEqual(converted, [True])
@@ -45,3 +45,33 @@ class LockTest(unittest.TestCase):
         with NodeLock(1, exclusive=False):
             lock2 = NodeLock(1, exclusive=False)
             lock2.__enter__()
+
+    def test_waiting_lock_is_acquired_soon_after_release(self):
+        import time
+        import threading
+        from zero.locking import NodeLock
+
+        holder = NodeLock(1, exclusive=True)
+        holder.__enter__()
+        threading.Timer(0.05, holder.__exit__).start()
+        start = time.monotonic()
+        with NodeLock(1, exclusive=True, acquisition_timeout=5):
+            waited = time.monotonic() - start
+        self.assertLess(waited, 0.5)
+
+    def test_waiting_lock_gives_up_after_timeout(self):
+        import os
+        import threading
+        from zero.locking import NodeLock, NodeLockedException
+
+        threads = threading.active_count()
+        with NodeLock(1, exclusive=True):
+            lock2 = NodeLock(1, exclusive=True, acquisition_timeout=0.1)
+            with self.assertRaises(NodeLockedException):
+                lock2.__enter__()
+        # The abandoned attempt must not keep the lock or its file
+        open_files = len(os.listdir("/proc/self/fd"))
+        with NodeLock(1, exclusive=True, acquisition_timeout=1):
+            pass
+        self.assertEqual(len(os.listdir("/proc/self/fd")), open_files)
+        self.assertEqual(threading.active_count(), threads)
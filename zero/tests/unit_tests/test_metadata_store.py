@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+from zero.state_store import StateStore, STATES
+from zero.metadata_store import WriteBuffer, MetaData, RELATIME_THRESHOLD
+
+
+class WriteBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_folder = tempfile.mkdtemp()
+        self.store = StateStore(self.cache_folder)
+        self.store.add("/file", os.stat(self.cache_folder), STATES.CLEAN)
+        self.store.set_value("/file", "size", 0)
+        self.buffer = WriteBuffer(self.store, flush_interval=3600)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_folder)
+
+    def test_first_write_marks_file_dirty_right_away(self):
+        self.buffer.record_write("/file", 10)
+        assert self.store.get_value("/file", "state") == STATES.DIRTY
+        assert self.store.get_value("/file", "size") == 10
+
+    def test_later_writes_are_kept_until_flush(self):
+        self.buffer.record_write("/file", 10)
+        self.buffer.record_write("/file", 20)
+        assert self.store.get_value("/file", "size") == 10
+        assert self.buffer.get("/file")[1] == 20
+        self.buffer.flush("/file")
+        assert self.store.get_value("/file", "size") == 20
+        assert self.buffer.get("/file") is None
+
+
+class RelatimeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_folder = tempfile.mkdtemp()
+        self.metadata = MetaData(self.cache_folder)
+        self.store = self.metadata.store
+        self.store.add("/file", os.stat(self.cache_folder), STATES.CLEAN)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_folder)
+
+    def test_atime_is_only_updated_when_due(self):
+        self.store.set_value("/file", "mtime", 100)
+        self.store.set_value("/file", "ctime", 100)
+        self.store.set_value("/file", "atime", 50)
+        assert self.metadata.record_access("/file")
+        assert not self.metadata.record_access("/file")
+        atime = self.store.get_value("/file", "atime")
+        self.store.set_value("/file", "atime", atime - RELATIME_THRESHOLD)
+        assert self.metadata.record_access("/file")
@@ -0,0 +1,50 @@
+import threading
+import unittest
+from zero.packer import Packer
+
+
+class PackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.packs = []
+        self.failed = []
+        self.packed = threading.Event()
+
+    def make_packer(self, pack_size, delay, upload_pack=None):
+        return Packer(
+            upload_pack or self.packs.append,
+            lambda members: self.packed.set(),
+            self.failed.extend,
+            pack_size=pack_size,
+            delay=delay,
+        )
+
+    def test_full_pack_is_uploaded_right_away(self):
+        packer = self.make_packer(pack_size=10, delay=60)
+        packer.add("/a", "uuid a", b"12345")
+        packer.add("/b", "uuid b", b"12345")
+        assert self.packed.wait(5)
+        assert self.packs == [
+            [("uuid a", b"12345", "/a"), ("uuid b", b"12345", "/b")]
+        ]
+        assert len(packer) == 0
+
+    def test_pack_is_uploaded_after_delay(self):
+        packer = self.make_packer(pack_size=1000, delay=0.1)
+        packer.add("/a", "first uuid", b"old")
+        # Replaces the version of the file that is waiting
+        packer.add("/a", "second uuid", b"new")
+        assert self.packed.wait(5)
+        assert self.packs == [[("second uuid", b"new", "/a")]]
+
+    def test_failed_pack_is_handed_back(self):
+        def fail(members):
+            raise ConnectionError
+
+        packer = self.make_packer(pack_size=1, delay=60, upload_pack=fail)
+        packer.add("/a", "uuid", b"data")
+        for _ in range(50):
+            if self.failed:
+                break
+            threading.Event().wait(0.1)
+        assert self.failed == [("/a", "uuid", b"data")]
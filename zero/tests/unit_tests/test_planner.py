@@ -0,0 +1,59 @@
+import unittest
+from zero.cache_management.planner import (
+    Planner,
+    ACTIONS,
+    select_evictees,
+    select_primees,
+)
+
+
+class PlannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.planner = Planner(target=1000, watermark_fraction=0.1)
+
+    def test_cache_within_watermarks_is_left_alone(self):
+        assert self.planner.plan(1090, 10, is_sorted=True) is None
+        assert self.planner.plan(910, 10, is_sorted=True) is None
+
+    def test_cache_outside_watermarks_goes_back_to_target(self):
+        plan = self.planner.plan(1500, 10, is_sorted=True)
+        assert (plan.action, plan.amount) == (ACTIONS.EVICT, 500)
+        plan = self.planner.plan(800, 10, is_sorted=True)
+        assert (plan.action, plan.amount) == (ACTIONS.PRIME, 200)
+
+    def test_band_is_wider_than_biggest_file(self):
+        assert self.planner.plan(1200, 200, is_sorted=True) is None
+
+    def test_unsorted_cache_within_watermarks_swaps_files(self):
+        plan = self.planner.plan(1050, 10, is_sorted=False, primee_size=20)
+        assert (plan.action, plan.amount) == (ACTIONS.EVICT, 70)
+        plan = self.planner.plan(950, 10, is_sorted=False, primee_size=20)
+        assert (plan.action, plan.amount) == (ACTIONS.PRIME, 50)
+
+    def test_swap_at_target_makes_room_for_a_file(self):
+        plan = self.planner.plan(1000, 10, is_sorted=False, primee_size=20)
+        assert (plan.action, plan.amount) == (ACTIONS.EVICT, 20)
+        # Less room than the file takes
+        plan = self.planner.plan(990, 10, is_sorted=False, primee_size=20)
+        assert (plan.action, plan.amount) == (ACTIONS.EVICT, 10)
+
+    def test_unsorted_cache_without_files_to_swap_is_left_alone(self):
+        assert self.planner.plan(1000, 10, is_sorted=False) is None
+        # Swapping in a file this big would leave the band
+        assert (
+            self.planner.plan(1000, 10, is_sorted=False, primee_size=500)
+            is None
+        )
+
+    def test_evictees_cover_amount(self):
+        sizes = {"/a": 30, "/b": 30, "/d": 30}
+        # /c is not clean, so it cannot be evicted
+        candidates = ["/a", "/b", "/c", "/d"]
+        assert select_evictees(candidates, sizes, 50) == ["/a", "/b"]
+        assert select_evictees(candidates, sizes, 61) == ["/a", "/b", "/d"]
+
+    def test_primees_fit_into_amount(self):
+        sizes = {"/a": 30, "/b": 80, "/c": 20}
+        candidates = ["/a", "/b", "/c"]
+        assert select_primees(candidates, sizes, 60) == ["/a", "/c"]
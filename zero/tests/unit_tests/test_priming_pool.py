@@ -0,0 +1,48 @@
+import threading
+import unittest
+from zero.cache_management.priming_pool import PrimingPool
+
+
+class PrimingPoolTest(unittest.TestCase):
+
+    def test_paths_are_primed_concurrently(self):
+        # Only passes if all three paths are primed at the same time
+        barrier = threading.Barrier(3, timeout=5)
+        primed = []
+
+        def prime(path):
+            barrier.wait()
+            primed.append(path)
+
+        pool = PrimingPool(prime, workers=3)
+        pool.submit(["/a", "/b", "/c"])
+        assert pool.wait_until_idle(timeout=5)
+        assert sorted(primed) == ["/a", "/b", "/c"]
+
+    def test_path_is_not_primed_twice_at_once(self):
+        release = threading.Event()
+        primed = []
+
+        def prime(path):
+            primed.append(path)
+            release.wait(5)
+
+        pool = PrimingPool(prime, workers=2)
+        pool.submit(["/a"])
+        pool.submit(["/a", "/b"])
+        release.set()
+        assert pool.wait_until_idle(timeout=5)
+        assert sorted(primed) == ["/a", "/b"]
+
+    def test_failure_does_not_stop_the_pool(self):
+        primed = []
+
+        def prime(path):
+            if path == "/a":
+                raise OSError
+            primed.append(path)
+
+        pool = PrimingPool(prime, workers=1)
+        pool.submit(["/a", "/b"])
+        assert pool.wait_until_idle(timeout=5)
+        assert primed == ["/b"]
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+from zero.state_store import StateStore, STATES
+
+
+class StateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_folder = tempfile.mkdtemp()
+        self.store = StateStore(self.cache_folder)
+        self.stat = os.stat(self.cache_folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_folder)
+
+    def test_write_marks_clean_file_dirty_and_grows_it(self):
+        self.store.add("/file", self.stat, STATES.CLEAN)
+        self.store.set_value("/file", "size", 10)
+        self.store.record_write("/file", 5)
+        entry = self.store.get("/file")
+        assert entry["state"] == STATES.DIRTY
+        assert entry["size"] == 10
+        self.store.record_write("/file", 20)
+        assert self.store.get_value("/file", "size") == 20
+
+    def test_transition_only_from_expected_state(self):
+        self.store.add("/file", self.stat, STATES.DIRTY)
+        assert not self.store.transition("/file", STATES.CLEAN, STATES.REMOTE)
+        assert self.store.transition("/file", STATES.DIRTY, STATES.CLEAN)
+        assert self.store.get_value("/file", "state") == STATES.CLEAN
+
+    def test_move_folder_moves_files_below_it(self):
+        for path in ("/dir/a", "/dir/sub/b", "/dir2/c", "/target/old"):
+            self.store.add(path, self.stat, STATES.CLEAN, uuid=path)
+        self.store.move("/dir", "/target")
+        assert self.store.get_value("/target/a", "uuid") == "/dir/a"
+        assert self.store.get_value("/target/sub/b", "uuid") == "/dir/sub/b"
+        assert self.store.get("/target/old") is None
+        assert self.store.get("/dir/a") is None
+        assert self.store.get_value("/dir2/c", "uuid") == "/dir2/c"
+
+    def test_adding_known_path_keeps_uuid(self):
+        self.store.add("/file", self.stat, STATES.CLEAN, uuid="old")
+        self.store.add("/file", self.stat, STATES.DIRTY)
+        assert self.store.get_value("/file", "uuid") == "old"
+
+    def test_totals_follow_sizes_and_states(self):
+        self.store.add("/a", self.stat, STATES.DIRTY)
+        self.store.set_value("/a", "size", 10)
+        self.store.add("/b", self.stat, STATES.CLEAN)
+        self.store.set_value("/b", "size", 30)
+        assert self.store.get_resident_size() == 40
+        assert self.store.get_biggest_resident_size() == 30
+        self.store.record_write("/a", 50)
+        assert self.store.get_biggest_resident_size() == 50
+        self.store.transition("/a", STATES.DIRTY, STATES.CLEAN)
+        self.store.transition("/a", STATES.CLEAN, STATES.REMOTE)
+        assert self.store.get_resident_size() == 30
+        self.store.delete("/b")
+        assert self.store.get_resident_size() == 0
+        assert self.store.get_biggest_resident_size() == 0
+
+    def test_totals_are_computed_for_existing_database(self):
+        self.store.add("/a", self.stat, STATES.CLEAN)
+        self.store.set_value("/a", "size", 10)
+        self.store.connection.execute("DROP TABLE totals")
+        assert StateStore(self.cache_folder).get_resident_size() == 10
+
+    def test_sizes_of_files_in_state(self):
+        self.store.add("/a", self.stat, STATES.CLEAN)
+        self.store.add("/b", self.stat, STATES.DIRTY)
+        self.store.set_value("/a", "size", 10)
+        sizes = self.store.get_sizes(["/a", "/b", "/c"], STATES.CLEAN)
+        assert sizes == {"/a": 10}
+
+    def test_used_uuids(self):
+        self.store.add("/a", self.stat, STATES.CLEAN)
+        self.store.set_value("/a", "uuid", "used")
+        uuids = ["used", "unused"] + [
+            f"uuid {number}" for number in range(600)
+        ]
+        assert self.store.get_used_uuids(uuids) == {"used"}
@@ -0,0 +1,36 @@
+import time
+import unittest
+from zero.upload_backlog import UploadBacklog
+
+
+class UploadBacklogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backlog = UploadBacklog(quiescence=0.1)
+
+    def test_path_is_handed_out_once_after_it_was_quiet(self):
+        start = time.monotonic()
+        for _ in range(100):
+            self.backlog.add("/file")
+        assert self.backlog.take(timeout=1) == "/file"
+        assert time.monotonic() - start >= 0.1
+        assert self.backlog.take(timeout=0.2) is None
+
+    def test_adding_a_path_postpones_it(self):
+        self.backlog.add("/first")
+        self.backlog.add("/second")
+        time.sleep(0.05)
+        self.backlog.add("/first")
+        assert self.backlog.take(timeout=1) == "/second"
+        assert self.backlog.take(timeout=1) == "/first"
+
+    def test_path_is_not_handed_out_during_its_upload(self):
+        self.backlog.add("/file")
+        assert self.backlog.take(timeout=1) == "/file"
+        # Written to again while it is being uploaded
+        self.backlog.add("/file")
+        assert self.backlog.take(timeout=0.2) is None
+        self.backlog.done("/file")
+        assert self.backlog.take(timeout=1) == "/file"
+        self.backlog.done("/file")
+        assert len(self.backlog) == 0
@@ -0,0 +1,71 @@
+import time
+import heapq
+import threading
+
+# A file is uploaded once it has not been written to for this long.
+# Files are often written in many small steps, and each of them
+# would otherwise start a new upload.
+QUIESCENCE_PERIOD = 2  # seconds
+
+
+class UploadBacklog:
+    """Paths that wait to be uploaded, each of them at most once.
+
+    Adding a path that is already in the backlog postpones it. A path
+    is handed out once it has been quiet for `quiescence` seconds, and
+    not again until the upload is done.
+    """
+
+    def __init__(self, quiescence=QUIESCENCE_PERIOD):
+        self.quiescence = quiescence
+        # path -> time at which it is due
+        self.due = {}
+        # (time, path). Entries whose time is no longer the one in
+        # `due` are outdated and skipped.
+        self.heap = []
+        self.in_progress = set()
+        self.condition = threading.Condition()
+
+    def add(self, path):
+        with self.condition:
+            due = time.monotonic() + self.quiescence
+            self.due[path] = due
+            if path not in self.in_progress:
+                heapq.heappush(self.heap, (due, path))
+            self.condition.notify_all()
+
+    def take(self, timeout=None):
+        """Waits for a path that is due and returns it.
+        Returns None if there was none within `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                while self.heap and (
+                    self.due.get(self.heap[0][1]) != self.heap[0][0]
+                ):
+                    heapq.heappop(self.heap)
+                now = time.monotonic()
+                if self.heap and self.heap[0][0] <= now:
+                    _, path = heapq.heappop(self.heap)
+                    del self.due[path]
+                    self.in_progress.add(path)
+                    return path
+                wait = self.heap[0][0] - now if self.heap else None
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    wait = min(wait or deadline - now, deadline - now)
+                self.condition.wait(wait)
+
+    def done(self, path):
+        with self.condition:
+            self.in_progress.discard(path)
+            if path in self.due:
+                # It was added again during the upload
+                heapq.heappush(self.heap, (self.due[path], path))
+                self.condition.notify_all()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.due) + len(self.in_progress)